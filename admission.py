@@ -0,0 +1,304 @@
+import os
+import re
+import heapq
+import itertools
+import threading
+from decimal import Decimal
+
+import metrics
+import settings.settings as settings
+from informer import Informer
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+# multipliers of the suffixes of resource quantities
+QUANTITY_SUFFIXES = {
+    "n": Decimal("1e-9"), "u": Decimal("1e-6"), "m": Decimal("1e-3"), "": Decimal(1),
+    "k": Decimal("1e3"), "M": Decimal("1e6"), "G": Decimal("1e9"), "T": Decimal("1e12"),
+    "P": Decimal("1e15"), "E": Decimal("1e18"),
+    "Ki": Decimal(2 ** 10), "Mi": Decimal(2 ** 20), "Gi": Decimal(2 ** 30), "Ti": Decimal(2 ** 40),
+    "Pi": Decimal(2 ** 50), "Ei": Decimal(2 ** 60),
+}
+QUANTITY = re.compile(r"^([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)(Ki|Mi|Gi|Ti|Pi|Ei|[numkMGTPE])?$")
+
+WAITING_JOBS = metrics.Gauge("dljob_admission_waiting_jobs", "Jobs waiting for enough free capacity to start")
+
+
+def parse_quantity(quantity):
+    """Parse a Kubernetes resource quantity (e.g. `500m`, `4Gi`, `1e3`).
+
+        Returns:
+            Decimal. The quantity in base units (cores, bytes, ...)
+    """
+    match = QUANTITY.match(str(quantity).strip())
+    if match is None:
+        raise ValueError(f"Invalid resource quantity {quantity!r}")
+    number, suffix = match.groups()
+    return Decimal(number) * QUANTITY_SUFFIXES[suffix or ""]
+
+
+def parse_resources(resources):
+    """Parse a resource name -> quantity dictionary (e.g. the `requests` of a container).
+    """
+    return {name: parse_quantity(value) for name, value in (resources or {}).items()}
+
+
+def add_resources(total, resources):
+    for name, value in resources.items():
+        total[name] = total.get(name, 0) + value
+
+
+def pod_requests(pod):
+    """The resources requested by a pod, including the pod itself.
+
+    As in the scheduler, the request of a pod is the larger of the sum of its
+    containers and of each of its init containers, which run one at a time.
+    """
+    requests = {"pods": Decimal(1)}
+    containers = dict()
+    for container in pod.spec.containers or []:
+        if container.resources is not None:
+            add_resources(containers, parse_resources(container.resources.requests))
+    for container in pod.spec.init_containers or []:
+        if container.resources is not None:
+            for name, value in parse_resources(container.resources.requests).items():
+                containers[name] = max(containers.get(name, 0), value)
+    add_resources(requests, containers)
+    return requests
+
+
+def pod_terminated(pod):
+    return pod.status is not None and pod.status.phase in ("Succeeded", "Failed")
+
+
+def fits(requests, free):
+    return all(free.get(name, 0) >= value for name, value in requests.items())
+
+
+def job_priority(obj):
+    """The admission priority of a job custom resource, from its `PRIORITY_ANNOTATION` annotation.
+    """
+    annotations = obj.get("metadata", {}).get("annotations") or {}
+    try:
+        return int(annotations.get(settings.PRIORITY_ANNOTATION, 0))
+    except ValueError:
+        logger.warning(f"Job {obj['metadata'].get('name')}: invalid priority "
+                       f"{annotations[settings.PRIORITY_ANNOTATION]!r}, using 0")
+        return 0
+
+
+class GangAdmission:
+    """
+    All-or-nothing admission of jobs against the free capacity of the cluster.
+
+    The free capacity of every schedulable node is its allocatable resources minus the
+    requests of the pods bound to it, read from a cached view of the nodes and of the
+    pods of all the namespaces. A job is admitted only if all its replicas can be placed
+    at once (first fit, largest replicas first), so that it never starts partially and
+    holds resources while waiting for the rest.
+
+    Jobs that do not fit wait in a priority queue, highest priority first and then in
+    submission order, and are admitted strictly in that order: a large job at the head
+    is not starved by smaller jobs behind it. `on_change(key)` is called with the job
+    at the head of the queue whenever it may have become admissible (capacity was freed,
+    or the job before it was admitted or left), so that it is synced again.
+
+    The replicas of admitted jobs that are not bound to a node yet are placed before the
+    job being admitted, so that two jobs are not admitted on the same free capacity.
+    """
+
+    def __init__(self, core_v1_client, on_change, informer_class=Informer):
+        """
+        :param core_v1_client: A `CoreV1Api`, used to list and watch nodes and pods
+        :param on_change: Called with the key of the job to sync when it may fit
+        :param informer_class: `Informer`, or the `AsyncInformer` of the asyncio engine
+        """
+        self.on_change = on_change
+        self.nodes = informer_class(core_v1_client.list_node, None)
+        self.pods = informer_class(core_v1_client.list_pod_for_all_namespaces, None,
+                                   field_selector="status.phase!=Succeeded,status.phase!=Failed")
+        self.nodes.add_handler(self.on_node_event)
+        self.pods.add_handler(self.on_pod_event)
+        self._lock = threading.RLock()
+        # heap of (-priority, sequence number, key) of the waiting jobs
+        self._heap = []
+        # key -> heap entry of the waiting jobs, and key -> job of the admitted ones
+        self._waiting = dict()
+        self._admitted = dict()
+        self._sequence = itertools.count()
+        WAITING_JOBS.set_function(lambda: len(self._waiting))
+
+    @property
+    def informers(self):
+        return self.nodes, self.pods
+
+    def start(self):
+        for informer in self.informers:
+            informer.start()
+
+    def stop(self):
+        for informer in self.informers:
+            informer.stop()
+
+    def wait_for_sync(self, timeout=None):
+        return all(informer.wait_for_sync(timeout) for informer in self.informers)
+
+    def admit(self, key, job, priority=0, spec=None):
+        """Admit the job `key` if all its replicas fit in the free capacity, or queue it.
+
+        A running job is admitted again when it is scaled up: the replicas added by its
+        new spec must fit, and wait in the same queue as the new jobs otherwise.
+
+            Args:
+                key: The key of the job in the work queue
+                job: The DLJob, not started yet, or running if `spec` is given
+                priority: Jobs with a higher priority are admitted first
+                spec: The new spec of a running job
+
+            Returns:
+                Bool. True if the job can start, or be scaled to `spec`
+        """
+        with self._lock:
+            if spec is None:
+                if self.started(job):
+                    # already started, e.g. by a previous operator
+                    self._admit(key, job)
+                    return True
+                requests = job.replica_requests().values()
+            else:
+                current = job.replica_requests()
+                requests = [r for name, r in job.replica_requests(spec).items() if name not in current]
+                if not requests:
+                    # scaled down, or back to its size before a scale up that was waiting
+                    if self._waiting.pop(key, None) is not None:
+                        self.notify_head()
+                    return True
+            entry = self._waiting.get(key)
+            if entry is None or entry[0] != -priority:
+                if entry is not None:
+                    logger.info(f"Priority of job {key} changed to {priority}")
+                entry = self._waiting[key] = (-priority, next(self._sequence), key)
+                heapq.heappush(self._heap, entry)
+            if self.head() != key:
+                logger.info(f"Job {key} waiting for admission behind {self.head()}")
+                return False
+            if not self.place(self.pending_requests(), requests):
+                logger.info(f"Job {key} does not fit in the free capacity of the cluster, waiting")
+                return False
+            heapq.heappop(self._heap)
+            del self._waiting[key]
+            self._admit(key, job)
+        logger.info(f"Job {key} admitted")
+        self.notify_head()
+        return True
+
+    @staticmethod
+    def started(job):
+        """Whether pods of the job are running, created by this job and not by a deleted job with the same name.
+        """
+        for pod in job.cache.get_pods(job.job_name):
+            owners = pod.metadata.owner_references or []
+            if any(o.controller and o.uid == job.uid for o in owners):
+                return True
+        return False
+
+    def _admit(self, key, job):
+        self._admitted[key] = job
+        if self._waiting.pop(key, None) is not None:
+            # its heap entry is skipped by `head`
+            self.notify_head()
+
+    def release(self, key):
+        """Forget a job that was deleted, freeing its place in the queue or its reservation.
+        """
+        with self._lock:
+            released = self._waiting.pop(key, None) is not None or self._admitted.pop(key, None) is not None
+        if released:
+            self.notify_head()
+
+    def waiting(self, key):
+        return key in self._waiting
+
+    def head(self):
+        """The key of the next job to admit, or None if no job is waiting.
+        """
+        with self._lock:
+            while self._heap and self._waiting.get(self._heap[0][2]) is not self._heap[0]:
+                # left the queue, or queued again with another priority
+                heapq.heappop(self._heap)
+            return self._heap[0][2] if self._heap else None
+
+    def notify_head(self):
+        key = self.head()
+        if key is not None:
+            self.on_change(key)
+
+    def on_node_event(self, operation, node):
+        if operation != "DELETED":
+            self.on_capacity_freed()
+
+    def on_pod_event(self, operation, pod):
+        # most pod events are the creation and the start of pods, which free nothing
+        if operation == "DELETED" or pod_terminated(pod):
+            self.on_capacity_freed()
+
+    def on_capacity_freed(self):
+        # only the head of the queue can become admissible
+        if self._waiting:
+            self.notify_head()
+
+    def pending_requests(self):
+        """The requests of the replicas of the admitted jobs that are not bound to a node yet.
+        """
+        requests = []
+        with self._lock:
+            for key, job in list(self._admitted.items()):
+                pending = [r for name, r in job.replica_requests().items()
+                           if not self.bound(job.cache.get_pod(name))]
+                if pending:
+                    requests.extend(pending)
+                else:
+                    # fully counted by the pods of the nodes from now on
+                    del self._admitted[key]
+        return requests
+
+    @staticmethod
+    def bound(pod):
+        return pod is not None and pod.spec is not None and pod.spec.node_name is not None
+
+    def free_capacity(self):
+        """The allocatable resources of every schedulable node minus the requests of its pods.
+
+            Returns:
+                Dict. Node name -> resource name -> free quantity
+        """
+        free = dict()
+        for node in self.nodes.list():
+            if node.spec is not None and node.spec.unschedulable:
+                continue
+            if node.status is None or not node.status.allocatable:
+                continue
+            free[node.metadata.name] = parse_resources(node.status.allocatable)
+        for pod in self.pods.list():
+            if pod.spec is None or pod_terminated(pod) or pod.spec.node_name not in free:
+                continue
+            node = free[pod.spec.node_name]
+            for name, value in pod_requests(pod).items():
+                node[name] = node.get(name, 0) - value
+        return free
+
+    def place(self, *request_lists):
+        """Whether all the given replica requests can be placed at once on the free capacity.
+
+        The requests of each list are placed largest first, each on the first node where it fits.
+        """
+        free = list(self.free_capacity().values())
+        for requests in request_lists:
+            for request in sorted(requests, key=lambda r: (r.get("cpu", 0), r.get("memory", 0)), reverse=True):
+                node = next((n for n in free if fits(request, n)), None)
+                if node is None:
+                    return False
+                for name, value in request.items():
+                    node[name] = node.get(name, 0) - value
+        return True
@@ -0,0 +1,832 @@
+import os
+import json
+import time
+import yaml
+import asyncio
+from collections import deque
+
+import dl_job
+import settings.settings as settings
+import metrics
+import tracing
+from admission import GangAdmission, job_priority
+from controller import resync_delay, spec_changed, job_key, serves_namespace, crd_path, orphan_jobs
+from informer import Informer, ClusterCache
+from replica import pod_failed
+from status import StatusWriter
+from kube_client import RequestLayer, RetryBudget, TokenBucket, already_created, is_retriable, retry_delay
+
+# the asyncio engine is optional and needs the kubernetes_asyncio client
+try:
+    import aiohttp
+    from kubernetes_asyncio import client, config, watch
+    from kubernetes_asyncio.client.rest import ApiException
+except ImportError:
+    aiohttp = client = config = watch = ApiException = None
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+async def gather_all(*aws):
+    """Like `asyncio.gather`, but wait for all the awaitables before raising the first failure,
+    as the thread pool of the threads engine does, so that none is left running unobserved.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class ConnectionStats:
+    """
+    Counters of the connections opened by the aiohttp session of an ApiClient, as
+    `PooledApiClient.connection_stats` for the urllib3 pool of the threads engine.
+    """
+
+    def __init__(self, api_client):
+        self.connections = 0
+        self.reused = 0
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_created)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reused)
+        trace_config.freeze()
+        # read by the session on every request
+        api_client.rest_client.pool_manager.trace_configs.append(trace_config)
+
+    async def on_connection_created(self, session, context, params):
+        self.connections += 1
+
+    async def on_connection_reused(self, session, context, params):
+        self.reused += 1
+
+    def __call__(self):
+        return {
+            "requests": self.connections + self.reused,
+            "connections": self.connections,
+            "reused": self.reused
+        }
+
+
+class AsyncRequestLayer(RequestLayer):
+    """
+    `RequestLayer` of the asyncio client: the rate limiter, the retry budgets and the
+    backoff are the same, but waits do not block the event loop.
+    """
+
+    def with_budget(self, budget):
+        return AsyncRequestLayer(self.api, self.limiter, budget, self.stats)
+
+    async def call(self, func, *args, **kwargs):
+        # see RequestLayer.call
+        with tracing.span(f"api.{func.__name__}", root=False) as span:
+            attempt = 0
+            throttled = 0.0
+            while True:
+                waited = self.limiter.reserve()
+                if waited > 0:
+                    throttled += waited
+                    self.stats.inc("throttled")
+                    self.stats.inc("throttled_seconds", waited)
+                    await asyncio.sleep(waited)
+                self.stats.inc("calls")
+                start = time.monotonic()
+                try:
+                    result = await func(*args, **kwargs)
+                    self.observe(func, kwargs, start, 200)
+                    span.set(code=200, retries=attempt, throttled=round(throttled, 6))
+                    return result
+                except ApiException as e:
+                    self.observe(func, kwargs, start, e.status)
+                    span.set(code=e.status, retries=attempt, throttled=round(throttled, 6))
+                    if already_created(func, attempt, e):
+                        logger.info(f"{func.__name__}: created by a previous attempt")
+                        return None
+                    if kwargs.get("watch") or not is_retriable(e) or attempt >= settings.API_MAX_RETRIES:
+                        self.stats.inc("failures")
+                        raise
+                    if self.budget is not None and not self.budget.spend():
+                        logger.warning(f"{func.__name__}: retry budget exhausted")
+                        self.stats.inc("budget_exhausted")
+                        self.stats.inc("failures")
+                        raise
+                    delay = retry_delay(attempt, e)
+                    logger.warning(f"{func.__name__} failed with {e.status}, retrying in {delay:.2f}s")
+                    self.stats.inc("retries")
+                    attempt += 1
+                    await asyncio.sleep(delay)
+
+
+class AsyncInformer(Informer):
+    """
+    `Informer` following the watch stream in a coroutine instead of a thread.
+    The in-memory store and the label indexes are the same.
+    """
+
+    def __init__(self, list_func, namespace, index_labels=(), **list_kwargs):
+        super(AsyncInformer, self).__init__(list_func, namespace, index_labels, **list_kwargs)
+        self._changed = asyncio.Condition()
+        self._async_synced = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def wait_for_sync(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._async_synced.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self):
+        while True:
+            try:
+                if not self._resource_version:
+                    await self.relist()
+                await self.watch()
+            except ApiException as e:
+                if e.status == 410:
+                    logger.info(f"{self.list_func.__name__}: resource version expired, relisting")
+                    self._resource_version = ''
+                else:
+                    logger.exception(f"{self.list_func.__name__}: watch failed")
+                    await asyncio.sleep(settings.INFORMER_RETRY_PERIOD)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"{self.list_func.__name__}: watch failed")
+                await asyncio.sleep(settings.INFORMER_RETRY_PERIOD)
+            finally:
+                metrics.WATCH_RECONNECTS.labels(self.resource).inc()
+
+    async def relist(self):
+        object_list = await self.list_func(*self.args, **self.list_kwargs)
+        with self._cond:
+            events = self._replace(object_list.items)
+            self._resource_version = object_list.metadata.resource_version
+        await self._notify()
+        if self._async_synced.is_set():
+            for operation, obj in events:
+                self.dispatch(operation, obj)
+        self._async_synced.set()
+        logger.debug(f"{self.list_func.__name__}: listed {len(object_list.items)} objects")
+
+    async def watch(self):
+        # the requests go through the client of `list_func`, the Watch has its own client
+        # to deserialize the events, closed with the response when the watch ends
+        async with watch.Watch() as w:
+            stream = w.stream(self.list_func, *self.args,
+                              resource_version=self._resource_version,
+                              allow_watch_bookmarks=True,
+                              timeout_seconds=settings.WATCH_TIMEOUT,
+                              **self.list_kwargs)
+            async for event in stream:
+                operation = event['type']
+                obj = event['object']
+                if operation == "ERROR":
+                    status = event.get('raw_object', {})
+                    raise ApiException(status=status.get('code'), reason=status.get('message'))
+                if operation == "BOOKMARK":
+                    # see Informer.watch
+                    self._resource_version = event['raw_object']['metadata']['resourceVersion']
+                    continue
+                with self._cond:
+                    self._remove(self.key(obj))
+                    if operation != "DELETED":
+                        self._add(obj)
+                self._resource_version = obj.metadata.resource_version
+                await self._notify()
+                self.dispatch(operation, obj)
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_for(self, predicate, timeout):
+        """Wait until `predicate()` is true or `timeout` seconds have passed.
+
+            Returns:
+                Bool. True if the predicate became true before the deadline
+        """
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait_for(predicate), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class AsyncClusterCache(ClusterCache):
+    """
+    `ClusterCache` backed by `AsyncInformer`s. Lookups are synchronous, waits are coroutines.
+    """
+
+    def __init__(self, core_v1_client, namespaces=settings.WATCH_NAMESPACES):
+        super(AsyncClusterCache, self).__init__(core_v1_client, namespaces, informer_class=AsyncInformer)
+
+    async def wait_for_sync(self, timeout=None):
+        return await self.pods.wait_for_sync(timeout) and await self.services.wait_for_sync(timeout)
+
+    async def wait_for_pods_deleted(self, pod_names, timeout=settings.DELETE_TIMEOUT):
+        return await self.pods.wait_for(lambda: not any(self.pods.get(name, self.namespace) for name in pod_names),
+                                        timeout)
+
+    async def wait_for_services_deleted(self, service_names, timeout=settings.DELETE_TIMEOUT):
+        return await self.services.wait_for(
+            lambda: not any(self.services.get(name, self.namespace) for name in service_names), timeout)
+
+    async def wait_for_pod_ip(self, pod_name, timeout=settings.POD_IP_TIMEOUT):
+        def pod_ip():
+            pod = self.get_pod(pod_name)
+            return pod.status.pod_ip if pod is not None and pod.status else None
+
+        if await self.pods.wait_for(pod_ip, timeout):
+            return pod_ip()
+        return None
+
+
+class AsyncWorkQueue:
+    """
+    Coroutine flavour of `controller.WorkQueue`, with the same deduplication rules.
+    Delayed keys are timers of the event loop, which keeps them in a single heap.
+    """
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._queue = deque()
+        self._dirty = set()
+        self._processing = set()
+        # timer handle of each delayed key
+        self._timers = dict()
+        self._failures = dict()
+
+    def add_after(self, key, delay):
+        """See `controller.WorkQueue.add_after`.
+        """
+        loop = asyncio.get_running_loop()
+        timer = self._timers.get(key)
+        if timer is not None:
+            if timer.when() <= loop.time() + delay:
+                return
+            timer.cancel()
+        self._timers[key] = loop.call_later(max(delay, 0), self._add_due, key)
+
+    def _add_due(self, key):
+        del self._timers[key]
+        asyncio.ensure_future(self.add(key))
+
+    def add_rate_limited(self, key):
+        failures = self._failures.get(key, 0)
+        self._failures[key] = failures + 1
+        self.add_after(key, min(settings.REQUEUE_BACKOFF_BASE * 2 ** failures, settings.REQUEUE_BACKOFF_MAX))
+
+    def forget(self, key):
+        self._failures.pop(key, None)
+
+    async def add(self, key):
+        async with self._cond:
+            if key in self._dirty:
+                return
+            self._dirty.add(key)
+            if key in self._processing:
+                return
+            self._queue.append(key)
+            self._cond.notify()
+
+    async def get(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: len(self._queue) > 0)
+            key = self._queue.popleft()
+            self._dirty.discard(key)
+            self._processing.add(key)
+            return key
+
+    async def done(self, key):
+        async with self._cond:
+            self._processing.discard(key)
+            if key in self._dirty:
+                self._queue.append(key)
+                self._cond.notify()
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class AsyncJob:
+    """
+    Drives a `DLJob` with coroutines.
+
+    The `DLJob` subclass still defines the replicas of the job, their environment
+    and the dependencies between replica types; this class only replaces the
+    blocking API calls with asynchronous ones.
+    """
+
+    def __init__(self, job, core_v1_client, cache):
+        self.job = job
+        self.api = core_v1_client
+        # bound to the namespace of the job
+        self.cache = cache.for_namespace(job.namespace)
+
+    @tracing.traced("job.start")
+    async def start(self):
+        self.job.started_at = time.monotonic()
+        await self.clean_up_pods()
+        await self.clean_up_services()
+        self.job.create_replicas()
+        await self.reconcile()
+
+    @tracing.traced("job.adopt")
+    async def adopt(self):
+        """See `DLJob.adopt`.
+        """
+        logger.info(f"Adopting job {self.job.job_name}")
+        self.job.create_replicas()
+        for r in self.job.replicas:
+            r.observe()
+        await self.reconcile()
+
+    @tracing.traced("job.update")
+    async def update(self, spec):
+        """See `DLJob.update`.
+        """
+        removed = self.job.scale(spec)
+        await gather_all(*(self.delete_replica(r) for r in removed))
+        await self.reconcile()
+
+    async def delete_replica(self, replica):
+        if self.cache.get_pod(replica.replica_name) is not None:
+            await self.api.delete_namespaced_pod(replica.replica_name, self.job.namespace)
+        service_name = f"{replica.replica_name}-service"
+        if self.cache.get_service(service_name) is not None:
+            await self.api.delete_namespaced_service(service_name, self.job.namespace)
+
+    @tracing.traced("job.reconcile")
+    async def reconcile(self):
+        logger.info(f"Reconcile Job {self.job.job_name}")
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(settings.REPLICA_CREATION_WORKERS)
+        for stage in self.job.replica_stages():
+            await self.publish_topology()
+            replicas = [r for r in self.job.replicas if r.replica_type.casefold() in stage]
+            with tracing.span("job.reconcile_stage", stage=",".join(sorted(stage)), replicas=len(replicas)):
+                # the next stages are not started if a replica failed
+                await gather_all(*(self.reconcile_replica(r, semaphore) for r in replicas))
+        metrics.RECONCILE_DURATION.labels(self.job.job_type).observe(time.monotonic() - start)
+        self.job.check_running()
+
+    @tracing.traced("job.publish_topology")
+    async def publish_topology(self):
+        """See `DLJob.publish_topology`.
+        """
+        config_map = self.job.topology_config_map()
+        if config_map is None or config_map["data"] == self.job.published_topology:
+            return
+        if self.job.published_topology is not None:
+            try:
+                await self.api.patch_namespaced_config_map(self.job.topology_name(), self.job.namespace,
+                                                           {"data": config_map["data"]})
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                logger.warning(f"Topology ConfigMap of job {self.job.job_name} deleted, creating it again")
+                await self.api.create_namespaced_config_map(self.job.namespace, config_map)
+        else:
+            try:
+                await self.api.create_namespaced_config_map(self.job.namespace, config_map)
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                await self.api.patch_namespaced_config_map(self.job.topology_name(), self.job.namespace,
+                                                           {"data": config_map["data"]})
+        self.job.published_topology = config_map["data"]
+
+    async def reconcile_replica(self, replica, semaphore):
+        async with semaphore:
+            with tracing.span("replica.reconcile", replica=replica.replica_name):
+                self.job.prepare_replica(replica)
+                pod = replica.observe()
+                if pod is not None and pod_failed(pod):
+                    logger.warning(f"Replica pod {replica.replica_name} failed ({pod.status.reason}), deleting it")
+                    await self.api.delete_namespaced_pod(replica.replica_name, self.job.namespace)
+                    return
+                if pod is not None or self.job.creation_pending(replica.replica_name):
+                    logger.info(f"Replica pod {replica.replica_name} already exist.")
+                    if replica.replica_type == "SCHEDULER" and not replica.scheduler_ip:
+                        # see Replica.reconcile
+                        await self.wait_for_scheduler_ip(replica)
+                    return
+
+                try:
+                    await self.api.create_namespaced_pod(namespace=self.job.namespace, body=replica.build_pod())
+                except ApiException as e:
+                    # see Replica.create_pod
+                    if e.status != 409:
+                        raise
+                    logger.info(f"Pod of replica {replica.replica_name} already exists")
+                else:
+                    logger.info(f"Created Pod for replica {replica.replica_name}")
+                self.job.expect_pod(replica.replica_name)
+                if replica.ports is not None and self.cache.get_service(f"{replica.replica_name}-service") is None:
+                    try:
+                        await self.api.create_namespaced_service(
+                            namespace=self.job.namespace,
+                            body=replica.build_service(replica.ports))
+                    except ApiException as e:
+                        if e.status != 409:
+                            raise
+
+                if replica.replica_type == "SCHEDULER":
+                    await self.wait_for_scheduler_ip(replica)
+
+    async def wait_for_scheduler_ip(self, replica):
+        """See `Replica.wait_for_scheduler_ip`.
+        """
+        with tracing.span("replica.wait_for_pod_ip"):
+            replica.scheduler_ip = await self.cache.wait_for_pod_ip(replica.replica_name) or ""
+        if not replica.scheduler_ip:
+            logger.error(f"Scheduler pod {replica.replica_name} has no IP after {settings.POD_IP_TIMEOUT} seconds")
+            raise TimeoutError(f"Scheduler pod {replica.replica_name} was not assigned an IP")
+
+    async def clean_up(self, wait=True):
+        start = time.monotonic()
+        pods = await self.clean_up_pods(wait=wait)
+        services = await self.clean_up_services(wait=wait)
+        if self.job.topology_configmap:
+            await self.api.delete_collection_namespaced_config_map(
+                self.job.namespace,
+                label_selector=f"job_name={self.job.job_name}")
+            self.job.published_topology = None
+        logger.info(f"Job {self.job.job_name} torn down: deleted {pods} pods and {services} services "
+                    f"in {time.monotonic() - start:.2f}s")
+        return pods, services
+
+    @tracing.traced("job.clean_up_pods")
+    async def clean_up_pods(self, wait=True):
+        job_name = self.job.job_name
+        self.job.expected_pods.clear()
+        pod_names = [pod.metadata.name for pod in self.cache.get_pods(job_name)]
+        if len(pod_names) == 0:
+            return 0
+        logger.info(f"Deleting {len(pod_names)} pods matching {job_name} job name")
+        await self.api.delete_collection_namespaced_pod(self.job.namespace, label_selector=f"job_name={job_name}")
+        with tracing.span("job.wait_for_pods_deleted", pods=len(pod_names)):
+            deleted = not wait or await self.cache.wait_for_pods_deleted(pod_names)
+        if not deleted:
+            raise TimeoutError(f"Pods of job {job_name} not deleted after {settings.DELETE_TIMEOUT} seconds")
+        return len(pod_names)
+
+    @tracing.traced("job.clean_up_services")
+    async def clean_up_services(self, wait=True):
+        job_name = self.job.job_name
+        service_names = [service.metadata.name for service in self.cache.get_services(job_name)]
+        if len(service_names) == 0:
+            return 0
+        logger.info(f"Deleting {len(service_names)} services matching {job_name} job name")
+        try:
+            await self.api.delete_collection_namespaced_service(self.job.namespace,
+                                                                label_selector=f"job_name={job_name}")
+        except ApiException as e:
+            if e.status not in (404, 405):
+                raise
+            await gather_all(*(
+                self.api.delete_namespaced_service(name, self.job.namespace, body=client.V1DeleteOptions())
+                for name in service_names))
+        with tracing.span("job.wait_for_services_deleted", services=len(service_names)):
+            deleted = not wait or await self.cache.wait_for_services_deleted(service_names)
+        if not deleted:
+            raise TimeoutError(f"Services of job {job_name} not deleted after {settings.DELETE_TIMEOUT} seconds")
+        return len(service_names)
+
+
+class AsyncDLOperator:
+    """
+    asyncio execution mode of the `DLOperator`.
+
+    The job watches, the pod and service informers and the reconcile of every job run
+    as coroutines on a single event loop, so that one process can drive many jobs
+    without one thread per job.
+    """
+
+    def __init__(self, workers=settings.WORKERS):
+        if client is None:
+            raise Exception("The asyncio engine requires the kubernetes_asyncio package")
+        self.workers = workers
+        self.job_kinds = dl_job.job_kinds()
+        # jobs and last observed custom resource of every job, by job key (namespace/name)
+        self.jobs = {}
+        self.job_objects = {}
+        # jobs found running at startup, to be adopted instead of restarted
+        self.adopting = set()
+
+    async def setup(self):
+        if 'KUBERNETES_PORT' in os.environ:
+            config.load_incluster_config()
+        else:
+            await config.load_kube_config()
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = settings.CONNECTION_POOL_MAXSIZE
+        # single client, and connection pool, shared by every job and replica
+        self.api_client = client.ApiClient(configuration)
+        self.connection_stats = ConnectionStats(self.api_client)
+        limiter = TokenBucket(settings.API_QPS, settings.API_BURST)
+        self.v1_client = AsyncRequestLayer(client.ApiextensionsV1Api(self.api_client), limiter)
+        self.crd_client = AsyncRequestLayer(client.CustomObjectsApi(self.api_client), limiter)
+        self.core_v1_client = AsyncRequestLayer(client.CoreV1Api(self.api_client), limiter)
+
+        self.cache = AsyncClusterCache(self.core_v1_client)
+        self.cache.start()
+        if not await self.cache.wait_for_sync(settings.CACHE_SYNC_TIMEOUT):
+            logger.warning("Pod and service caches not synced, continuing anyway")
+        self.queue = AsyncWorkQueue()
+
+        self.admission = None
+        if settings.GANG_ADMISSION:
+            self.admission = GangAdmission(self.core_v1_client, informer_class=AsyncInformer,
+                                           on_change=lambda key: asyncio.ensure_future(self.queue.add(key)))
+            self.admission.start()
+            synced = await asyncio.gather(*(i.wait_for_sync(settings.CACHE_SYNC_TIMEOUT)
+                                            for i in self.admission.informers))
+            if not all(synced):
+                logger.warning("Node and pod capacity caches not synced, continuing anyway")
+
+        # the patches are sent by `write_status`
+        self.status = StatusWriter(self.job_status, patch_func=None)
+
+        metrics.JOBS.set_function(lambda: len(self.jobs))
+        metrics.REPLICAS.set_function(lambda: sum(len(j.job.replicas) for j in list(self.jobs.values())))
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.queue))
+        metrics.export_connection_stats(self.connection_stats)
+        self.cache.pods.add_handler(self.on_pod_event)
+
+    async def run(self):
+        """Set up the clients and follow the job streams until cancelled.
+        """
+        await self.setup()
+        workers = [asyncio.ensure_future(self.process_queue()) for _ in range(self.workers)]
+        if settings.STATUS_UPDATE_PERIOD:
+            workers.append(asyncio.ensure_future(self.write_status()))
+        try:
+            if not settings.WARM_START:
+                await self.clean_up()
+            for job_class in self.job_kinds.values():
+                await self.create_crd(crd_path(job_class))
+            await self.watch_crds()
+        finally:
+            for w in workers:
+                w.cancel()
+            if not settings.WARM_START:
+                await self.clean_up()
+            self.cache.stop()
+            if self.admission is not None:
+                self.admission.stop()
+            await self.api_client.close()
+
+    async def clean_up(self):
+        """See `DLOperator.clean_up`.
+        """
+        logger.info("Deleting existing custom resources...")
+        crd_list = await self.v1_client.list_custom_resource_definition()
+        for crd in crd_list.items:
+            if crd.spec.group == settings.DOMAIN:
+                logger.info(f"Deleting {crd.metadata.name}")
+                await self.v1_client.delete_custom_resource_definition(name=crd.metadata.name,
+                                                                       body=client.V1DeleteOptions())
+        for name, job in list(self.jobs.items()):
+            try:
+                await job.clean_up(wait=False)
+            except Exception:
+                logger.exception(f"Failed to clean up job {name}")
+        # wait a moment for the resource to be deleted
+        await asyncio.sleep(2)
+
+    async def create_crd(self, crd_path):
+        logger.info(f"Creating {crd_path} CRD")
+        with open(crd_path) as crd:
+            body = yaml.safe_load(crd)
+            try:
+                await self.v1_client.create_custom_resource_definition(body)
+            except ApiException as e:
+                if json.loads(e.body)['reason'] == "AlreadyExists":
+                    logger.info(f"Resource {body['metadata']['name']} already exists")
+                    return
+                raise e
+
+    async def write_status(self):
+        """See `status.StatusWriter`, whose patches are sent from this coroutine.
+        """
+        while True:
+            await asyncio.sleep(settings.STATUS_UPDATE_PERIOD)
+            for key, obj, status, patch in self.status.changes():
+                metadata = obj["metadata"]
+                try:
+                    await self.crd_client.patch_namespaced_custom_object_status(
+                        settings.DOMAIN, "v1", metadata["namespace"], self.job_kinds[obj["kind"]].plural,
+                        metadata["name"], {"status": patch})
+                    self.status.written(key, status)
+                except ApiException as e:
+                    if e.status == 404:
+                        continue
+                    logger.exception(f"Failed to write the status of job {key}")
+                    self.status.touch(key)
+
+    def job_status(self, key):
+        """See `DLOperator.job_status`.
+        """
+        obj = self.job_objects.get(key)
+        if obj is None:
+            return None
+        if key in self.jobs:
+            return obj, self.jobs[key].job.status()
+        if self.admission is not None and self.admission.waiting(key):
+            return obj, {"phase": "Queued"}
+        return None
+
+    async def process_queue(self):
+        while True:
+            key = await self.queue.get()
+            try:
+                with tracing.span("operator.sync_job", job=key):
+                    await self.sync_job(key)
+                self.status.touch(key)
+                self.queue.forget(key)
+                if key in self.jobs and settings.RESYNC_PERIOD:
+                    self.queue.add_after(key, resync_delay())
+            except Exception:
+                logger.exception(f"Failed to sync job {key}")
+                self.queue.add_rate_limited(key)
+            finally:
+                await self.queue.done(key)
+
+    async def sync_job(self, key):
+        obj = self.job_objects.get(key)
+        if obj is None:
+            await self.delete_job(key)
+            return
+        uid = obj["metadata"].get("uid")
+        if key in self.jobs and uid is not None and self.jobs[key].job.uid != uid:
+            await self.delete_job(key)
+        if key in self.jobs:
+            if self.jobs[key].job.spec != obj["spec"]:
+                if self.admission is not None and \
+                        not self.admission.admit(key, self.jobs[key].job, job_priority(obj), spec=obj["spec"]):
+                    return
+                await self.jobs[key].update(obj["spec"])
+            elif self.jobs[key].job.needs_reconcile():
+                await self.jobs[key].reconcile()
+            return
+        logger.debug(f"{key} not found in jobs. Create new one.")
+        job_class = self.job_kinds[obj.get("kind")]
+        namespace, _, name = key.partition("/")
+        # the blocking client of the job is never used, API calls are made by the AsyncJob
+        job = AsyncJob(job_class(name, obj["spec"], self.cache, None, uid, namespace),
+                       self.core_v1_client.with_budget(RetryBudget()), self.cache)
+        if self.admission is not None and not self.admission.admit(key, job.job, job_priority(obj)):
+            return
+        self.jobs[key] = job
+        if key in self.adopting:
+            self.adopting.discard(key)
+            await job.adopt()
+        else:
+            await job.start()
+
+    def on_pod_event(self, operation, pod):
+        """See `DLOperator.on_pod_event`.
+        """
+        key = job_key(pod.metadata.namespace, (pod.metadata.labels or {}).get("job_name"))
+        job = self.jobs.get(key)
+        if job is None:
+            return
+        job.job.pod_observed(pod.metadata.name)
+        self.status.touch(key)
+        if operation == "DELETED" or pod_failed(pod):
+            asyncio.ensure_future(self.queue.add(key))
+        else:
+            job.job.check_running()
+
+    async def delete_job(self, key):
+        """See `DLOperator.delete_job`.
+        """
+        if self.admission is not None:
+            self.admission.release(key)
+        self.status.forget(key)
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return
+        if job.job.uid is None:
+            await job.clean_up(wait=False)
+        logger.info(f"Job {key} deleted")
+
+    async def watch_crds(self):
+        """List the jobs of every kind, then follow the stream of each kind, see `DLOperator.watch_crds`.
+        """
+        logger.info("Waiting for DLJobs to come up...")
+        versions = dict()
+        keys = set()
+        for kind, job_class in self.job_kinds.items():
+            versions[kind], listed = await self.relist_crd(job_class, adopt=settings.WARM_START)
+            keys |= listed
+        if settings.WARM_START:
+            await self.clean_up_orphans(keys)
+        await asyncio.gather(*(self.watch_crd(job_class, versions[kind])
+                               for kind, job_class in self.job_kinds.items()))
+
+    async def watch_crd(self, job_class, resource_version):
+        """Follow the stream of the custom resources of one job kind, see `DLOperator.watch_crd`.
+        """
+        while True:
+            try:
+                async with watch.Watch() as w:
+                    stream = w.stream(self.crd_client.list_cluster_custom_object,
+                                      settings.DOMAIN, "v1", job_class.plural,
+                                      resource_version=resource_version,
+                                      allow_watch_bookmarks=True,
+                                      timeout_seconds=settings.WATCH_TIMEOUT)
+                    async for event in stream:
+                        obj = event["object"]
+                        operation = event['type']
+                        if operation == "ERROR":
+                            raise ApiException(status=obj.get("code"), reason=obj.get("message"))
+                        resource_version = obj.get("metadata", {}).get("resourceVersion", resource_version)
+                        if operation == "BOOKMARK":
+                            continue
+                        metadata = obj.get("metadata", {})
+                        with tracing.span("operator.watch_event",
+                                          job=job_key(metadata.get("namespace"), metadata.get("name")),
+                                          operation=operation, kind=job_class.job_type):
+                            await self.handle_event(operation, obj)
+            except ApiException as e:
+                if e.status != 410:
+                    logger.exception(f"{job_class.job_type} watch failed, reconnecting...")
+                    await asyncio.sleep(settings.INFORMER_RETRY_PERIOD)
+                    continue
+                logger.info(f"{job_class.job_type} resource version expired, relisting...")
+                resource_version = (await self.relist_crd(job_class))[0]
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"{job_class.job_type} watch failed, reconnecting...")
+                await asyncio.sleep(settings.INFORMER_RETRY_PERIOD)
+            finally:
+                metrics.WATCH_RECONNECTS.labels(job_class.plural).inc()
+
+    async def relist_crd(self, job_class, adopt=False):
+        job_list = await self.crd_client.list_cluster_custom_object(settings.DOMAIN, "v1", job_class.plural)
+        logger.info(f"Listed {len(job_list['items'])} existing {job_class.plural}")
+        keys = {job_key(obj["metadata"]["namespace"], obj["metadata"]["name"]) for obj in job_list["items"]}
+        known = {key for key, obj in list(self.job_objects.items()) if obj.get("kind") == job_class.job_type}
+        for key in known - keys:
+            self.job_objects.pop(key, None)
+            await self.queue.add(key)
+        for obj in job_list["items"]:
+            await self.handle_event("ADDED", obj, adopt=adopt)
+        return job_list["metadata"]["resourceVersion"], keys
+
+    async def clean_up_orphans(self, job_keys):
+        """See `DLOperator.clean_up_orphans`.
+        """
+        for namespace, job_name in orphan_jobs(self.cache, job_keys):
+            logger.info(f"Deleting resources of job {namespace}/{job_name}, which no longer exists")
+            selector = f"job_name={job_name}"
+            await self.core_v1_client.delete_collection_namespaced_pod(namespace, label_selector=selector)
+            try:
+                await self.core_v1_client.delete_collection_namespaced_service(namespace, label_selector=selector)
+            except ApiException as e:
+                if e.status not in (404, 405):
+                    raise
+                await gather_all(*(
+                    self.core_v1_client.delete_namespaced_service(service.metadata.name, namespace,
+                                                                  body=client.V1DeleteOptions())
+                    for service in self.cache.for_namespace(namespace).get_services(job_name)))
+
+    async def handle_event(self, operation, obj, adopt=False):
+        """See `DLOperator.handle_event`.
+        """
+        spec = obj.get("spec")
+        if not spec:
+            return
+        metadata = obj["metadata"]
+        if not serves_namespace(metadata["namespace"]):
+            return
+        key = job_key(metadata["namespace"], metadata["name"])
+        logger.info("Handling %s on %s %s" % (operation, obj.get("kind"), key))
+
+        previous = self.job_objects.get(key)
+        if previous is not None and previous.get("kind") != obj.get("kind"):
+            logger.warning(f"Ignoring {obj.get('kind')} {key}, a {previous.get('kind')} with the same name exists")
+            return
+        if operation in ("ADDED", "MODIFIED"):
+            self.job_objects[key] = obj
+            if adopt:
+                self.adopting.add(key)
+            elif operation == "MODIFIED" and not spec_changed(previous, obj):
+                return
+            await self.queue.add(key)
+        elif operation == "DELETED":
+            self.job_objects.pop(key, None)
+            await self.queue.add(key)
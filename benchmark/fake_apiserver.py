@@ -0,0 +1,525 @@
+"""
+In-memory fake of the parts of the Kubernetes API used by the operator.
+
+The server keeps every object in memory and serves LIST, WATCH, GET, POST, PUT, PATCH,
+DELETE and DELETE collection on pods, services, ConfigMaps, nodes, Leases, custom resource
+definitions and custom objects. Pods are "scheduled" by a fake kubelet, which assigns
+them an IP and marks them Running after `pod_start_delay` seconds, binding them to the
+fake nodes in turn if there are any. Objects are garbage
+collected through their ownerReferences, and deleting a custom resource definition
+deletes its objects, as on a real cluster.
+Watches requested with `allowWatchBookmarks` receive a BOOKMARK event every
+`BOOKMARK_PERIOD` seconds without events.
+
+Run it on its own to point one or more operator processes at it:
+
+    python -m benchmark.fake_apiserver --port 8001 --kubeconfig /tmp/fake.kubeconfig
+    KUBECONFIG=/tmp/fake.kubeconfig python main.py
+"""
+import re
+import sys
+import copy
+import json
+import time
+import uuid
+import heapq
+import argparse
+import threading
+from collections import defaultdict, deque, Counter
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+# resource -> (apiVersion, kind) of its objects
+KINDS = {
+    "pods": ("v1", "Pod"),
+    "services": ("v1", "Service"),
+    "configmaps": ("v1", "ConfigMap"),
+    "nodes": ("v1", "Node"),
+    "leases": ("coordination.k8s.io/v1", "Lease"),
+    "customresourcedefinitions": ("apiextensions.k8s.io/v1", "CustomResourceDefinition"),
+}
+
+# seconds between two BOOKMARK events of a watch without events
+BOOKMARK_PERIOD = 1
+
+ROUTES = [
+    # resource, namespace, name and subresource are the named groups of every route
+    re.compile(r"^/api/v1/(?:namespaces/(?P<namespace>[^/]+)/)?(?P<resource>pods|services|configmaps|nodes)"
+               r"(?:/(?P<name>[^/]+))?(?:/(?P<subresource>status))?$"),
+    re.compile(r"^/apis/coordination\.k8s\.io/v1/(?:namespaces/(?P<namespace>[^/]+)/)?(?P<resource>leases)"
+               r"(?:/(?P<name>[^/]+))?$"),
+    re.compile(r"^/apis/apiextensions\.k8s\.io/v1(?:beta1)?/(?P<resource>customresourcedefinitions)"
+               r"(?:/(?P<name>[^/]+))?$"),
+    re.compile(r"^/apis/(?P<group>[^/]+)/(?P<version>[^/]+)/(?:namespaces/(?P<namespace>[^/]+)/)?"
+               r"(?P<resource>[^/]+)(?:/(?P<name>[^/]+))?(?:/(?P<subresource>status))?$"),
+]
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message=""):
+        super(ApiError, self).__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def status(self):
+        return {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure",
+                "message": self.message, "reason": self.reason, "code": self.code}
+
+
+def now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_selector(selector):
+    """Parse an equality based label selector (`a=b,c=d`) in a dictionary.
+
+    A term without a value (`a`) selects the objects having the label, and is parsed as `a: None`.
+    """
+    if not selector:
+        return {}
+    terms = [term.split("=", 1) for term in selector.replace("==", "=").split(",")]
+    return {term[0]: term[1] if len(term) > 1 else None for term in terms}
+
+
+def matches(obj, selector):
+    labels = obj["metadata"].get("labels") or {}
+    return all(k in labels if v is None else labels.get(k) == v for k, v in selector.items())
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386) to `target` in place."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def json_patch(target, operations):
+    """Apply the add, replace and remove operations of a JSON patch (RFC 6902) to `target` in place."""
+    for op in operations:
+        *parents, last = [p.replace("~1", "/").replace("~0", "~") for p in op["path"].lstrip("/").split("/")]
+        node = target
+        for p in parents:
+            node = node[int(p)] if isinstance(node, list) else node.setdefault(p, {})
+        if isinstance(node, list):
+            index = len(node) if last == "-" else int(last)
+            if op["op"] == "remove":
+                node.pop(index)
+            elif op["op"] == "add":
+                node.insert(index, op["value"])
+            else:
+                node[index] = op["value"]
+        elif op["op"] == "remove":
+            node.pop(last, None)
+        else:
+            node[last] = op["value"]
+
+
+class Store:
+    """
+    Objects of the fake cluster, with one event log per resource to serve watches.
+    """
+
+    def __init__(self, history=100000, pod_start_delay=0.0, nodes=0, node_allocatable=None):
+        """
+        :param history: Events kept per resource; older resourceVersions get 410 Gone
+        :param pod_start_delay: Seconds before a new pod is assigned an IP and Running
+        :param nodes: Number of fake nodes the pods are bound to
+        :param node_allocatable: Allocatable resources of every fake node
+        """
+        self.history = history
+        self.pod_start_delay = pod_start_delay
+        self.cond = threading.Condition()
+        # as on a real server, never "0", which watches read as "start from the current state"
+        self.resource_version = 1
+        # resource -> (namespace, name) -> object
+        self.objects = defaultdict(dict)
+        # resource -> deque of (resourceVersion, event type, object)
+        self.events = defaultdict(deque)
+        # API calls served, by (verb, resource)
+        self.calls = Counter()
+        # open watch requests, by resource
+        self.watchers = Counter()
+        self._pending_pods = []
+        allocatable = node_allocatable or {"cpu": "16", "memory": "64Gi", "pods": "110"}
+        self.node_names = [f"node-{i}" for i in range(nodes)]
+        for name in self.node_names:
+            self.create("nodes", None, {"metadata": {"name": name}, "status": {"allocatable": dict(allocatable)}})
+        self._stopped = threading.Event()
+        self._kubelet = threading.Thread(target=self.run_kubelet, name="fake-kubelet", daemon=True)
+        self._kubelet.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _record(self, resource, event_type, obj):
+        # must be called with the lock held
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        log = self.events[resource]
+        log.append((self.resource_version, event_type, copy.deepcopy(obj)))
+        if len(log) > self.history:
+            log.popleft()
+        self.cond.notify_all()
+
+    def create(self, resource, namespace, obj):
+        with self.cond:
+            metadata = obj.setdefault("metadata", {})
+            key = (namespace, metadata.get("name"))
+            if key[1] is None:
+                raise ApiError(422, "Invalid", "metadata.name is required")
+            if key in self.objects[resource]:
+                raise ApiError(409, "AlreadyExists", f'{resource} "{key[1]}" already exists')
+            if namespace is not None:
+                metadata["namespace"] = namespace
+            metadata["uid"] = str(uuid.uuid4())
+            metadata["creationTimestamp"] = now()
+            if resource == "pods":
+                obj["status"] = {"phase": "Pending"}
+                heapq.heappush(self._pending_pods, (time.monotonic() + self.pod_start_delay, namespace, key[1]))
+            self.objects[resource][key] = obj
+            self._record(resource, "ADDED", obj)
+            return copy.deepcopy(obj)
+
+    def get(self, resource, namespace, name):
+        with self.cond:
+            obj = self.objects[resource].get((namespace, name))
+            if obj is None:
+                raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+            return copy.deepcopy(obj)
+
+    def list(self, resource, namespace, selector):
+        with self.cond:
+            items = [copy.deepcopy(o) for (ns, _), o in self.objects[resource].items()
+                     if (namespace is None or ns == namespace) and matches(o, selector)]
+            return items, str(self.resource_version)
+
+    def replace(self, resource, namespace, name, obj, subresource=None):
+        with self.cond:
+            current = self.objects[resource].get((namespace, name))
+            if current is None:
+                raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+            version = obj.get("metadata", {}).get("resourceVersion")
+            if version and version != current["metadata"]["resourceVersion"]:
+                raise ApiError(409, "Conflict", f'Operation cannot be fulfilled on {resource} "{name}": '
+                                                f'the object has been modified')
+            if subresource == "status":
+                current["status"] = obj.get("status")
+            else:
+                obj["metadata"] = dict(obj.get("metadata") or {}, uid=current["metadata"]["uid"],
+                                       creationTimestamp=current["metadata"]["creationTimestamp"])
+                if "status" in current and "status" not in obj:
+                    obj["status"] = current["status"]
+                current = self.objects[resource][(namespace, name)] = obj
+            self._record(resource, "MODIFIED", current)
+            return copy.deepcopy(current)
+
+    def patch(self, resource, namespace, name, patch, subresource=None):
+        with self.cond:
+            current = self.objects[resource].get((namespace, name))
+            if current is None:
+                raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+            if subresource == "status":
+                patch = {"status": patch.get("status")} if isinstance(patch, dict) else \
+                    [op for op in patch if op["path"].startswith("/status")]
+            if isinstance(patch, list):
+                json_patch(current, patch)
+            else:
+                merge_patch(current, patch)
+            self._record(resource, "MODIFIED", current)
+            return copy.deepcopy(current)
+
+    def delete(self, resource, namespace, name):
+        with self.cond:
+            obj = self.objects[resource].pop((namespace, name), None)
+            if obj is None:
+                raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+            self._deleted(resource, obj)
+            return copy.deepcopy(obj)
+
+    def delete_collection(self, resource, namespace, selector):
+        with self.cond:
+            keys = [(ns, n) for (ns, n), o in self.objects[resource].items()
+                    if (namespace is None or ns == namespace) and matches(o, selector)]
+            for key in keys:
+                self._deleted(resource, self.objects[resource].pop(key))
+            return len(keys)
+
+    def _deleted(self, resource, obj):
+        self._record(resource, "DELETED", obj)
+        if resource == "customresourcedefinitions":
+            # the objects of a custom resource go away with its definition
+            spec = obj["spec"]
+            custom = f"{spec['group']}/{spec['names']['plural']}"
+            for key in list(self.objects[custom]):
+                self._deleted(custom, self.objects[custom].pop(key))
+        # garbage collect the dependents, in the background as the API server does by default
+        uid = obj["metadata"]["uid"]
+        for dependent_resource, objects in list(self.objects.items()):
+            for key, dependent in list(objects.items()):
+                owners = dependent["metadata"].get("ownerReferences") or []
+                if any(ref.get("uid") == uid for ref in owners):
+                    self._deleted(dependent_resource, objects.pop(key))
+
+    def events_since(self, resource, version):
+        """The events of `resource` after `version`, or ApiError 410 if they are no longer kept."""
+        log = self.events[resource]
+        if log and version < log[0][0] - 1 and len(log) >= self.history:
+            raise ApiError(410, "Expired", f"too old resource version: {version} ({log[0][0]})")
+        return [e for e in log if e[0] > version]
+
+    def run_kubelet(self):
+        """Start the pods whose start delay has passed: assign an IP and mark them Running."""
+        ip = 0
+        while not self._stopped.is_set():
+            with self.cond:
+                while self._pending_pods and self._pending_pods[0][0] <= time.monotonic():
+                    _, namespace, name = heapq.heappop(self._pending_pods)
+                    pod = self.objects["pods"].get((namespace, name))
+                    if pod is None:
+                        continue
+                    ip += 1
+                    if self.node_names:
+                        pod["spec"]["nodeName"] = self.node_names[ip % len(self.node_names)]
+                    pod["status"] = {"phase": "Running", "podIP": f"10.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}",
+                                     "hostIP": "192.168.0.1", "startTime": now()}
+                    self._record("pods", "MODIFIED", pod)
+                delay = self._pending_pods[0][0] - time.monotonic() if self._pending_pods else 0.05
+            self._stopped.wait(min(max(delay, 0.001), 0.05))
+
+    def count_pods(self, phase=None, selector=None):
+        with self.cond:
+            return sum(1 for p in self.objects["pods"].values()
+                       if (phase is None or p["status"].get("phase") == phase) and matches(p, selector or {}))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set by FakeApiServer
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        for pattern in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                params = match.groupdict()
+                resource = params["resource"]
+                if params.get("group"):
+                    # custom objects are stored by group and plural
+                    resource = f"{params['group']}/{resource}"
+                return resource, params, query
+        raise ApiError(404, "NotFound", f"the server could not find the requested resource {url.path}")
+
+    def read_body(self):
+        """Consume the body of the request, used or not (e.g. the DeleteOptions of a DELETE):
+        on a keep-alive connection, it would otherwise be read as the start of the next request."""
+        length = int(self.headers.get("Content-Length") or 0)
+        self.data = self.rfile.read(length) if length else b""
+
+    def body(self):
+        try:
+            return json.loads(self.data) if self.data else {}
+        except ValueError:
+            # e.g. the client was killed while sending the body
+            raise ApiError(400, "BadRequest", "invalid JSON body")
+
+    def send_json(self, code, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        try:
+            self.read_body()
+            resource, params, query = self.route()
+            namespace, name, subresource = params.get("namespace"), params.get("name"), params.get("subresource")
+            selector = parse_selector(query.get("labelSelector"))
+            verb = {"POST": "create", "PUT": "update", "PATCH": "patch"}.get(method)
+            if method == "GET":
+                verb = "get" if name else ("watch" if query.get("watch", "").lower() in ("true", "1") else "list")
+            elif method == "DELETE":
+                verb = "delete" if name else "deletecollection"
+            with self.store.cond:
+                self.store.calls[(verb, resource)] += 1
+
+            if verb == "watch":
+                return self.watch(resource, namespace, selector, query, self.kind(resource, params))
+            if verb == "list":
+                items, version = self.store.list(resource, namespace, selector)
+                api_version, kind = self.kind(resource, params)
+                return self.send_json(200, {"apiVersion": api_version, "kind": f"{kind}List",
+                                            "metadata": {"resourceVersion": version}, "items": items})
+            if verb == "get":
+                return self.send_json(200, self.store.get(resource, namespace, name))
+            if verb == "create":
+                obj = self.body()
+                if "apiVersion" not in obj:
+                    obj["apiVersion"], obj["kind"] = self.kind(resource, params)
+                return self.send_json(201, self.store.create(resource, namespace, obj))
+            if verb == "update":
+                return self.send_json(200, self.store.replace(resource, namespace, name, self.body(), subresource))
+            if verb == "patch":
+                return self.send_json(200, self.store.patch(resource, namespace, name, self.body(), subresource))
+            if verb == "delete":
+                return self.send_json(200, self.store.delete(resource, namespace, name))
+            self.store.delete_collection(resource, namespace, selector)
+            return self.send_json(200, {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Success"})
+        except ApiError as e:
+            self.send_json(e.code, e.status())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def kind(self, resource, params):
+        if resource in KINDS:
+            return KINDS[resource]
+        # e.g. mxjobs -> MXJob is not derivable, custom lists are read as plain dicts anyway
+        return f"{params['group']}/{params['version']}", params["resource"]
+
+    def watch(self, resource, namespace, selector, query, kind):
+        timeout = float(query.get("timeoutSeconds") or 1800)
+        version = query.get("resourceVersion") or ""
+        bookmarks = query.get("allowWatchBookmarks", "").lower() == "true"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(event_type, obj):
+            line = json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+
+        store = self.store
+        deadline = time.monotonic() + timeout
+        next_bookmark = time.monotonic() + BOOKMARK_PERIOD
+        with store.cond:
+            store.watchers[resource] += 1
+            initial = []
+            if version in ("", "0"):
+                # no resourceVersion: start with the current state
+                initial = [("ADDED", copy.deepcopy(obj)) for obj in store.objects[resource].values()]
+                version = store.resource_version
+        version = int(version)
+        try:
+            events = [(version, event_type, obj) for event_type, obj in initial]
+            while True:
+                # write to the socket without holding the lock of the store
+                for event_version, event_type, obj in events:
+                    version = event_version
+                    if event_type == "BOOKMARK" or \
+                            (namespace is None or obj["metadata"].get("namespace") == namespace) and \
+                            matches(obj, selector):
+                        send(event_type, obj)
+                self.wfile.flush()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or store._stopped.is_set():
+                    break
+                with store.cond:
+                    try:
+                        events = store.events_since(resource, version)
+                        if not events:
+                            store.cond.wait(min(remaining, 1))
+                            events = store.events_since(resource, version)
+                    except ApiError as e:
+                        send("ERROR", e.status())
+                        break
+                    if not events and bookmarks and time.monotonic() >= next_bookmark:
+                        # tell the client how far the watch got, as the API server does
+                        # periodically, with an object carrying only its version
+                        next_bookmark = time.monotonic() + BOOKMARK_PERIOD
+                        version = store.resource_version
+                        events = [(version, "BOOKMARK", {"apiVersion": kind[0], "kind": kind[1],
+                                                          "metadata": {"resourceVersion": str(version)}})]
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with store.cond:
+                store.watchers[resource] -= 1
+        self.close_connection = True
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # operators killed at the end of a benchmark reset their connections
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super(HTTPServer, self).handle_error(request, client_address)
+
+
+class FakeApiServer:
+    """
+    The fake API server, serving a `Store` over HTTP from a background thread.
+    """
+
+    def __init__(self, port=0, address="127.0.0.1", **store_options):
+        self.store = Store(**store_options)
+        handler = type("BoundHandler", (Handler,), {"store": self.store})
+        self.server = HTTPServer((address, port), handler)
+        self.url = f"http://{address}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-apiserver", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.store.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def write_kubeconfig(self, path):
+        """Write a kubeconfig pointing at this server, to be used through `KUBECONFIG`."""
+        kubeconfig = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+            "users": [{"name": "fake", "user": {"token": "fake"}}],
+            "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+            "current-context": "fake",
+        }
+        with open(path, "w") as f:
+            yaml.safe_dump(kubeconfig, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory fake Kubernetes API server")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--kubeconfig", help="write a kubeconfig pointing at the server to this path")
+    parser.add_argument("--pod-start-delay", type=float, default=0.0)
+    parser.add_argument("--nodes", type=int, default=0, help="fake nodes the pods are bound to")
+    args = parser.parse_args()
+    server = FakeApiServer(port=args.port, pod_start_delay=args.pod_start_delay, nodes=args.nodes)
+    if args.kubeconfig:
+        server.write_kubeconfig(args.kubeconfig)
+    print(f"Fake API server listening on {server.url}")
+    server.server.serve_forever()
@@ -0,0 +1,18 @@
+"""
+Entry point of the operator processes started by the benchmark: `main.py` run with the
+settings overridden by the JSON object in `DLJOB_BENCHMARK_SETTINGS`.
+"""
+import os
+import json
+import runpy
+import logging
+
+import settings.settings as settings
+
+if __name__ == "__main__":
+    # applied before main.py imports the operator, whose defaults are read at import time
+    for key, value in json.loads(os.environ.get("DLJOB_BENCHMARK_SETTINGS", "{}")).items():
+        setattr(settings, key, value)
+    # logging to stderr would be a large part of the measured CPU time
+    logging.disable(logging.getLevelName(os.environ.get("DLJOB_BENCHMARK_LOG_LEVEL", "WARNING")) - 1)
+    runpy.run_path("main.py", run_name="__main__")
@@ -0,0 +1,214 @@
+"""
+Scale benchmark of the operator against the in-memory fake API server.
+
+Starts a fake API server in this process and one or more operator processes pointed
+at it, submits synthetic MXJob/TFJob jobs and waits for all their pods to be Running.
+The result of each run is printed as JSON, and appended as one JSON line to `--output`
+so that runs of different versions can be compared:
+
+    python -m benchmark.run --jobs 100 --replicas 16 --output results.jsonl
+    python -m benchmark.run --operators 3 --mode sharded --jobs 300
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+import settings.settings as settings
+from dl_job import job_kinds
+from benchmark.fake_apiserver import FakeApiServer
+
+CONTAINER = {"image": "busybox", "name": "main", "command": ["sleep", "infinity"]}
+
+
+def replica_counts(kind, replicas):
+    """Split `replicas` among the replica types of a job, a quarter of them being servers/ps."""
+    servers = max(1, replicas // 4)
+    if kind == "MXJob":
+        return {"SCHEDULER": 1, "SERVER": servers, "WORKER": max(1, replicas - 1 - servers)}
+    return {"ps": servers, "worker": max(1, replicas - servers)}
+
+
+def job_manifest(kind, name, replicas, namespace=settings.NAMESPACE):
+    return {
+        "apiVersion": f"{settings.DOMAIN}/v1",
+        "kind": kind,
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": [{"replicaType": replica_type, "replicas": count, "template": {"spec": {"containers": [CONTAINER]}}}
+                 for replica_type, count in replica_counts(kind, replicas).items()]
+    }
+
+
+def start_operators(server, count, mode, overrides, log_level, log_dir):
+    kubeconfig = os.path.join(log_dir, "kubeconfig")
+    server.write_kubeconfig(kubeconfig)
+    processes = []
+    for i in range(count):
+        operator_settings = dict(overrides, OPERATOR_ID=f"operator-{i}",
+                                 LEADER_ELECTION=mode == "leader", SHARDED=mode == "sharded")
+        env = dict(os.environ, KUBECONFIG=kubeconfig,
+                   DLJOB_BENCHMARK_SETTINGS=json.dumps(operator_settings),
+                   DLJOB_BENCHMARK_LOG_LEVEL=log_level)
+        env.pop("KUBERNETES_PORT", None)
+        log = open(os.path.join(log_dir, f"operator-{i}.log"), "w")
+        processes.append(subprocess.Popen([sys.executable, "-m", "benchmark.operator"], env=env,
+                                          stdout=log, stderr=subprocess.STDOUT))
+    return processes
+
+
+def reap(process, options=os.WNOHANG):
+    """Reap an exited operator process with `wait4`, which also returns its resource usage.
+
+        Returns:
+            Bool. True if the process has exited
+    """
+    if getattr(process, "rusage", None) is None:
+        pid, _, rusage = os.wait4(process.pid, options)
+        if pid == 0:
+            return False
+        process.rusage = rusage
+        # keep Popen from waiting on a pid that no longer exists
+        process.returncode = -1
+    return True
+
+
+def stop_operators(processes):
+    """Stop the operator processes and collect their resource usage."""
+    usage = []
+    for p in processes:
+        if not reap(p):
+            p.send_signal(signal.SIGTERM)
+            reap(p, 0)
+        rusage = p.rusage
+        usage.append({
+            # kilobytes on Linux
+            "peak_rss_kb": rusage.ru_maxrss,
+            "cpu_user": rusage.ru_utime,
+            "cpu_system": rusage.ru_stime
+        })
+    return usage
+
+
+def wait_until(condition, timeout, processes, period=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if any(reap(p) for p in processes):
+            raise RuntimeError("an operator process exited, see its log")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"condition not met within {timeout}s")
+        time.sleep(period)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(jobs=10, replicas=4, kinds=("MXJob", "TFJob"), operators=1, mode="single", pod_start_delay=0.0,
+        nodes=0, namespaces=1, timeout=600, overrides=None, log_level="WARNING", log_dir=None):
+    """Run one benchmark.
+
+        Returns:
+            Dict. The parameters and the measurements of the run
+    """
+    # the jobs are spread over `namespaces` namespaces, all served by every operator
+    namespace_names = [settings.NAMESPACE] if namespaces == 1 else [f"bench-{i}" for i in range(namespaces)]
+    overrides = dict({"METRICS_PORT": None, "WATCH_NAMESPACES": namespace_names}, **(overrides or {}))
+    log_dir = log_dir or tempfile.mkdtemp(prefix="dljob-benchmark-")
+    server = FakeApiServer(pod_start_delay=pod_start_delay, nodes=nodes).start()
+    store = server.store
+    # the operators watch every job kind, the jobs are submitted to the resource of their kind
+    resources = {kind: f"{settings.DOMAIN}/{job_class.plural}" for kind, job_class in job_kinds().items()}
+    crd_names = [f"{job_class.plural}.{settings.DOMAIN}" for job_class in job_kinds().values()]
+    # the replicas of the leader election mode wait on the Lease, only one watches the jobs
+    watching = 1 if mode == "leader" else operators
+    processes = start_operators(server, operators, mode, overrides, log_level, log_dir)
+    try:
+        started = time.monotonic()
+        wait_until(lambda: all((None, name) in store.objects["customresourcedefinitions"] for name in crd_names) and
+                   all(store.watchers[resource] >= watching for resource in resources.values()), timeout, processes)
+        startup_time = time.monotonic() - started
+
+        manifests = [job_manifest(kinds[i % len(kinds)], f"bench-{i}", replicas, namespace_names[i % namespaces])
+                     for i in range(jobs)]
+        expected_pods = sum(s["replicas"] for m in manifests for s in m["spec"])
+        calls_before = dict(store.calls)
+        submitted = time.monotonic()
+        for manifest in manifests:
+            store.create(resources[manifest["kind"]], manifest["metadata"]["namespace"], manifest)
+        wait_until(lambda: store.count_pods() >= expected_pods, timeout, processes)
+        created_time = time.monotonic() - submitted
+        wait_until(lambda: store.count_pods(phase="Running") >= expected_pods, timeout, processes)
+        wall_time = time.monotonic() - submitted
+        calls = {f"{verb} {resource}": n - calls_before.get((verb, resource), 0)
+                 for (verb, resource), n in sorted(store.calls.items())
+                 if n - calls_before.get((verb, resource), 0) > 0}
+    finally:
+        usage = stop_operators(processes)
+        server.stop()
+
+    total_calls = sum(calls.values())
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "params": {"jobs": jobs, "replicas": replicas, "kinds": list(kinds), "operators": operators, "mode": mode,
+                   "pod_start_delay": pod_start_delay, "nodes": nodes, "namespaces": namespaces,
+                   "settings": overrides},
+        "pods": expected_pods,
+        "startup_time": startup_time,
+        "pods_created_time": created_time,
+        "wall_time": wall_time,
+        "jobs_per_second": jobs / wall_time,
+        "api_calls": total_calls,
+        "api_calls_per_job": total_calls / jobs,
+        "api_calls_by_verb": calls,
+        "peak_rss_kb": max(u["peak_rss_kb"] for u in usage),
+        "cpu_seconds": sum(u["cpu_user"] + u["cpu_system"] for u in usage),
+        "operators_usage": usage,
+        "log_dir": log_dir
+    }
+
+
+def parse_override(value):
+    key, _, raw = value.partition("=")
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the operator against an in-memory fake API server")
+    parser.add_argument("--jobs", type=int, default=10, help="number of jobs submitted")
+    parser.add_argument("--replicas", type=int, default=4, help="replicas per job")
+    parser.add_argument("--kind", action="append", choices=["MXJob", "TFJob"],
+                        help="job kinds, submitted in turn (default: both)")
+    parser.add_argument("--operators", type=int, default=1, help="operator processes")
+    parser.add_argument("--mode", choices=["single", "leader", "sharded"], default="single")
+    parser.add_argument("--pod-start-delay", type=float, default=0.0,
+                        help="seconds before a created pod is Running")
+    parser.add_argument("--nodes", type=int, default=0,
+                        help="fake nodes the pods are bound to (needed by GANG_ADMISSION)")
+    parser.add_argument("--namespaces", type=int, default=1, help="namespaces the jobs are spread over")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--set", action="append", default=[], type=parse_override, metavar="SETTING=VALUE",
+                        help="override a setting of the operators, the value is parsed as JSON if possible")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the operators")
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    args = parser.parse_args()
+
+    result = run(jobs=args.jobs, replicas=args.replicas, kinds=args.kind or ("MXJob", "TFJob"),
+                 operators=args.operators, mode=args.mode, pod_start_delay=args.pod_start_delay, nodes=args.nodes,
+                 namespaces=args.namespaces, timeout=args.timeout, overrides=dict(args.set), log_level=args.log_level)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
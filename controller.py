@@ -1,15 +1,26 @@
 import os
-import sys
 import time
 import json
 import yaml
+import heapq
 import atexit
+import random
+import threading
+from collections import deque
 
-from kubernetes import client, config, watch
+from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
 
 import dl_job
+import metrics
+import tracing
 import settings.settings as settings
+from admission import GangAdmission, job_priority
+from election import ShardMembership, operator_identity
+from informer import ClusterCache
+from replica import pod_failed
+from status import StatusWriter
+from kube_client import PooledApiClient, load_configuration, RequestLayer, RetryBudget, TokenBucket, watch_timeout
 
 import logging
 
@@ -17,46 +28,264 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
 
+def resync_delay():
+    """The delay before a job is checked again, spread so that the jobs do not all resync at once.
+    """
+    return settings.RESYNC_PERIOD * (1 + random.uniform(0, settings.RESYNC_JITTER))
+
+
+def job_key(namespace, name):
+    """The key of a job in the work queue and in the maps of the operator.
+    """
+    return f"{namespace}/{name}"
+
+
+def serves_namespace(namespace):
+    return settings.WATCH_NAMESPACES is None or namespace in settings.WATCH_NAMESPACES
+
+
+def crd_path(job_class):
+    return os.path.join(settings.CRD_DIR, f"{job_class.job_type.lower()}.yml")
+
+
+def orphan_jobs(cache, job_keys):
+    """The (namespace, job name) of the pods and services of jobs that do not exist anymore.
+
+        Args:
+            cache: The ClusterCache of the operator
+            job_keys: Keys of the existing jobs
+    """
+    # only resources created by a Replica carry both labels
+    orphans = {(pod.metadata.namespace, pod.metadata.labels["job_name"]) for pod in cache.pods.list()
+               if "job_name" in (pod.metadata.labels or {}) and "pod_name" in pod.metadata.labels}
+    orphans |= {(service.metadata.namespace, service.metadata.labels["job_name"])
+                for service in cache.services.list()
+                if "job_name" in (service.metadata.labels or {}) and "service_name" in service.metadata.labels}
+    return sorted((namespace, job_name) for namespace, job_name in orphans
+                  if job_key(namespace, job_name) not in job_keys and serves_namespace(namespace))
+
+
+def spec_changed(old, new):
+    """Whether a job custom resource changed in a way the operator acts on, not only in its status.
+    """
+    return old is None or old.get("spec") != new.get("spec") or \
+        old["metadata"].get("uid") != new["metadata"].get("uid") or \
+        old["metadata"].get("annotations") != new["metadata"].get("annotations")
+
+
+class WorkQueue:
+    """
+    FIFO queue of job keys drained by a pool of workers.
+
+    A key added while it is already waiting in the queue is collapsed into the pending
+    entry. A key is never handed to two workers at the same time: if it is added while
+    a worker is processing it, it is queued again only when that worker calls `done`.
+
+    Keys can also be added after a delay. Delayed keys are kept in a single heap ordered
+    by due time and moved to the queue by the workers waiting in `get`, so that no timer
+    thread is needed per key.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = deque()
+        # keys that need to be processed
+        self._dirty = set()
+        # keys currently held by a worker
+        self._processing = set()
+        self._shutting_down = False
+        # heap of (due time, key) of the delayed keys, and the earliest due time of each key
+        self._waiting = []
+        self._due = dict()
+        # consecutive failures of each key, for `add_rate_limited`
+        self._failures = dict()
+
+    def add(self, key):
+        with self._cond:
+            if self._shutting_down or key in self._dirty:
+                return
+            self._dirty.add(key)
+            if key in self._processing:
+                # will be queued again by `done`
+                return
+            self._queue.append(key)
+            self._cond.notify()
+
+    def add_after(self, key, delay):
+        """Add `key` once `delay` seconds have passed.
+
+        If the key is already waiting, it is added at the earliest of the two due times.
+        """
+        if delay <= 0:
+            self.add(key)
+            return
+        due = time.monotonic() + delay
+        with self._cond:
+            if self._shutting_down or self._due.get(key, due + 1) <= due:
+                return
+            self._due[key] = due
+            heapq.heappush(self._waiting, (due, key))
+            # a worker may be waiting for a later due time
+            self._cond.notify()
+
+    def add_rate_limited(self, key):
+        """Add `key` again after a delay growing exponentially with its consecutive failures.
+        """
+        with self._cond:
+            failures = self._failures.get(key, 0)
+            self._failures[key] = failures + 1
+        self.add_after(key, min(settings.REQUEUE_BACKOFF_BASE * 2 ** failures, settings.REQUEUE_BACKOFF_MAX))
+
+    def forget(self, key):
+        """Reset the failure count of `key`, after it was processed successfully.
+        """
+        with self._cond:
+            self._failures.pop(key, None)
+
+    def _add_due(self):
+        # must be called with the lock held
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            due, key = heapq.heappop(self._waiting)
+            # skip the entries replaced by an earlier due time
+            if self._due.get(key) == due:
+                del self._due[key]
+                if key not in self._dirty:
+                    self._dirty.add(key)
+                    if key not in self._processing:
+                        self._queue.append(key)
+                        self._cond.notify()
+        return self._waiting[0][0] - now if self._waiting else None
+
+    def get(self):
+        """Block until a key is available.
+
+            Returns:
+                The next key to process, or None if the queue was shut down
+        """
+        with self._cond:
+            while True:
+                next_due = self._add_due()
+                if self._queue or self._shutting_down:
+                    break
+                self._cond.wait(next_due)
+            if not self._queue:
+                return None
+            key = self._queue.popleft()
+            self._dirty.discard(key)
+            self._processing.add(key)
+            return key
+
+    def done(self, key):
+        """Mark `key` as processed. Must be called once for every key returned by `get`.
+        """
+        with self._cond:
+            self._processing.discard(key)
+            if key in self._dirty:
+                self._queue.append(key)
+                self._cond.notify()
+
+    def shut_down(self):
+        with self._cond:
+            self._shutting_down = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+
 class DLOperator:
 
     def __init__(self):
-        atexit.register(self.clean_up)
+        if settings.GANG_ADMISSION and settings.SHARDED:
+            # each replica would place its own jobs on the capacity that the jobs of the
+            # other replicas are about to use, and admit more than fits in the cluster
+            raise Exception("Gang admission is not supported in the sharded mode")
+        # with several operator replicas the jobs must survive any one of them
+        self.warm_start = settings.WARM_START or settings.LEADER_ELECTION or settings.SHARDED
 
-        if 'KUBERNETES_PORT' in os.environ:
-            config.load_incluster_config()
-        else:
-            config.load_kube_config()
-        self.configuration = client.Configuration()
-        self.configuration.assert_hostname = False
-        self.api_client = client.api_client.ApiClient(configuration=self.configuration)
-        self.v1_client = client.ApiextensionsV1beta1Api(self.api_client)
-        self.crd_client = client.CustomObjectsApi(self.api_client)
+        self.configuration = load_configuration()
+        # single client, and connection pool, shared by every job and replica
+        self.api_client = PooledApiClient(configuration=self.configuration)
+        # every API call is rate limited and retried by the request layer
+        self.limiter = TokenBucket(settings.API_QPS, settings.API_BURST)
+        self.v1_client = RequestLayer(client.ApiextensionsV1Api(self.api_client), self.limiter)
+        self.crd_client = RequestLayer(client.CustomObjectsApi(self.api_client), self.limiter)
+        self.core_v1_client = RequestLayer(client.CoreV1Api(self.api_client), self.limiter)
+        if not self.warm_start:
+            atexit.register(self.clean_up)
+
+        # shared view of pods and services, read by every job and replica
+        self.cache = ClusterCache(self.core_v1_client)
+        self.cache.start()
+        if not self.cache.wait_for_sync(settings.CACHE_SYNC_TIMEOUT):
+            logger.warning("Pod and service caches not synced, continuing anyway")
 
+        # job classes by kind, each with its custom resource and its watch
+        self.job_kinds = dl_job.job_kinds()
+        # jobs and last observed custom resource of every job, by job key (namespace/name)
         self.jobs = {}
+        self.job_objects = {}
+        self.queue = WorkQueue()
+        self.workers = list()
+        # jobs found running at startup, to be adopted instead of restarted
+        self.adopting = set()
+
+        metrics.JOBS.set_function(lambda: len(self.jobs))
+        metrics.REPLICAS.set_function(lambda: sum(len(j.replicas) for j in list(self.jobs.values())))
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.queue))
+        metrics.export_connection_stats(self.api_client.connection_stats)
+        self.cache.pods.add_handler(self.on_pod_event)
+
+        # capacity check of the new jobs, see admission.GangAdmission
+        self.admission = None
+        if settings.GANG_ADMISSION:
+            self.admission = GangAdmission(self.core_v1_client, on_change=self.queue.add)
+            self.admission.start()
+            if not self.admission.wait_for_sync(settings.CACHE_SYNC_TIMEOUT):
+                logger.warning("Node and pod capacity caches not synced, continuing anyway")
+
+        # status subresource of the job custom resources
+        self.status = StatusWriter(self.job_status, self.patch_status)
+
+        # jobs owned by this replica in the sharded mode
+        self.shards = None
+        if settings.SHARDED:
+            self.shards = ShardMembership(client.CoordinationV1Api(self.api_client), operator_identity(),
+                                          on_change=self.rebalance)
 
-        # launch default clean up process
-        self.clean_up()
+        if not self.warm_start:
+            # launch default clean up process
+            self.clean_up()
 
     def clean_up(self):
-        # delete all crds in the cluster
+        # delete the crds owned by the operator
         # all jobs associated with the crds will be deleted as well
         logging.info("Deleting existing custom resources...")
         current_crds = ["{}.{}".format(x['spec']['names']['plural'], x['spec']['group'])
-                        for x in self.v1_client.list_custom_resource_definition().to_dict()['items']]
+                        for x in self.v1_client.list_custom_resource_definition().to_dict()['items']
+                        if x['spec']['group'] == settings.DOMAIN]
         for c in current_crds:
             logger.info(f"Deleting {c}")
             self.v1_client.delete_custom_resource_definition(name=c, body=client.V1DeleteOptions())
-        for k, v in self.jobs.items():
-            v.clean_up()
+        for k, v in list(self.jobs.items()):
+            v.clean_up(wait=False)
         # wait a moment for the resource to be deleted
         time.sleep(2)
 
+    def create_crds(self):
+        """Register the custom resource of every job kind.
+        """
+        for job_class in self.job_kinds.values():
+            self.create_crd(crd_path(job_class))
+
     def create_crd(self, crd_path):
         current_crds = [x['spec']['names']['kind'].lower() for x in
                         self.v1_client.list_custom_resource_definition().to_dict()['items']]
         logger.info(f"Creating {crd_path} CRD")
         with open(crd_path) as crd:
-            body = yaml.load(crd)
+            body = yaml.safe_load(crd)
             try:
                 self.v1_client.create_custom_resource_definition(body)
             except ApiException as e:
@@ -72,50 +301,314 @@ class DLOperator:
             test0 = json.loads(test.read())
             try:
                 self.crd_client.create_cluster_custom_object(settings.DOMAIN, "v1",
-                                                             settings.CRD_NAME_PLURAL,
+                                                             self.job_kinds[test0["kind"]].plural,
                                                              body=test0)
             except ApiException as e:
                 logger.debug(json.loads(e.body))
-                sys.exit(1)
+                raise
 
-    def update_crd(self, obj):
-        metadata = obj.get("metadata")
-        if not metadata:
-            logger.info("No metadata in object, skipping: %s" % json.dumps(obj, indent=1))
+    def patch_status(self, obj, body):
+        """Apply the merge patch `body` to the status subresource of the job custom resource `obj`.
+
+        Patching the subresource leaves the spec alone, so status writes never conflict
+        with users editing the job.
+        """
+        metadata = obj["metadata"]
+        logger.debug(f"Updating status of job {metadata['name']}: {json.dumps(body)}")
+        self.crd_client.patch_namespaced_custom_object_status(settings.DOMAIN, "v1", metadata["namespace"],
+                                                              self.job_kinds[obj["kind"]].plural, metadata["name"],
+                                                              body)
+
+    def job_status(self, key):
+        """The (custom resource, status) of the job `key`, or None if this operator does not manage it.
+        """
+        obj = self.job_objects.get(key)
+        if obj is None:
+            return None
+        job = self.jobs.get(key)
+        if job is not None:
+            return obj, job.status()
+        if self.admission is not None and self.admission.waiting(key):
+            return obj, {"phase": "Queued"}
+        return None
+
+    def run(self, workers=settings.WORKERS):
+        """Start the reconcile workers and follow the job streams forever.
+        """
+        if self.shards is not None:
+            self.shards.start()
+        if settings.STATUS_UPDATE_PERIOD:
+            self.status.start()
+        self.start_workers(workers)
+        self.watch_crds()
+
+    def start_workers(self, workers=settings.WORKERS):
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_queue, name=f"worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        logger.info(f"Started {workers} workers")
+
+    def process_queue(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            try:
+                with tracing.span("operator.sync_job", job=key):
+                    self.sync_job(key)
+                self.status.touch(key)
+                self.queue.forget(key)
+                if key in self.jobs and settings.RESYNC_PERIOD:
+                    # check the job again later, even if nothing changes in the meantime
+                    self.queue.add_after(key, resync_delay())
+            except Exception:
+                logger.exception(f"Failed to sync job {key}")
+                self.queue.add_rate_limited(key)
+            finally:
+                self.queue.done(key)
+
+    def sync_job(self, key):
+        """Reconcile the job `key` against its last observed custom resource.
+        """
+        if self.shards is not None and not self.shards.owns(key):
+            self.release_job(key)
             return
-        name = metadata.get("name")
-        namespace = metadata.get("namespace")
-        spec = obj["spec"]
+        obj = self.job_objects.get(key)
+        if obj is None:
+            self.delete_job(key)
+            return
+        uid = obj["metadata"].get("uid")
+        job = self.jobs.get(key)
+        if job is not None and uid is not None and job.uid != uid:
+            # deleted and created again before we could process the deletion
+            self.delete_job(key)
+        # in the sharded mode a job may have been started by the replica that owned it before
+        adopt = key in self.adopting or (self.shards is not None and self.has_resources(key, uid))
+        self.adopting.discard(key)
+        job = self.jobs.get(key)
+        if job is not None:
+            if job.spec != obj["spec"]:
+                if self.admission is not None and \
+                        not self.admission.admit(key, job, job_priority(obj), spec=obj["spec"]):
+                    # synced again by the admission once the added replicas may fit
+                    return
+                job.update(obj["spec"])
+            elif job.needs_reconcile():
+                job.reconcile()
+            return
+        self.new_job(key, kind=obj.get("kind"), spec=obj["spec"], adopt=adopt, uid=uid,
+                     priority=job_priority(obj))
 
-        # Update spec ...
+    def on_pod_event(self, operation, pod):
+        """Check whether the job of a pod that changed is now fully running, or lost a replica.
+        """
+        job_name = (pod.metadata.labels or {}).get("job_name")
+        key = job_key(pod.metadata.namespace, job_name)
+        job = self.jobs.get(key)
+        if job is None:
+            return
+        job.pod_observed(pod.metadata.name)
+        self.status.touch(key)
+        if operation == "DELETED" or pod_failed(pod):
+            self.queue.add(key)
+        else:
+            job.check_running()
 
-        logger.info("Updating: %s" % name)
-        logger.info("Updating: %s" % name)
-        self.crd_client.replace_namespaced_custom_object(settings.DOMAIN, "v1", namespace, settings.CRD_NAME_PLURAL, name, obj)
+    def has_resources(self, key, uid):
+        """Whether pods or services of the job `key` are in the cache. The leftovers of a
+        deleted job with the same name, owned by another uid, do not count.
+        """
+        namespace, _, name = key.partition("/")
+        cache = self.cache.for_namespace(namespace)
+        for obj in cache.get_pods(name) + cache.get_services(name):
+            owners = obj.metadata.owner_references or []
+            if uid is None or any(o.uid == uid for o in owners):
+                return True
+        return False
+
+    def release_job(self, key):
+        """Stop managing a job now owned by another operator replica, leaving its resources running.
+        """
+        if self.admission is not None:
+            self.admission.release(key)
+        self.status.forget(key)
+        if self.jobs.pop(key, None) is not None:
+            logger.info(f"Job {key} handed over to {self.shards.owner(key)}")
+
+    def rebalance(self):
+        """Re-evaluate the owner of every known job after the shard members changed.
+        """
+        for key in set(self.job_objects) | set(self.jobs):
+            self.queue.add(key)
+
+    def delete_job(self, key):
+        """Forget a job whose custom resource was deleted.
+        """
+        if self.admission is not None:
+            self.admission.release(key)
+        self.status.forget(key)
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return
+        if job.uid is None:
+            # not owned by the custom resource, nothing will garbage collect the resources
+            job.clean_up(wait=False)
+        logger.info(f"Job {key} deleted")
 
-    def watch_crd(self):
+    def watch_crds(self):
+        """List the jobs of every kind, then follow the stream of each kind in its own thread.
+
+        Each kind has a single cluster-wide watch, whatever the number of namespaces served.
+        """
         logger.info("Waiting for DLJobs to come up...")
-        resource_version = ''
+        versions = self.relist_crds(adopt=self.warm_start)
+        watchers = [threading.Thread(target=self.watch_crd, args=(job_class, versions[kind]),
+                                     name=f"watch-{job_class.plural}", daemon=True)
+                    for kind, job_class in self.job_kinds.items()]
+        for w in watchers:
+            w.start()
+        for w in watchers:
+            w.join()
+
+    def watch_crd(self, job_class, resource_version):
+        """Follow the stream of the custom resources of one job kind.
+
+        The watch is resumed from the last seen resourceVersion every time the stream
+        ends, so that only the changes are received after a reconnection. The full list
+        of jobs is requested again only when the server answers 410 Gone, meaning our
+        resourceVersion is no longer available.
+        """
         while True:
-            stream = watch.Watch().stream(self.crd_client.list_cluster_custom_object, settings.DOMAIN, "v1", settings.CRD_NAME_PLURAL,
-                                          resource_version=resource_version)
-            for event in stream:
-                obj = event["object"]
-                operation = event['type']
-                spec = obj.get("spec")
-                if not spec:
+            try:
+                stream = watch.Watch().stream(self.crd_client.list_cluster_custom_object, settings.DOMAIN, "v1", job_class.plural,
+                                              resource_version=resource_version,
+                                              allow_watch_bookmarks=True,
+                                              timeout_seconds=settings.WATCH_TIMEOUT,
+                                              _request_timeout=watch_timeout())
+                for event in stream:
+                    obj = event["object"]
+                    operation = event['type']
+                    if operation == "ERROR":
+                        raise ApiException(status=obj.get("code"), reason=obj.get("message"))
+                    resource_version = obj.get("metadata", {}).get("resourceVersion", resource_version)
+                    if operation == "BOOKMARK":
+                        continue
+                    metadata = obj.get("metadata", {})
+                    with tracing.span("operator.watch_event", job=job_key(metadata.get("namespace"), metadata.get("name")),
+                                      operation=operation, kind=job_class.job_type):
+                        self.handle_event(operation, obj)
+            except ApiException as e:
+                if e.status != 410:
+                    logger.exception(f"{job_class.job_type} watch failed, reconnecting...")
+                    time.sleep(settings.INFORMER_RETRY_PERIOD)
                     continue
-                metadata = obj.get("metadata")
-                name = metadata['name']
-                logger.info("Handling %s on %s" % (operation, name))
+                logger.info(f"{job_class.job_type} resource version expired, relisting...")
+                resource_version = self.relist_crd(job_class)[0]
+            except Exception:
+                logger.exception(f"{job_class.job_type} watch failed, reconnecting...")
+                time.sleep(settings.INFORMER_RETRY_PERIOD)
+            finally:
+                metrics.WATCH_RECONNECTS.labels(job_class.plural).inc()
+
+    def relist_crds(self, adopt=False):
+        """List the existing jobs of every kind and handle them as new events.
+
+            Args:
+                adopt: If True, the listed jobs are adopted with their current pods and
+                    services, and the resources of jobs that no longer exist are deleted
+
+            Returns:
+                Dict. Job kind -> resourceVersion to start watching from
+        """
+        versions = dict()
+        keys = set()
+        for kind, job_class in self.job_kinds.items():
+            versions[kind], listed = self.relist_crd(job_class, adopt)
+            keys |= listed
+        # in the sharded mode, the list may already be stale for the jobs of the other replicas
+        if adopt and self.shards is None:
+            self.clean_up_orphans(keys)
+        return versions
+
+    def relist_crd(self, job_class, adopt=False):
+        """List all the existing jobs of one kind and handle them as new events.
 
-                if operation == "ADDED":
-                    self.new_job(name=name, kind=obj.get("kind"), spec=spec)
+            Returns:
+                Tuple. The resourceVersion to start watching from, and the keys of the listed jobs
+        """
+        job_list = self.crd_client.list_cluster_custom_object(settings.DOMAIN, "v1", job_class.plural)
+        logger.info(f"Listed {len(job_list['items'])} existing {job_class.plural}")
+        keys = {job_key(obj["metadata"]["namespace"], obj["metadata"]["name"]) for obj in job_list["items"]}
+        # jobs deleted while we were not watching
+        known = {key for key, obj in list(self.job_objects.items()) if obj.get("kind") == job_class.job_type}
+        for key in known - keys:
+            self.job_objects.pop(key, None)
+            self.queue.add(key)
+        for obj in job_list["items"]:
+            self.handle_event("ADDED", obj, adopt=adopt)
+        return job_list["metadata"]["resourceVersion"], keys
+
+    def clean_up_orphans(self, job_keys):
+        """Delete the pods and services left by jobs that were deleted while the operator was not running.
+
+            Args:
+                job_keys: Keys of the existing jobs
+        """
+        for namespace, job_name in orphan_jobs(self.cache, job_keys):
+            logger.info(f"Deleting resources of job {namespace}/{job_name}, which no longer exists")
+            self.core_v1_client.delete_collection_namespaced_pod(namespace, label_selector=f"job_name={job_name}")
+            try:
+                self.core_v1_client.delete_collection_namespaced_service(namespace,
+                                                                         label_selector=f"job_name={job_name}")
+            except (AttributeError, ApiException) as e:
+                # see DLJob.clean_up_services
+                if isinstance(e, ApiException) and e.status not in (404, 405):
+                    raise
+                for service in self.cache.for_namespace(namespace).get_services(job_name):
+                    self.core_v1_client.delete_namespaced_service(service.metadata.name, namespace,
+                                                                  body=client.V1DeleteOptions())
+
+    def handle_event(self, operation, obj, adopt=False):
+        spec = obj.get("spec")
+        if not spec:
+            return
+        metadata = obj.get("metadata")
+        if not serves_namespace(metadata["namespace"]):
+            return
+        key = job_key(metadata["namespace"], metadata["name"])
+        logger.info("Handling %s on %s %s" % (operation, obj.get("kind"), key))
+
+        previous = self.job_objects.get(key)
+        if previous is not None and previous.get("kind") != obj.get("kind"):
+            # the pods and services of the two jobs would have the same names
+            logger.warning(f"Ignoring {obj.get('kind')} {key}, a {previous.get('kind')} with the same name exists")
+            return
+        if operation in ("ADDED", "MODIFIED"):
+            self.job_objects[key] = obj
+            if adopt:
+                self.adopting.add(key)
+            elif operation == "MODIFIED" and not spec_changed(previous, obj):
+                # e.g. our own status writes
+                return
+            self.queue.add(key)
+        elif operation == "DELETED":
+            self.job_objects.pop(key, None)
+            self.queue.add(key)
 
-    def new_job(self, name, kind, spec):
+    def new_job(self, key, kind, spec, adopt=False, uid=None, priority=0):
         # job does not exists. Create new job
-        if name not in self.jobs:
-            logger.debug(f"{name} not found in jobs. Create new one.")
-            job_class = getattr(dl_job, kind)
-            job = job_class(name, spec)
-            self.jobs[name] = job
+        if key not in self.jobs:
+            logger.debug(f"{key} not found in jobs. Create new one.")
+            namespace, _, name = key.partition("/")
+            job_class = self.job_kinds[kind]
+            # each job retries failed calls within its own budget
+            job = job_class(name, spec, self.cache, self.core_v1_client.with_budget(RetryBudget()), uid, namespace)
+            if self.admission is not None and not self.admission.admit(key, job, priority):
+                # synced again by the admission once it may fit
+                return
+            self.jobs[key] = job
+            if adopt:
+                job.adopt()
+            else:
+                job.start()
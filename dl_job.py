@@ -1,11 +1,18 @@
 import os
 import json
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import metrics
+import tracing
 import settings.settings as settings
 
 from kubernetes import client
-from replica import Replica
+from kubernetes.client.rest import ApiException
+from admission import add_resources, parse_resources
+from replica import Replica, pod_failed
+from template import PodTemplate
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -17,10 +24,15 @@ class DLJob(ABC):
 
     # TODO: How to force redefinition of these two variables?
     job_type = None
+    # plural name of the custom resource of the job kind, see `job_kinds`
+    plural = None
     replica_types = list()
     container_properties = {}
+    # replica type -> replica types that must be created before it
+    replica_dependencies = {}
 
-    def __init__(self, name, spec):
+    @tracing.traced("job.init")
+    def __init__(self, name, spec, cache, core_v1_client, uid=None, namespace=settings.NAMESPACE):
         # check the class was properly subclassed
         if self.job_type is None or \
            type(self.replica_types) != list or \
@@ -28,34 +40,147 @@ class DLJob(ABC):
             raise Exception("Need to subclass DLJob with custom type and define job_type class variable")
 
         self.job_name = name
+        # namespace of the job custom resource, where all the resources of the job are created
+        self.namespace = namespace
         self.spec = spec
+        # uid of the job custom resource, owner of all the resources of the job
+        self.uid = uid
+        # shared pod and service cache (see informer.ClusterCache), looking up the job namespace
+        self.cache = cache.for_namespace(namespace)
         self.replicas = list()
-        # TODO: Initialize this in one single place
-        self.core_v1_client = client.CoreV1Api()
-
+        # client shared by the whole operator
+        self.core_v1_client = core_v1_client
+        # publish the cluster topology in a ConfigMap instead of the env of every replica
+        self.topology_configmap = settings.TOPOLOGY_CONFIGMAP and self.get_topology() is not None
+        # data of the topology ConfigMap as last written to the cluster
+        self.published_topology = None
+        # time the job was started, and the time all its replicas were first seen running
+        self.started_at = None
+        self.running_at = None
+        # pods created by the operator and not seen in the cache yet, name -> time of the creation,
+        # so that a sync running before the watch delivers them does not create them again
+        self.expected_pods = dict()
+
+    @tracing.traced("job.start")
+    def start(self):
+        """
+        Bring up the job from scratch: delete any leftover resource of a previous job
+        with the same name, then create and reconcile the replicas.
+        """
+        self.started_at = time.monotonic()
         self.clean_up_pods()
         self.clean_up_services()
         self.create_replicas()
         self.reconcile()
 
+    @tracing.traced("job.adopt")
+    def adopt(self):
+        """
+        Take over a job that was already running before the operator started:
+        its existing pods and services are kept, only the missing ones are created.
+        """
+        logger.info(f"Adopting job {self.job_name}")
+        self.create_replicas()
+        # load the state of the running replicas before the topology is published
+        for r in self.replicas:
+            r.observe()
+        self.reconcile()
+
+    @tracing.traced("job.update")
+    def update(self, spec):
+        """
+        Apply a modified spec to the running job. Only the replicas added or removed
+        by the new spec are created or deleted, the others are left running.
+        """
+        removed = self.scale(spec)
+        for r in removed:
+            r.clean_up()
+        self.reconcile()
+
+    def scale(self, spec):
+        """
+        Replace the spec of the job, adding the replica objects of the new replicas
+        and dropping the ones of the replicas no longer in the spec.
+        :return: The list of the dropped replicas, whose resources must be deleted
+        """
+        counts = {s["replicaType"]: s["replicas"] for s in spec}
+        old_counts = {s["replicaType"]: s["replicas"] for s in self.spec}
+        logger.info(f"Scaling job {self.job_name} from {old_counts} to {counts}")
+        self.spec = spec
+        removed = [r for r in self.replicas if r.uid >= counts.get(r.replica_type, 0)]
+        self.replicas = [r for r in self.replicas if r.uid < counts.get(r.replica_type, 0)]
+        self.create_replicas()
+
+        # the environment of a container is only read when it starts, from the spec or the ConfigMap
+        if counts != old_counts:
+            if self.topology_configmap:
+                logger.warning(f"Running replicas of job {self.job_name} keep the previous topology in their "
+                               f"environment, only the files under {settings.TOPOLOGY_MOUNT_PATH} are updated")
+            else:
+                logger.warning(f"Running replicas of job {self.job_name} keep the previous topology in their "
+                               f"environment, only the new replicas get the new one")
+        return removed
+
+    @tracing.traced("job.create_replicas")
     def create_replicas(self):
+        """
+        Create the replica objects defined by the spec that do not exist yet.
+        """
         logger.info("create replicas")
+        existing = {(r.replica_type, r.uid) for r in self.replicas}
         # create the replica objects
         for replica_spec in self.spec:
+            # validate and compile the template once for all the replicas of this type
+            template = PodTemplate(self.job_name, replica_spec["replicaType"],
+                                   replica_spec["template"], self.container_properties,
+                                   topology_configmap=self.topology_name() if self.topology_configmap else None,
+                                   owner_references=self.owner_references())
             # create n replicas for this type of replica
             for i in range(0, replica_spec['replicas']):
-                # create new replica
-                self.container_properties['env'] = self.get_environment_variables(replica_spec, i)
+                if (replica_spec["replicaType"], i) in existing:
+                    continue
+                # create new replica, its pod is only built when it is created
                 self.replicas.append(Replica(
                     uid=i,
                     replica_name=self.generate_replica_name(replica_spec["replicaType"].casefold(), self.job_name, i),
                     replica_type=replica_spec["replicaType"],
-                    job_name=self.job_name,
-                    template=replica_spec["template"],
-                    # define arbitrary container specific parameters
-                    **self.container_properties
+                    job=self,
+                    template=template
                     ))
 
+    def replica_environment(self, replica):
+        """
+        The env variables of a replica, from the current spec of the job. They are computed
+        each time a pod is built rather than stored, since they can hold the whole topology
+        of the job (e.g. the `TF_CONFIG` of `TFJob`).
+        """
+        for replica_spec in self.spec:
+            if replica_spec["replicaType"] == replica.replica_type:
+                return self.get_environment_variables(replica_spec, replica.uid)
+        return None
+
+    def replica_requests(self, spec=None):
+        """
+        The resources requested by each replica of the spec, including the pod itself,
+        as counted by the scheduler (see admission.pod_requests).
+
+            Args:
+                spec: The spec to read instead of the current spec of the job
+
+            Returns:
+                Dict. Replica name -> resource name -> Decimal quantity
+        """
+        requests = dict()
+        for replica_spec in spec if spec is not None else self.spec:
+            # only the first container of a template is used (see PodTemplate)
+            containers = (replica_spec["template"].get("spec") or {}).get("containers") or [{}]
+            request = {"pods": 1}
+            add_resources(request, parse_resources((containers[0].get("resources") or {}).get("requests")))
+            for i in range(replica_spec["replicas"]):
+                name = self.generate_replica_name(replica_spec["replicaType"].casefold(), self.job_name, i)
+                requests[name] = request
+        return requests
+
     def validate_spec(self):
         # validate replica type
         for replica_spec in self.spec['replicas']:
@@ -96,10 +221,212 @@ class DLJob(ABC):
         """
         pass
 
+    def get_topology(self):
+        """
+        Return the settings shared by all the replicas of the job (e.g. the addresses of
+        the other replicas). When `settings.TOPOLOGY_CONFIGMAP` is enabled, they are stored
+        once in a ConfigMap exposed to every replica as env variables and as files under
+        `settings.TOPOLOGY_MOUNT_PATH`, and `get_environment_variables` should only return
+        the settings specific to one replica.
+        :return: A dictionary of string values, or None if the job has no shared settings
+        """
+        return None
+
+    def owner_references(self):
+        """
+        Make the job custom resource the owner of the pods, services and ConfigMaps of the job,
+        so that Kubernetes garbage collects them when the job is deleted.
+        :return: A list with the owner reference, or None if the uid of the job is not known
+        """
+        if self.uid is None:
+            return None
+        return [{
+            "apiVersion": f"{settings.DOMAIN}/v1",
+            "kind": self.job_type,
+            "name": self.job_name,
+            "uid": self.uid,
+            "controller": True,
+            "blockOwnerDeletion": True
+        }]
+
+    def topology_name(self):
+        return f"{self.job_name}-topology"
+
+    def topology_config_map(self):
+        """
+        Build the topology ConfigMap of the job.
+        :return: The ConfigMap manifest, or None if the topology does not need to be published
+        """
+        if not self.topology_configmap:
+            return None
+        config_map = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {
+                "name": self.topology_name(),
+                "labels": {"job_name": self.job_name}
+            },
+            "data": self.get_topology()
+        }
+        if self.uid is not None:
+            config_map["metadata"]["ownerReferences"] = self.owner_references()
+        return config_map
+
+    @tracing.traced("job.publish_topology")
+    def publish_topology(self):
+        """
+        Create or update the topology ConfigMap of the job, if its content changed
+        since the last time it was written.
+        """
+        config_map = self.topology_config_map()
+        if config_map is None or config_map["data"] == self.published_topology:
+            return
+        if self.published_topology is not None:
+            try:
+                # already created by this job, only its data changed
+                self.core_v1_client.patch_namespaced_config_map(self.topology_name(), self.namespace,
+                                                                {"data": config_map["data"]})
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                logger.warning(f"Topology ConfigMap of job {self.job_name} deleted, creating it again")
+                self.core_v1_client.create_namespaced_config_map(self.namespace, config_map)
+        else:
+            try:
+                self.core_v1_client.create_namespaced_config_map(self.namespace, config_map)
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                # left over by a previous job with the same name, or created before a restart
+                self.core_v1_client.patch_namespaced_config_map(self.topology_name(), self.namespace,
+                                                                {"data": config_map["data"]})
+        self.published_topology = config_map["data"]
+        logger.info(f"Published topology of job {self.job_name}")
+
+    @tracing.traced("job.reconcile")
     def reconcile(self):
+        """
+        Reconcile all the replicas of the job, one stage of the dependency graph at a time.
+        The replicas of a stage are reconciled in parallel.
+        """
         logger.info(f"Reconcile Job {self.job_name}")
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=settings.REPLICA_CREATION_WORKERS) as pool:
+            for stage in self.replica_stages():
+                # the replicas of this stage read the topology when they start
+                self.publish_topology()
+                replicas = [r for r in self.replicas if r.replica_type.casefold() in stage]
+                with tracing.span("job.reconcile_stage", stage=",".join(sorted(stage)), replicas=len(replicas)):
+                    # consuming the results re-raises the first failure, so that
+                    # the next stages are not started
+                    list(pool.map(tracing.wrap(self.reconcile_replica), replicas))
+        metrics.RECONCILE_DURATION.labels(self.job_type).observe(time.monotonic() - start)
+        self.check_running()
+
+    def needs_reconcile(self):
+        """
+        Whether a replica has no pod, or a failed one, in the cache. Only reads the cache,
+        so that the periodic resync of a healthy job costs no API call.
+        """
+        pods = {p.metadata.name: p for p in self.cache.get_pods(self.job_name)}
+        return any(pod_failed(pods[r.replica_name]) if r.replica_name in pods
+                   else not self.creation_pending(r.replica_name) for r in self.replicas)
+
+    def expect_pod(self, pod_name):
+        self.expected_pods[pod_name] = time.monotonic()
+
+    def pod_observed(self, pod_name):
+        """Called for every event of a pod of the job received by the pod cache.
+        """
+        self.expected_pods.pop(pod_name, None)
+
+    def creation_pending(self, pod_name):
+        """Whether the pod `pod_name` was created by the operator but is not in the cache yet.
+        """
+        created = self.expected_pods.get(pod_name)
+        if created is None:
+            return False
+        if time.monotonic() - created > settings.EXPECTATION_TIMEOUT:
+            # its creation was lost, e.g. by a failed request that reached the server
+            logger.warning(f"Pod {pod_name} never seen in the cache, creating it again")
+            self.expected_pods.pop(pod_name, None)
+            return False
+        return True
+
+    def check_running(self):
+        """
+        Record the time-to-running of the job the first time all its replicas are running.
+        Adopted jobs were started by a previous operator and are not measured.
+        """
+        if self.started_at is None or self.running_at is not None or not self.replicas:
+            return
+        running = sum(1 for p in self.cache.get_pods(self.job_name) if p.status and p.status.phase == "Running")
+        if running < len(self.replicas):
+            return
+        self.running_at = time.monotonic()
+        metrics.TIME_TO_RUNNING.labels(self.job_type).observe(self.running_at - self.started_at)
+        logger.info(f"Job {self.job_name} running after {self.running_at - self.started_at:.2f}s")
+
+    def status(self):
+        """
+        The status of the job for its custom resource, computed from the pods in the cache.
+        A replica without a pod is Pending. The job is Failed if a replica failed, Succeeded
+        if all the replicas succeeded, Running if all of them are running or done, and
+        Pending otherwise.
+
+            Returns:
+                Dict. The job phase, the replica count per type and phase, and the phase of every replica
+        """
+        pods = {p.metadata.name: p for p in self.cache.get_pods(self.job_name)}
+        replicas = dict()
+        counts = dict()
         for r in self.replicas:
-            r.reconcile()
+            pod = pods.get(r.replica_name)
+            phase = pod.status.phase if pod is not None and pod.status and pod.status.phase else "Pending"
+            replicas[r.replica_name] = phase
+            type_counts = counts.setdefault(r.replica_type, dict())
+            type_counts[phase] = type_counts.get(phase, 0) + 1
+        phases = set(replicas.values())
+        if "Failed" in phases:
+            phase = "Failed"
+        elif phases == {"Succeeded"}:
+            phase = "Succeeded"
+        elif phases and phases <= {"Running", "Succeeded"}:
+            phase = "Running"
+        else:
+            phase = "Pending"
+        return {"phase": phase, "replicaStatuses": counts, "replicas": replicas}
+
+    def reconcile_replica(self, replica):
+        self.prepare_replica(replica)
+        replica.reconcile()
+
+    def prepare_replica(self, replica):
+        """
+        Called right before a replica is reconciled, once all the replicas it depends on
+        have been reconciled. Subclasses can override it to inject their state into the replica.
+        """
+        pass
+
+    def replica_stages(self):
+        """
+        Sort the replica types of the job spec in stages, following `replica_dependencies`.
+        A replica type only depends on types of the previous stages.
+
+            Returns:
+                List. A list of sets of casefolded replica types
+        """
+        types = {s['replicaType'].casefold() for s in self.spec}
+        stages = list()
+        created = set()
+        while len(created) < len(types):
+            stage = {t for t in types - created
+                     if all(d in created or d not in types for d in self.replica_dependencies.get(t, []))}
+            if not stage:
+                raise Exception(f"Cyclic replica dependencies in job {self.job_name}: {self.replica_dependencies}")
+            stages.append(stage)
+            created |= stage
+        return stages
 
     def number_of_replicas(self, replica_type):
         for r in self.spec:
@@ -112,63 +439,88 @@ class DLJob(ABC):
             if s['replicaType'] == replica_type:
                 return s
 
-    def clean_up(self):
-        for r in self.replicas:
-            r.clean_up()
+    def clean_up(self, wait=True):
+        """
+        Tear down the job, deleting all of its pods and services with one
+        collection delete per resource kind.
 
-    def clean_up_pods(self):
+            Returns:
+                Tuple. The number of deleted pods and services
+        """
+        start = time.monotonic()
+        pods = self.clean_up_pods(wait=wait)
+        services = self.clean_up_services(wait=wait)
+        if self.topology_configmap:
+            self.core_v1_client.delete_collection_namespaced_config_map(
+                self.namespace,
+                label_selector=f"job_name={self.job_name}")
+            self.published_topology = None
+        logger.info(f"Job {self.job_name} torn down: deleted {pods} pods and {services} services "
+                    f"in {time.monotonic() - start:.2f}s")
+        return pods, services
+
+    @tracing.traced("job.clean_up_pods")
+    def clean_up_pods(self, wait=True):
         """
         Delete pods that match the selection job_name=self.job_name.
         This function is called every time a new job is created to delete any previous pod
         associated to the same job name. This avoid collisions and unpleasant behaviors.
+
+            Returns:
+                Int. The number of deleted pods
         """
-        api_instance = client.CoreV1Api()
-        logger.info(f"Deleting pods matching {self.job_name} job name")
-        selector = f"job_name={self.job_name}"
-        pod_list = api_instance.list_namespaced_pod(settings.NAMESPACE, label_selector=selector)
-        if len(pod_list.items) == 0:
-            return
-        logger.info(f"Deleting {len(pod_list.items)} pods.")
-        pod_names = list()
-        for pod in pod_list.items:
-            logger.info(f"Deleting pod {pod.metadata.name}.")
-            pod_names.append(pod.metadata.name)
-            api_instance.delete_namespaced_pod(
-                pod.metadata.name,
-                settings.NAMESPACE,
-                body=client.V1DeleteOptions())
+        self.expected_pods.clear()
+        pod_names = [pod.metadata.name for pod in self.cache.get_pods(self.job_name)]
+        if len(pod_names) == 0:
+            return 0
+        logger.info(f"Deleting {len(pod_names)} pods matching {self.job_name} job name")
+        start = time.monotonic()
+        self.core_v1_client.delete_collection_namespaced_pod(
+            self.namespace,
+            label_selector=f"job_name={self.job_name}")
 
         # wait for the resources to be deleted
-        while len(api_instance.list_namespaced_pod(settings.NAMESPACE,
-                                                   label_selector=f"pod_name in ({', '.join(pod_names)})").items):
-            pass
-
-    def clean_up_services(self):
+        with tracing.span("job.wait_for_pods_deleted", pods=len(pod_names)):
+            deleted = not wait or self.cache.wait_for_pods_deleted(pod_names)
+        if not deleted:
+            raise TimeoutError(f"Pods of job {self.job_name} not deleted after {settings.DELETE_TIMEOUT} seconds")
+        logger.info(f"Deleted {len(pod_names)} pods of job {self.job_name} in {time.monotonic() - start:.2f}s")
+        return len(pod_names)
+
+    @tracing.traced("job.clean_up_services")
+    def clean_up_services(self, wait=True):
         """
         Delete services that match the selection job_name=self.job_name.
         This function is called every time a new job is created to delete any previous pod
         associated to the same job name. This avoid collisions and unpleasant behaviors.
+
+            Returns:
+                Int. The number of deleted services
         """
-        api_instance = client.CoreV1Api()
-        logger.info(f"Deleting services matching {self.job_name} job name")
-        selector = f"job_name={self.job_name}"
-        service_list = api_instance.list_namespaced_service(settings.NAMESPACE, label_selector=selector)
-        if len(service_list.items) == 0:
-            return
-        logger.info(f"Deleting {len(service_list.items)} services.")
-        service_names = list()
-        for service in service_list.items:
-            logger.info(f"Deleting service {service.metadata.name}.")
-            service_names.append(service.metadata.name)
-            api_instance.delete_namespaced_service(
-                service.metadata.name,
-                settings.NAMESPACE,
-                body=client.V1DeleteOptions())
+        service_names = [service.metadata.name for service in self.cache.get_services(self.job_name)]
+        if len(service_names) == 0:
+            return 0
+        logger.info(f"Deleting {len(service_names)} services matching {self.job_name} job name")
+        start = time.monotonic()
+        try:
+            self.core_v1_client.delete_collection_namespaced_service(
+                self.namespace,
+                label_selector=f"job_name={self.job_name}")
+        except (AttributeError, ApiException) as e:
+            # collection deletes of services are not supported by older clients and API servers
+            if isinstance(e, ApiException) and e.status not in (404, 405):
+                raise
+            logger.debug("Service collection delete not supported, deleting services one by one")
+            for name in service_names:
+                self.core_v1_client.delete_namespaced_service(name, self.namespace, body=client.V1DeleteOptions())
 
         # wait for the resources to be deleted
-        while len(api_instance.list_namespaced_service(settings.NAMESPACE,
-                                                       label_selector=f"service_name in ({', '.join(service_names)})").items):
-            pass
+        with tracing.span("job.wait_for_services_deleted", services=len(service_names)):
+            deleted = not wait or self.cache.wait_for_services_deleted(service_names)
+        if not deleted:
+            raise TimeoutError(f"Services of job {self.job_name} not deleted after {settings.DELETE_TIMEOUT} seconds")
+        logger.info(f"Deleted {len(service_names)} services of job {self.job_name} in {time.monotonic() - start:.2f}s")
+        return len(service_names)
 
     @staticmethod
     def generate_replica_name(*args):
@@ -178,15 +530,21 @@ class DLJob(ABC):
 class MXJob(DLJob):
 
     job_type = "MXJob"
+    plural = "mxjobs"
     replica_types = ['scheduler', 'server', 'worker']
     container_properties = {
         "ports": [9000],
         "volumes": []
     }
     mx_port = 9000
+    # servers and workers need the address of the scheduler
+    replica_dependencies = {
+        "server": ["scheduler"],
+        "worker": ["scheduler"]
+    }
 
-    def __init__(self, name, spec):
-        super(MXJob, self).__init__(name, spec)
+    def __init__(self, name, spec, cache, core_v1_client, uid=None, namespace=settings.NAMESPACE):
+        super(MXJob, self).__init__(name, spec, cache, core_v1_client, uid, namespace)
 
     # @property
     # def job_type(cls):
@@ -199,45 +557,48 @@ class MXJob(DLJob):
     def validate_spec(self):
         super(MXJob, self).validate_spec()
 
-    def get_environment_variables(self, replica_spec, replica_index, scheduler_ip=""):
+    def get_environment_variables(self, replica_spec, replica_index):
         env = {
-            # define later
-            "DMLC_ROLE": replica_spec['replicaType'].casefold(),
-            # define later
-            "DMLC_PS_ROOT_URI": scheduler_ip,
-            "DMLC_PS_ROOT_PORT": self.mx_port,
+            "DMLC_ROLE": replica_spec['replicaType'].casefold()
+        }
+        if not self.topology_configmap:
+            env.update(self.get_topology())
+            if env["DMLC_ROLE"] != "scheduler" and not env["DMLC_PS_ROOT_URI"]:
+                # the replica would never reach the scheduler, the job is synced again later
+                raise Exception(f"Job {self.job_name}: the scheduler has no IP address yet")
+        return env
+
+    def get_topology(self):
+        return {
+            # TODO: Need to remove this once we solve the hostname resolve issue
+            # (known once the scheduler is created, before the pods of the next stages are built)
+            "DMLC_PS_ROOT_URI": self.scheduler_ip(),
             # auto conversion to str not supported by client for safety reasons
+            "DMLC_PS_ROOT_PORT": str(self.mx_port),
             "DMLC_NUM_SERVER": str(self.number_of_replicas("SERVER")),
             "DMLC_NUM_WORKER": str(self.number_of_replicas("WORKER")),
             "PS_VERBOSE": "2"
         }
-        return env
 
-    def reconcile(self):
-        logger.info(f"MXJob: Reconcile Job {self.job_name}")
-        scheduler_ip = ""
+    def scheduler_ip(self):
         for r in self.replicas:
-            # TODO: Need to remove this once we solve the hostname resolve issue
-            if r.replica_type != "SCHEDULER":
-                r.container_params['env']['DMLC_PS_ROOT_URI'] = scheduler_ip
-
-            r.reconcile()
-
             if r.replica_type == "SCHEDULER":
-                scheduler_ip = r.scheduler_ip
+                return r.scheduler_ip
+        return ""
 
 
 class TFJob(DLJob):
 
     job_type = "TFJob"
+    plural = "tfjobs"
     replica_types = ['ps', 'worker']
     container_properties = {
         "ports": [2222]
     }
     tf_port = 2222
 
-    def __init__(self, name, spec):
-        super(TFJob, self).__init__(name, spec)
+    def __init__(self, name, spec, cache, core_v1_client, uid=None, namespace=settings.NAMESPACE):
+        super(TFJob, self).__init__(name, spec, cache, core_v1_client, uid, namespace)
 
     # def job_type(self):
     #     return "TFJob"
@@ -262,14 +623,44 @@ class TFJob(DLJob):
         ]
         return cluster_config
 
+    def get_topology(self):
+        return {
+            "TF_CLUSTER": json.dumps(self.get_cluster_config())
+        }
+
     def get_environment_variables(self, replica_spec, replica_index):
-        tf_config = dict()
-        tf_config['cluster'] = self.get_cluster_config()
-        tf_config['task'] = {
+        task = {
             "type": replica_spec['replicaType'],
             "index": replica_index
         }
+        if self.topology_configmap:
+            # $(TF_CLUSTER) is expanded by the kubelet with the value
+            # read from the topology ConfigMap
+            return {
+                "TF_CONFIG": f'{{"cluster": $(TF_CLUSTER), "task": {json.dumps(task)}}}'
+            }
+        tf_config = dict()
+        tf_config['cluster'] = self.get_cluster_config()
+        tf_config['task'] = task
         env = {
             "TF_CONFIG": json.dumps(tf_config)
         }
         return env
+
+
+def job_kinds():
+    """
+    The job kinds served by the operator: every subclass of DLJob defining a `job_type`.
+    Defining a new subclass is enough for the operator to register and watch its custom resource.
+
+        Returns:
+            Dict. Job kind -> job class
+    """
+    kinds = dict()
+    classes = list(DLJob.__subclasses__())
+    while classes:
+        cls = classes.pop()
+        classes.extend(cls.__subclasses__())
+        if cls.job_type is not None:
+            kinds[cls.job_type] = cls
+    return kinds
@@ -0,0 +1,283 @@
+import os
+import time
+import random
+import socket
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+import metrics
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+# label of the Lease objects announcing the members of a sharded deployment
+MEMBER_LABEL = "dljob-operator-member-of"
+
+IS_LEADER = metrics.Gauge("dljob_leader", "1 if this operator holds the leader Lease")
+SHARD_MEMBERS = metrics.Gauge("dljob_shard_members", "Live operator replicas sharing the jobs")
+
+
+def operator_identity():
+    """The holder identity of this operator process in the Leases.
+    """
+    return settings.OPERATOR_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaderElector:
+    """
+    Lease-based leader election, following the client-go algorithm.
+
+    The holder renews the Lease every `retry_period` seconds. The other candidates
+    consider the Lease expired when they have not seen it change for
+    `lease_duration` seconds, measured with their own clock, so that no clock
+    synchronization between the operator replicas is needed. A leader that cannot
+    renew within `renew_deadline` seconds gives up its leadership.
+    """
+
+    def __init__(self, coordination_client, name, identity, namespace=settings.NAMESPACE, labels=None,
+                 lease_duration=settings.LEASE_DURATION, renew_deadline=settings.LEASE_RENEW_DEADLINE,
+                 retry_period=settings.LEASE_RETRY_PERIOD):
+        """
+        :param coordination_client: A `CoordinationV1Api`
+        :param name: Name of the Lease object
+        :param identity: Identity of this candidate, unique among the operator replicas
+        :param labels: Labels of the Lease object, set when it is created
+        """
+        self.api = coordination_client
+        self.name = name
+        self.identity = identity
+        self.namespace = namespace
+        self.labels = labels
+        self.lease_duration = lease_duration
+        self.renew_deadline = renew_deadline
+        self.retry_period = retry_period
+        # last (holder, renew time) seen in the Lease, and when we saw it change
+        self._observed = None
+        self._observed_at = 0
+        self._stopped = threading.Event()
+
+    def try_acquire_or_renew(self):
+        """Take the Lease if it is free or expired, or renew it if we hold it.
+
+            Returns:
+                Bool. True if we hold the Lease
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            lease = self.api.read_namespaced_lease(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=self.name, namespace=self.namespace, labels=self.labels),
+                spec=client.V1LeaseSpec(holder_identity=self.identity, lease_duration_seconds=self.lease_duration,
+                                        acquire_time=now, renew_time=now, lease_transitions=0))
+            try:
+                self.api.create_namespaced_lease(self.namespace, lease)
+            except ApiException as e:
+                if e.status == 409:
+                    # created by another candidate in the meantime
+                    return False
+                raise
+            self._observe(lease.spec)
+            return True
+
+        spec = lease.spec
+        self._observe(spec)
+        duration = spec.lease_duration_seconds or self.lease_duration
+        if spec.holder_identity and spec.holder_identity != self.identity and \
+                time.monotonic() < self._observed_at + duration:
+            return False
+
+        if spec.holder_identity != self.identity:
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.holder_identity = self.identity
+        spec.lease_duration_seconds = self.lease_duration
+        spec.renew_time = now
+        try:
+            # the resourceVersion of the Lease we read makes the update fail if someone else wrote it
+            self.api.replace_namespaced_lease(self.name, self.namespace, lease)
+        except ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        self._observe(spec)
+        return True
+
+    def _observe(self, spec):
+        record = (spec.holder_identity, spec.renew_time)
+        if record != self._observed:
+            self._observed = record
+            self._observed_at = time.monotonic()
+
+    def try_lease(self):
+        """`try_acquire_or_renew`, logging the errors instead of raising them.
+        """
+        try:
+            return self.try_acquire_or_renew()
+        except Exception:
+            logger.exception(f"Failed to acquire or renew Lease {self.name}")
+            return False
+
+    def acquire(self):
+        """Block until we hold the Lease, or the elector is stopped.
+
+            Returns:
+                Bool. True if the Lease was acquired
+        """
+        logger.info(f"{self.identity}: waiting for Lease {self.name}")
+        while not self._stopped.is_set():
+            if self.try_lease():
+                logger.info(f"{self.identity}: acquired Lease {self.name}")
+                return True
+            # jitter, so that the candidates do not all retry at the same time
+            self._stopped.wait(self.retry_period * (1 + random.random()))
+        return False
+
+    def renew(self):
+        """Keep renewing the Lease until a renewal fails for `renew_deadline` seconds, or the elector is stopped.
+        """
+        while not self._stopped.is_set():
+            deadline = time.monotonic() + self.renew_deadline
+            while not self.try_lease():
+                if time.monotonic() >= deadline or self._stopped.is_set():
+                    logger.error(f"{self.identity}: failed to renew Lease {self.name}")
+                    return
+                self._stopped.wait(self.retry_period)
+            self._stopped.wait(self.retry_period)
+
+    def run(self, on_started_leading, on_stopped_leading):
+        """Wait for the leadership, then run `on_started_leading` in a daemon thread while renewing the Lease.
+
+        `on_stopped_leading` is called once the leadership is lost or the elector is stopped.
+        """
+        if not self.acquire():
+            return
+        IS_LEADER.set_function(lambda: 1)
+        threading.Thread(target=on_started_leading, name="leader", daemon=True).start()
+        try:
+            self.renew()
+        finally:
+            IS_LEADER.set_function(lambda: 0)
+            on_stopped_leading()
+
+    def stop(self):
+        self._stopped.set()
+
+    def release(self):
+        """Give up the Lease, so that another candidate can take it without waiting for it to expire.
+        """
+        try:
+            lease = self.api.read_namespaced_lease(self.name, self.namespace)
+            if lease.spec.holder_identity != self.identity:
+                return
+            lease.spec.holder_identity = None
+            lease.spec.lease_duration_seconds = 1
+            lease.spec.renew_time = datetime.now(timezone.utc)
+            self.api.replace_namespaced_lease(self.name, self.namespace, lease)
+        except ApiException:
+            logger.exception(f"Failed to release Lease {self.name}")
+
+
+class ShardMembership:
+    """
+    Membership of one operator replica in a sharded deployment.
+
+    Every replica holds its own Lease, labeled with the name of the deployment, and
+    lists the Leases of the other replicas to know the live members. Each job is owned
+    by exactly one live member, chosen by rendezvous hashing of the job name, so that
+    a member joining or leaving only moves the jobs it gains or owned. `on_change` is
+    called from the membership thread every time the set of live members changes.
+    """
+
+    def __init__(self, coordination_client, identity, on_change, namespace=settings.NAMESPACE,
+                 group=settings.LEASE_NAME):
+        self.api = coordination_client
+        self.identity = identity
+        self.on_change = on_change
+        self.namespace = namespace
+        self.group = group
+        self.elector = LeaderElector(coordination_client, f"{group}-{identity}", identity, namespace,
+                                     labels={MEMBER_LABEL: group})
+        self.members = ()
+        # lease name -> ((holder, renew time), when we saw it change)
+        self._observed = dict()
+        self._renewed_at = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        SHARD_MEMBERS.set_function(lambda: len(self.members))
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self.run, name="shard-membership", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Leave the deployment: the other members take over our jobs right away.
+        """
+        self._stopped.set()
+        self.delete_lease(self.elector.name)
+
+    def delete_lease(self, name):
+        self._observed.pop(name, None)
+        try:
+            self.api.delete_namespaced_lease(name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                logger.exception(f"Failed to delete Lease {name}")
+
+    def run(self):
+        while not self._stopped.wait(self.elector.retry_period):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the shard members")
+
+    def refresh(self):
+        """Renew our own Lease and update the list of live members.
+        """
+        if self.elector.try_lease():
+            self._renewed_at = time.monotonic()
+        now = time.monotonic()
+        live = set()
+        leases = self.api.list_namespaced_lease(self.namespace, label_selector=f"{MEMBER_LABEL}={self.group}")
+        for lease in leases.items:
+            spec = lease.spec
+            record = (spec.holder_identity, spec.renew_time)
+            observed = self._observed.get(lease.metadata.name)
+            if observed is None or observed[0] != record:
+                observed = self._observed[lease.metadata.name] = (record, now)
+            duration = spec.lease_duration_seconds or self.elector.lease_duration
+            if spec.holder_identity and now < observed[1] + duration:
+                live.add(spec.holder_identity)
+            elif now > observed[1] + 2 * duration and lease.metadata.name != self.elector.name:
+                # the member was killed without deleting its Lease
+                self.delete_lease(lease.metadata.name)
+        # a member that cannot renew its own Lease must stop owning jobs before the others take them
+        if now - self._renewed_at > self.elector.renew_deadline:
+            live.discard(self.identity)
+        else:
+            live.add(self.identity)
+
+        members = tuple(sorted(live))
+        if members != self.members:
+            logger.info(f"Shard members changed from {list(self.members)} to {list(members)}")
+            self.members = members
+            self.on_change()
+
+    def owner(self, key):
+        """The live member owning the job `key`, or None if there are no live members.
+        """
+        members = self.members
+        if not members:
+            return None
+        return max(members, key=lambda m: hashlib.sha1(f"{m}/{key}".encode()).digest())
+
+    def owns(self, key):
+        return self.owner(key) == self.identity
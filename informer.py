@@ -0,0 +1,341 @@
+import os
+import copy
+import time
+import threading
+from collections import defaultdict
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+import metrics
+import settings.settings as settings
+from kube_client import watch_timeout
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+class Informer:
+    """
+    Watch-backed local copy of one kind of resource (e.g. pods).
+
+    The informer lists the resource once, then follows the watch stream starting
+    from the last seen resourceVersion, so that readers can query the cluster state
+    from memory instead of issuing LIST calls. Objects are also indexed by the
+    values of the labels given in `index_labels`.
+
+    Objects are stored by name. Informers not bound to a namespace (cluster scoped
+    resources, or `list_*_for_all_namespaces` functions) store namespaced objects
+    by `namespace/name`, and index them by (namespace, label value).
+    """
+
+    def __init__(self, list_func, namespace, index_labels=(), **list_kwargs):
+        """
+        :param list_func: The client function used to list/watch the resource
+            (e.g. `CoreV1Api.list_namespaced_pod`)
+        :param namespace: The namespace to watch, or None if `list_func` takes no namespace
+        :param index_labels: Names of the labels to build in-memory indexes for
+        :param list_kwargs: Other arguments of the list and watch requests (e.g. `field_selector`)
+        """
+        self.list_func = list_func
+        self.namespace = namespace
+        self.index_labels = tuple(index_labels)
+        self.list_kwargs = list_kwargs
+        self.args = (namespace,) if namespace is not None else ()
+
+        self._objects = dict()
+        # label name -> label value (see `index_key`) -> object name -> object
+        self._indexes = {label: defaultdict(dict) for label in self.index_labels}
+        # notified every time the cached objects change
+        self._cond = threading.Condition(threading.RLock())
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._resource_version = ''
+        self._thread = None
+        # called with (operation, object) after every change of the cached objects
+        self._handlers = []
+        self.resource = metrics.verb_and_resource(list_func.__name__)[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"informer-{self.list_func.__name__}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def add_handler(self, handler):
+        """Call `handler(operation, obj)` every time an object is added, modified or deleted.
+
+        Handlers run in the watch thread after the cache is updated, so they must not block.
+        """
+        self._handlers.append(handler)
+
+    def dispatch(self, operation, obj):
+        for handler in self._handlers:
+            try:
+                handler(operation, obj)
+            except Exception:
+                logger.exception(f"{self.list_func.__name__}: event handler failed")
+
+    def wait_for_sync(self, timeout=None):
+        """Block until the initial LIST has been loaded in memory.
+
+            Returns:
+                Bool. True if the informer synced within `timeout` seconds
+        """
+        return self._synced.wait(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if not self._resource_version:
+                    self.relist()
+                self.watch()
+            except ApiException as e:
+                if e.status == 410:
+                    # our resourceVersion is too old, start again from a fresh LIST
+                    logger.info(f"{self.list_func.__name__}: resource version expired, relisting")
+                    self._resource_version = ''
+                else:
+                    logger.exception(f"{self.list_func.__name__}: watch failed")
+                    self._stopped.wait(settings.INFORMER_RETRY_PERIOD)
+            except Exception:
+                logger.exception(f"{self.list_func.__name__}: watch failed")
+                self._stopped.wait(settings.INFORMER_RETRY_PERIOD)
+            finally:
+                metrics.WATCH_RECONNECTS.labels(self.resource).inc()
+
+    def relist(self):
+        object_list = self.list_func(*self.args, **self.list_kwargs)
+        with self._cond:
+            events = self._replace(object_list.items)
+            self._resource_version = object_list.metadata.resource_version
+            self._cond.notify_all()
+        if self._synced.is_set():
+            # the changes made while the watch was down, e.g. after a 410
+            for operation, obj in events:
+                self.dispatch(operation, obj)
+        self._synced.set()
+        logger.debug(f"{self.list_func.__name__}: listed {len(object_list.items)} objects")
+
+    def _replace(self, objects):
+        """Replace the cached objects with the result of a LIST.
+
+            Returns:
+                List. The (operation, object) events that turn the previous content into the new one
+        """
+        # must be called with the lock held
+        previous = self._objects
+        self._objects = dict()
+        self._indexes = {label: defaultdict(dict) for label in self.index_labels}
+        for obj in objects:
+            self._add(obj)
+        events = [("DELETED", obj) for name, obj in previous.items() if name not in self._objects]
+        for name, obj in self._objects.items():
+            old = previous.get(name)
+            if old is None:
+                events.append(("ADDED", obj))
+            elif old.metadata.resource_version != obj.metadata.resource_version:
+                events.append(("MODIFIED", obj))
+        return events
+
+    def watch(self):
+        stream = watch.Watch().stream(self.list_func, *self.args,
+                                      resource_version=self._resource_version,
+                                      allow_watch_bookmarks=True,
+                                      timeout_seconds=settings.WATCH_TIMEOUT,
+                                      _request_timeout=watch_timeout(),
+                                      **self.list_kwargs)
+        for event in stream:
+            if self._stopped.is_set():
+                return
+            operation = event['type']
+            obj = event['object']
+            if operation == "ERROR":
+                status = event.get('raw_object', {})
+                raise ApiException(status=status.get('code'), reason=status.get('message'))
+            if operation == "BOOKMARK":
+                # bookmarks only carry the latest resourceVersion, and are left as
+                # dictionaries by the client since they are not complete objects
+                self._resource_version = event['raw_object']['metadata']['resourceVersion']
+                continue
+            with self._cond:
+                if operation in ("ADDED", "MODIFIED"):
+                    self._remove(self.key(obj))
+                    self._add(obj)
+                elif operation == "DELETED":
+                    self._remove(self.key(obj))
+                self._resource_version = obj.metadata.resource_version
+                self._cond.notify_all()
+            self.dispatch(operation, obj)
+
+    def key(self, obj):
+        """The key `obj` is stored with, see `get`.
+        """
+        if self.namespace is None and obj.metadata.namespace:
+            return f"{obj.metadata.namespace}/{obj.metadata.name}"
+        return obj.metadata.name
+
+    def index_key(self, value, namespace):
+        return value if self.namespace is not None else (namespace, value)
+
+    def _add(self, obj):
+        name = self.key(obj)
+        self._objects[name] = obj
+        labels = obj.metadata.labels or {}
+        for label in self.index_labels:
+            if label in labels:
+                self._indexes[label][self.index_key(labels[label], obj.metadata.namespace)][name] = obj
+
+    def _remove(self, name):
+        obj = self._objects.pop(name, None)
+        if obj is None:
+            return
+        labels = obj.metadata.labels or {}
+        for label in self.index_labels:
+            if label in labels:
+                value = self.index_key(labels[label], obj.metadata.namespace)
+                bucket = self._indexes[label].get(value)
+                if bucket is not None:
+                    bucket.pop(name, None)
+                    if not bucket:
+                        del self._indexes[label][value]
+
+    def wait_for(self, predicate, timeout):
+        """Block until `predicate()` is true or `timeout` seconds have passed.
+
+        The predicate is evaluated again every time the informer receives an event.
+        In case a notification is missed (e.g. while the watch is reconnecting), it is
+        also re-evaluated after an exponentially growing delay.
+
+            Returns:
+                Bool. True if the predicate became true before the deadline
+        """
+        deadline = time.monotonic() + timeout
+        delay = settings.WAIT_BACKOFF_BASE
+        with self._cond:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(delay, remaining))
+                delay = min(delay * 2, settings.WAIT_BACKOFF_MAX)
+            return True
+
+    def get(self, name, namespace=None):
+        """Return the cached object `name`, in `namespace` if the informer is not bound to one.
+        """
+        if self.namespace is None and namespace:
+            name = f"{namespace}/{name}"
+        with self._cond:
+            return self._objects.get(name)
+
+    def by_label(self, label, value, namespace=None):
+        """Return the cached objects whose `label` label is equal to `value`.
+
+            Args:
+                label: One of the `index_labels` of this informer
+                value: The label value to match
+                namespace: The namespace of the objects, if the informer is not bound to one
+
+            Returns:
+                List. The matching objects
+        """
+        with self._cond:
+            return list(self._indexes[label].get(self.index_key(value, namespace), {}).values())
+
+    def list(self):
+        with self._cond:
+            return list(self._objects.values())
+
+
+class ClusterCache:
+    """
+    Shared in-memory view of the pods and services of the jobs.
+
+    A single instance is created by the `DLOperator`, so that reconciling a job does not
+    need any API read in the steady state. With a single namespace, the informers only
+    watch that namespace. Otherwise one cluster-wide watch per resource follows the
+    pods and services labeled with a `job_name`, whatever their namespace.
+
+    Lookups are made in `namespace`: every `DLJob` and `Replica` is handed a view of the
+    shared cache bound to the namespace of its job (see `for_namespace`).
+    """
+
+    def __init__(self, core_v1_client, namespaces=settings.WATCH_NAMESPACES, informer_class=Informer):
+        """
+        :param namespaces: The namespaces of the jobs, or None for all the namespaces
+        :param informer_class: `Informer`, or the `AsyncInformer` of the asyncio engine
+        """
+        if namespaces is not None and len(namespaces) == 1:
+            self.namespace = namespaces[0]
+            self.pods = informer_class(core_v1_client.list_namespaced_pod, self.namespace,
+                                       index_labels=("job_name", "pod_name"))
+            self.services = informer_class(core_v1_client.list_namespaced_service, self.namespace,
+                                           index_labels=("job_name", "service_name"))
+        else:
+            self.namespace = None
+            self.pods = informer_class(core_v1_client.list_pod_for_all_namespaces, None,
+                                       index_labels=("job_name", "pod_name"), label_selector="job_name")
+            self.services = informer_class(core_v1_client.list_service_for_all_namespaces, None,
+                                           index_labels=("job_name", "service_name"), label_selector="job_name")
+
+    def for_namespace(self, namespace):
+        """A view of this cache, sharing its informers, whose lookups are made in `namespace`.
+        """
+        view = copy.copy(self)
+        view.namespace = namespace
+        return view
+
+    def start(self):
+        self.pods.start()
+        self.services.start()
+
+    def stop(self):
+        self.pods.stop()
+        self.services.stop()
+
+    def wait_for_sync(self, timeout=None):
+        return self.pods.wait_for_sync(timeout) and self.services.wait_for_sync(timeout)
+
+    def get_pods(self, job_name):
+        return self.pods.by_label("job_name", job_name, self.namespace)
+
+    def get_pod(self, pod_name):
+        """Return the pod labeled with `pod_name`, or None if it does not exist.
+        """
+        pods = self.pods.by_label("pod_name", pod_name, self.namespace)
+        if len(pods) > 1:
+            logger.warning(f"Multiple pods found with label pod_name={pod_name}")
+        return pods[0] if pods else None
+
+    def get_services(self, job_name):
+        return self.services.by_label("job_name", job_name, self.namespace)
+
+    def get_service(self, service_name):
+        services = self.services.by_label("service_name", service_name, self.namespace)
+        if len(services) > 1:
+            logger.warning(f"Multiple services found with label service_name={service_name}")
+        return services[0] if services else None
+
+    def wait_for_pods_deleted(self, pod_names, timeout=settings.DELETE_TIMEOUT):
+        return self.pods.wait_for(lambda: not any(self.pods.get(name, self.namespace) for name in pod_names),
+                                  timeout)
+
+    def wait_for_services_deleted(self, service_names, timeout=settings.DELETE_TIMEOUT):
+        return self.services.wait_for(
+            lambda: not any(self.services.get(name, self.namespace) for name in service_names), timeout)
+
+    def wait_for_pod_ip(self, pod_name, timeout=settings.POD_IP_TIMEOUT):
+        """Wait for the pod labeled with `pod_name` to be assigned an IP address.
+
+            Returns:
+                String. The pod IP, or None if no IP was assigned within `timeout` seconds
+        """
+        def pod_ip():
+            pod = self.get_pod(pod_name)
+            return pod.status.pod_ip if pod is not None and pod.status else None
+
+        if self.pods.wait_for(pod_ip, timeout):
+            return pod_ip()
+        return None
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import random
+import socket
+import threading
+import functools
+from collections import deque
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
+
+import metrics
+import tracing
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def load_configuration():
+    """Load the in-cluster configuration, or the kube config outside of a cluster.
+    """
+    if 'KUBERNETES_PORT' in os.environ:
+        config.load_incluster_config()
+    else:
+        config.load_kube_config()
+    # newer clients no longer copy the loaded configuration in `Configuration()`
+    if hasattr(client.Configuration, "get_default_copy"):
+        configuration = client.Configuration.get_default_copy()
+    else:
+        configuration = client.Configuration()
+    configuration.assert_hostname = False
+    return configuration
+
+
+class PooledApiClient(client.ApiClient):
+    """
+    ApiClient shared by all the components of the operator.
+
+    A single instance owns a single urllib3 connection pool, so that connections to the
+    API server are kept alive and reused across jobs and replicas instead of being opened
+    by every new client. Requests that do not set `_request_timeout` get the default
+    timeouts defined in `settings`.
+    """
+
+    def __init__(self, configuration=None):
+        if configuration is None:
+            configuration = client.Configuration()
+        configuration.connection_pool_maxsize = settings.CONNECTION_POOL_MAXSIZE
+        super(PooledApiClient, self).__init__(configuration=configuration)
+
+        if settings.TCP_KEEPALIVE:
+            # applied to every connection the pool opens from now on
+            self.rest_client.pool_manager.connection_pool_kw['socket_options'] = \
+                HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def call_api(self, *args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            kwargs['_request_timeout'] = (settings.API_CONNECT_TIMEOUT, settings.API_READ_TIMEOUT)
+        return super(PooledApiClient, self).call_api(*args, **kwargs)
+
+    def connection_stats(self):
+        """Counters of the connections opened by the pool.
+
+            Returns:
+                Dict. Number of requests sent, connections opened and requests that
+                reused an already open connection
+        """
+        pools = self.rest_client.pool_manager.pools
+        requests = connections = 0
+        for key in pools.keys():
+            pool = pools[key]
+            requests += pool.num_requests
+            connections += pool.num_connections
+        return {
+            "requests": requests,
+            "connections": connections,
+            "reused": requests - connections
+        }
+
+
+def watch_timeout():
+    """The `_request_timeout` of watch requests, which stay open for up to `settings.WATCH_TIMEOUT`.
+    """
+    return settings.API_CONNECT_TIMEOUT, settings.WATCH_TIMEOUT + settings.API_READ_TIMEOUT
+
+
+class TokenBucket:
+    """
+    Client-side rate limiter allowing `qps` requests per second on average,
+    with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, possibly in advance.
+
+            Returns:
+                Float. Seconds the caller has to wait before sending its request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.qps)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.qps
+
+    def acquire(self):
+        """Block until a request can be sent.
+
+            Returns:
+                Float. Seconds waited
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class RetryBudget:
+    """
+    Maximum number of retries one job can spend in a sliding time window, so that
+    a job failing repeatedly does not keep the API server busy with retries.
+    """
+
+    def __init__(self, retries=None, period=None):
+        self.retries = settings.JOB_RETRY_BUDGET if retries is None else retries
+        self.period = settings.JOB_RETRY_BUDGET_PERIOD if period is None else period
+        self._spent = deque()
+        self._lock = threading.Lock()
+
+    def spend(self):
+        """Take one retry from the budget.
+
+            Returns:
+                Bool. False if the budget is exhausted
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._spent and now - self._spent[0] > self.period:
+                self._spent.popleft()
+            if len(self._spent) >= self.retries:
+                return False
+            self._spent.append(now)
+            return True
+
+
+class RequestStats:
+    """
+    Counters of the API calls sent through the request layer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "throttled": 0,
+            "throttled_seconds": 0.0,
+            "retries": 0,
+            "budget_exhausted": 0,
+            "failures": 0
+        }
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+# shared by all the request layers of the process
+request_stats = RequestStats()
+
+metrics.Counter("dljob_api_throttled_total", "Requests delayed by the client-side rate limiter") \
+    .set_function(lambda: request_stats.snapshot()["throttled"])
+metrics.Counter("dljob_api_throttled_seconds_total", "Time requests spent waiting for the rate limiter") \
+    .set_function(lambda: request_stats.snapshot()["throttled_seconds"])
+metrics.Counter("dljob_api_retries_total", "Failed requests sent again") \
+    .set_function(lambda: request_stats.snapshot()["retries"])
+metrics.Counter("dljob_api_retry_budget_exhausted_total", "Failed requests not retried because of the job retry budget") \
+    .set_function(lambda: request_stats.snapshot()["budget_exhausted"])
+
+
+def is_retriable(e):
+    """Whether the failed request may succeed if sent again.
+    """
+    if e.status in settings.API_RETRY_STATUSES:
+        return True
+    if e.status == 409:
+        # AlreadyExists is a 409 as well, retry only update conflicts
+        try:
+            return json.loads(e.body)["reason"] == "Conflict"
+        except (TypeError, ValueError, KeyError):
+            return False
+    return False
+
+
+def already_created(func, attempt, e):
+    """Whether a create failed with AlreadyExists only because a previous attempt of the same
+    request succeeded, e.g. the object was stored but the response was lost in a 5xx.
+    """
+    if attempt == 0 or e.status != 409 or not func.__name__.startswith("create_"):
+        return False
+    try:
+        return json.loads(e.body)["reason"] == "AlreadyExists"
+    except (TypeError, ValueError, KeyError):
+        return False
+
+
+def retry_delay(attempt, e):
+    """Jittered exponential backoff, honouring the Retry-After header of throttled responses.
+    """
+    delay = min(settings.API_RETRY_MAX_DELAY, settings.API_RETRY_BASE_DELAY * 2 ** attempt)
+    retry_after = (e.headers or {}).get("Retry-After")
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    # "full jitter": spread the retries of the clients failing at the same time
+    return random.uniform(0, delay)
+
+
+class RequestLayer:
+    """
+    Wraps an API object (e.g. `CoreV1Api`) so that every call goes through a shared
+    rate limiter, and calls failing with a 429, a 5xx or an update conflict are
+    retried with jittered exponential backoff, within the retry budget of the job
+    (if any). Other attributes of the API object are returned as they are.
+
+    A retried create answered with AlreadyExists returns None: the object was created
+    by one of the previous attempts.
+    """
+
+    def __init__(self, api, limiter, budget=None, stats=request_stats):
+        self.api = api
+        self.limiter = limiter
+        self.budget = budget
+        self.stats = stats
+
+    def with_budget(self, budget):
+        """Return a request layer sharing the same API object and rate limiter, limited by `budget`.
+        """
+        return RequestLayer(self.api, self.limiter, budget, self.stats)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        # keep name, docstring and signature, they are inspected by `watch.Watch`
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self.call(attr, *args, **kwargs)
+        return call
+
+    def observe(self, func, kwargs, start, code):
+        """Record the latency and the status code of one request.
+        """
+        verb, resource = metrics.verb_and_resource(func.__name__)
+        if kwargs.get("watch"):
+            verb = "watch"
+        metrics.API_REQUESTS.labels(verb, resource, code).inc()
+        metrics.API_REQUEST_DURATION.labels(verb, resource).observe(time.monotonic() - start)
+
+    def call(self, func, *args, **kwargs):
+        # only traced as part of a larger operation, e.g. not the requests of the informers
+        with tracing.span(f"api.{func.__name__}", root=False) as span:
+            attempt = 0
+            throttled = 0.0
+            while True:
+                waited = self.limiter.acquire()
+                if waited > 0:
+                    throttled += waited
+                    self.stats.inc("throttled")
+                    self.stats.inc("throttled_seconds", waited)
+                self.stats.inc("calls")
+                start = time.monotonic()
+                try:
+                    result = func(*args, **kwargs)
+                    self.observe(func, kwargs, start, 200)
+                    span.set(code=200, retries=attempt, throttled=round(throttled, 6))
+                    return result
+                except ApiException as e:
+                    self.observe(func, kwargs, start, e.status)
+                    span.set(code=e.status, retries=attempt, throttled=round(throttled, 6))
+                    if already_created(func, attempt, e):
+                        logger.info(f"{func.__name__}: created by a previous attempt")
+                        return None
+                    if kwargs.get("watch") or not is_retriable(e) or attempt >= settings.API_MAX_RETRIES:
+                        self.stats.inc("failures")
+                        raise
+                    if self.budget is not None and not self.budget.spend():
+                        logger.warning(f"{func.__name__}: retry budget exhausted")
+                        self.stats.inc("budget_exhausted")
+                        self.stats.inc("failures")
+                        raise
+                    delay = retry_delay(attempt, e)
+                    logger.warning(f"{func.__name__} failed with {e.status}, retrying in {delay:.2f}s")
+                    self.stats.inc("retries")
+                    attempt += 1
+                    time.sleep(delay)
@@ -1,5 +1,14 @@
+import sys
+import asyncio
+
+from kubernetes import client
+
+import metrics
+import tracing
 import settings.settings as settings
 from controller import DLOperator
+from election import LeaderElector, operator_identity
+from kube_client import PooledApiClient, load_configuration
 
 import logging
 from logging.config import fileConfig
@@ -10,8 +19,42 @@ fileConfig("logging.ini")
 
 if __name__ == "__main__":
     logging.getLogger("kubernetes").setLevel(logging.CRITICAL)
+    if settings.METRICS_PORT is not None:
+        metrics.start_server()
+    tracing.configure()
     logger.info("Creating Controller...")
-    controller = DLOperator()
-    controller.create_crd(crd_path=settings.CRD)
-    # controller.create_dljob()
-    controller.watch_crd()
\ No newline at end of file
+    if settings.ENGINE == "asyncio" and (settings.LEADER_ELECTION or settings.SHARDED):
+        raise Exception("Leader election and sharding are only supported by the threads engine")
+    if settings.ENGINE == "asyncio":
+        from async_controller import AsyncDLOperator
+        logging.getLogger("kubernetes_asyncio").setLevel(logging.CRITICAL)
+        asyncio.run(AsyncDLOperator().run())
+    elif settings.LEADER_ELECTION:
+        def lead():
+            try:
+                controller = DLOperator()
+                controller.create_crds()
+                controller.run()
+            finally:
+                # a leader that is not managing the jobs must let another replica take over
+                elector.stop()
+
+        def stop_leading():
+            # another replica may already be managing the jobs, stop right away
+            logger.error("Not leading anymore, exiting")
+            elector.release()
+            sys.exit(1)
+
+        # the Lease is renewed with its own client, not slowed down by the rate limiter of the jobs
+        api = client.CoordinationV1Api(PooledApiClient(configuration=load_configuration()))
+        elector = LeaderElector(api, settings.LEASE_NAME, operator_identity())
+        elector.run(on_started_leading=lead, on_stopped_leading=stop_leading)
+    else:
+        controller = DLOperator()
+        controller.create_crds()
+        # controller.create_dljob()
+        try:
+            controller.run()
+        finally:
+            if controller.shards is not None:
+                controller.shards.stop()
@@ -0,0 +1,235 @@
+import os
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+# default buckets (seconds) of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """
+    One metric family in the Prometheus text format, with one child per combination
+    of label values. A metric without labels can also be computed at scrape time by
+    passing a function to `set_function`.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        self._function = None
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Return the child of the metric with the given label values, creating it if needed.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        values = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self.new_child()
+            return child
+
+    def set_function(self, function):
+        self._function = function
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        :return: The list of (suffix, labels, value) samples of the metric
+        """
+        if self._function is not None:
+            return [("", {}, self._function())]
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for values, child in children:
+            labels = dict(zip(self.labelnames, values))
+            samples.extend((suffix, {**labels, **extra}, value) for suffix, extra, value in child.samples())
+        return samples
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, labels, value in self.samples():
+            if labels:
+                label_str = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+                lines.append(f"{self.name}{suffix}{{{label_str}}} {value}")
+            else:
+                lines.append(f"{self.name}{suffix} {value}")
+        return "\n".join(lines)
+
+
+class Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def samples(self):
+        return [("", {}, self.value)]
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if i < len(self.buckets):
+                self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            samples.append(("_bucket", {"le": str(bound)}, cumulative))
+        samples.append(("_bucket", {"le": "+Inf"}, count))
+        samples.append(("_sum", {}, total))
+        samples.append(("_count", {}, count))
+        return samples
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def new_child(self):
+        return Value()
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def new_child(self):
+        return Value()
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# every metric of the process, in creation order
+REGISTRY = []
+
+RECONCILE_DURATION = Histogram("dljob_reconcile_duration_seconds",
+                               "Time spent reconciling all the replicas of a job", ("job_type",))
+TIME_TO_RUNNING = Histogram("dljob_time_to_running_seconds",
+                            "Time from the start of a job until all its replicas are running", ("job_type",),
+                            buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800))
+API_REQUESTS = Counter("dljob_api_requests_total",
+                       "Requests sent to the API server", ("verb", "resource", "code"))
+API_REQUEST_DURATION = Histogram("dljob_api_request_duration_seconds",
+                                 "Latency of the requests sent to the API server", ("verb", "resource"))
+WATCH_RECONNECTS = Counter("dljob_watch_reconnects_total",
+                           "Watch streams opened again after ending or failing", ("resource",))
+JOBS = Gauge("dljob_jobs", "Jobs tracked by the operator")
+REPLICAS = Gauge("dljob_replicas", "Replicas of the jobs tracked by the operator")
+QUEUE_DEPTH = Gauge("dljob_queue_depth", "Jobs waiting in the work queue")
+# connection pool of the API client, set by the operator from its client
+POOL_REQUESTS = Gauge("dljob_api_pool_requests", "Requests sent through the connection pool of the API client")
+POOL_CONNECTIONS = Gauge("dljob_api_pool_connections_opened", "Connections opened to the API server by the pool")
+POOL_REUSED = Gauge("dljob_api_pool_connections_reused", "Requests sent on a connection already open")
+
+
+def export_connection_stats(connection_stats):
+    """Compute the connection pool gauges at scrape time.
+
+        Args:
+            connection_stats: Function returning the `requests`, `connections` and `reused` counters of the pool
+    """
+    POOL_REQUESTS.set_function(lambda: connection_stats()["requests"])
+    POOL_CONNECTIONS.set_function(lambda: connection_stats()["connections"])
+    POOL_REUSED.set_function(lambda: connection_stats()["reused"])
+
+
+def verb_and_resource(func_name):
+    """Split the name of a client method in the verb and the resource it acts on.
+
+        e.g. `delete_collection_namespaced_pod` -> (`deletecollection`, `pod`)
+    """
+    verb, _, rest = func_name.replace("_for_all_namespaces", "").partition("_")
+    parts = rest.split("_")
+    if parts and parts[0] == "collection":
+        verb += "collection"
+        parts = parts[1:]
+    if parts and parts[0] in ("namespaced", "cluster"):
+        parts = parts[1:]
+    return verb, "_".join(parts) or verb
+
+
+def render():
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are too frequent for the operator log
+        logger.debug(format % args)
+
+
+def start_server(port=settings.METRICS_PORT, address=settings.METRICS_ADDRESS):
+    """Serve the metrics on `http://address:port/metrics` from a daemon thread.
+
+        Returns:
+            The HTTP server
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{address}:{server.server_address[1]}/metrics")
+    return server
@@ -1,159 +1,184 @@
 import os
 from kubernetes import client
+from kubernetes.client.rest import ApiException
 
+import tracing
 import settings.settings as settings
 
 import logging
 logger = logging.getLogger(os.path.basename(__file__))
 
 
+def pod_failed(pod):
+    """Whether the pod terminated and will not be restarted (e.g. evicted).
+    """
+    return pod.status is not None and pod.status.phase == "Failed"
+
+
 class Replica:
     """
     This class defines the properties and the behavior of one replica in the cluster.
+
+    A job can have tens of thousands of replicas, so a replica only holds its index, name,
+    type and the shared template of its type, in `__slots__`. The client, the cache, the
+    namespace and the environment are read from the job, and the pod and service
+    manifests are only built when they are created.
     """
-    def __init__(self, uid, replica_name, replica_type, job_name, template, **kwargs):
-        # environment_variables=None, volumes=None, ports=None
+    __slots__ = ("uid", "replica_name", "replica_type", "job", "template", "scheduler_ip")
+
+    def __init__(self, uid, replica_name, replica_type, job, template):
         self.uid = uid
         self.replica_name = replica_name
         self.replica_type = replica_type
-        self.job_name = job_name
+        # the DLJob the replica belongs to
+        self.job = job
+        # PodTemplate shared by all the replicas of this type
         self.template = template
-        self.status = "None"
         self.scheduler_ip = ""
 
-        # TODO: create a function to check these parameters
-        self.container_params = kwargs
-        # self.environment_variables = kwargs['environment_variables']
-        # self.volumes = kwargs['volumes']
-        # self.ports = kwargs['ports']
+    @property
+    def job_name(self):
+        return self.job.job_name
+
+    @property
+    def namespace(self):
+        return self.job.namespace
+
+    @property
+    def cache(self):
+        return self.job.cache
+
+    @property
+    def api_instance(self):
+        return self.job.core_v1_client
 
-        self.api_instance = client.CoreV1Api()
+    @property
+    def ports(self):
+        """The ports exposed to the other replicas through the service of the replica, if any.
+        """
+        return self.job.container_properties.get('ports')
 
     def reconcile(self):
         """Check the current status of the replica and match it against the desired state.
         """
         logger.info(f"Reconcile replica {self.replica_name} with type {self.replica_type}")
-        # check if pod with current replica name already exists using selector with replica name
-        # selector = client.V1LabelSelector(match_labels={"pod_name": self.replica_name})
-        selector = f"pod_name={self.replica_name}"
-        # returns a V1PodList object
-        pod_list = self.api_instance.list_namespaced_pod(settings.NAMESPACE, label_selector=selector)
-
-        if len(pod_list.items) == 0:
-            self.create_replica()
-        elif len(pod_list.items) > 1:
-            # this should not happen. The operator should make sure that a single
-            # pod with that label name is created.
-            assert False
-        else:
-            # TODO: should check the status of the replica here
-            pod = pod_list.items[0]
-            assert pod.metadata.labels['pod_name'] == self.replica_name
-            logger.info("Replica pod already exist. Checking the current status...")
-            pass
+        with tracing.span("replica.reconcile", replica=self.replica_name):
+            # check if pod with current replica name already exists in the shared cache
+            pod = self.observe()
+
+            if pod is None and not self.job.creation_pending(self.replica_name):
+                self.create_replica()
+            elif pod is not None and pod_failed(pod):
+                # the pod is created again by the reconcile triggered by its deletion
+                logger.warning(f"Replica pod {self.replica_name} failed ({pod.status.reason}), deleting it")
+                self.api_instance.delete_namespaced_pod(self.replica_name, self.namespace,
+                                                        body=client.V1DeleteOptions())
+            else:
+                # TODO: should check the status of the replica here
+                # (or created by a previous sync, and not in the cache yet)
+                logger.info("Replica pod already exist. Checking the current status...")
+                if self.replica_type == "SCHEDULER" and not self.scheduler_ip:
+                    # e.g. adopted while Pending, or its IP wait timed out in a previous sync
+                    self.wait_for_scheduler_ip()
+
+    def observe(self):
+        """Load the current state of the replica from the shared cache.
+
+            Returns:
+                The pod of this replica, or None if it does not exist
+        """
+        pod = self.cache.get_pod(self.replica_name)
+        if pod is not None and self.replica_type == "SCHEDULER" and pod.status and pod.status.pod_ip:
+            self.scheduler_ip = pod.status.pod_ip
+        return pod
 
     def create_replica(self):
         self.create_pod()
-        # in case the pod needs to expose some ports
-        if 'ports' in self.container_params:
-            self.create_service(ports=self.container_params['ports'])
+        # in case the pod needs to expose some ports, and the service is not left from a previous pod
+        if self.ports is not None and self.cache.get_service(f"{self.replica_name}-service") is None:
+            self.create_service(ports=self.ports)
 
+    @tracing.traced("replica.create_pod")
     def create_pod(self):
-        pod = client.V1Pod()
-        pod.metadata = client.V1ObjectMeta(
-            name=self.replica_name,
-            labels={"pod_name": self.replica_name,
-                    "job_name": self.job_name})
-
-        container_spec = self.template["spec"]["containers"][0]
-        # add container properties to container spec
-        if 'env' in self.container_params:
-            # add env variables to container_spec
-            container_spec['env'] = [
-                client.V1EnvVar(name=k, value=str(v))
-                for k, v in self.container_params['env'].items()
-            ]
-        if 'volumes' in self.container_params:
-            # add volumes spec to container
-            # TODO: look at how to mount a volume (volumeMounts vs volumeDevices?)
-            container_spec['volumeMounts'] = []
-
-        # V1Container accepts keys defined in V1Container.attribute_map.
-        # The current spec is defined with camel case keys, so we need to map back
-        # to underscore keys.
-        inv_map = {
-            k: container_spec[v]
-            for k, v in client.V1Container.attribute_map.items()
-            if v in container_spec
-        }
-        pod_spec = client.V1PodSpec(containers=[client.V1Container(**inv_map)], hostname=self.replica_name)
-
-        pod.spec = pod_spec
-        self.api_instance.create_namespaced_pod(namespace=settings.NAMESPACE, body=pod)
-        logger.info(f"Created Pod for replica {self.replica_name} with container spec {inv_map}")
+        pod = self.build_pod()
+        try:
+            self.api_instance.create_namespaced_pod(namespace=self.namespace, body=pod)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            # created by a previous sync, before the cache received it
+            logger.info(f"Pod of replica {self.replica_name} already exists")
+        else:
+            logger.info(f"Created Pod for replica {self.replica_name}")
+        self.job.expect_pod(self.replica_name)
+        logger.debug(f"Container spec of {self.replica_name}: {pod['spec']['containers'][0]}")
+
+        if self.replica_type == "SCHEDULER":
+            self.wait_for_scheduler_ip()
 
+    def wait_for_scheduler_ip(self):
+        """Wait for the pod of this scheduler replica to be assigned an IP address.
+        """
         # TODO: Need to solve the Hostname resolve. Now only solution is to use direct IP address.
         # if scheduler, we need to get scheduler IP address and inject it in the other pods.
-        if self.replica_type == "SCHEDULER":
-            selector = f"pod_name={self.replica_name}"
-            pod_list = client.models.v1_pod_list.V1PodList(items=[])
-            while len(pod_list.items) == 0:
-                pod_list = self.api_instance.list_namespaced_pod(settings.NAMESPACE, label_selector=selector)
-                self.scheduler_ip = pod_list.items[0].status.pod_ip
+        with tracing.span("replica.wait_for_pod_ip"):
+            self.scheduler_ip = self.cache.wait_for_pod_ip(self.replica_name) or ""
+        if not self.scheduler_ip:
+            logger.error(f"Scheduler pod {self.replica_name} has no IP after {settings.POD_IP_TIMEOUT} seconds")
+            raise TimeoutError(f"Scheduler pod {self.replica_name} was not assigned an IP")
+
+    def build_pod(self):
+        """Build the pod manifest of this replica, without sending it to the cluster.
+        The environment is computed from the current spec of the job.
+
+            Returns:
+                Dict. The pod to be created
+        """
+        return self.template.pod(self.replica_name, self.job.replica_environment(self))
 
+    @tracing.traced("replica.create_service")
     def create_service(self, ports):
         """Creates an tandem network service for this replica.
 
             Args:
                 ports: The ports to be exposed to the other replicas
         """
-        service = client.V1Service()
-        service.api_version = "v1"
-        service.kind = "Service"
-        service.metadata = client.V1ObjectMeta(name=f"{self.replica_name}-service",
-                                               labels={"service_name": f"{self.replica_name}-service",
-                                                       "job_name": self.job_name}
-                                               )
-        # Set Service object to target port on any Pod with that label.
-        # The label selection allows Kubernetes to determine which Pod
-        # should receive traffic when the service is used.
-        spec = client.V1ServiceSpec()
-        spec.selector = {"pod_name": self.replica_name}
-        spec.ports = [
-            client.V1ServicePort(name="dlport{}".format(i), port=port)
-            for i, port in enumerate(ports)
-        ]
-        service.spec = spec
-        self.api_instance.create_namespaced_service(namespace=settings.NAMESPACE, body=service)
+        service = self.build_service(ports)
+        try:
+            self.api_instance.create_namespaced_service(namespace=self.namespace, body=service)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            logger.info(f"Service of replica {self.replica_name} already exists")
+
+    def build_service(self, ports):
+        """Build the service manifest of this replica, without sending it to the cluster.
+
+            Args:
+                ports: The ports to be exposed to the other replicas
+
+            Returns:
+                Dict. The service to be created
+        """
+        return self.template.service(self.replica_name, ports)
 
     def clean_up(self):
         logger.info(f"Deleting pod {self.replica_name}...")
-        selector = f"pod_name={self.replica_name}"
-        pod_list = self.api_instance.list_namespaced_pod(settings.NAMESPACE, label_selector=selector)
-        if len(pod_list.items) == 0:
+        if self.cache.get_pod(self.replica_name) is None:
             logging.warning(f"No pod with name {self.replica_name} found during clean up")
-            return
-        if len(pod_list.items) > 1:
-            logging.warning(f"Multiple pods found with labels name {self.replica_name} found during clean up")
-            assert False
-        self.api_instance.delete_namespaced_pod(
-            self.replica_name,
-            settings.NAMESPACE,
-            body=client.V1DeleteOptions())
+        else:
+            self.api_instance.delete_namespaced_pod(
+                self.replica_name,
+                self.namespace,
+                body=client.V1DeleteOptions())
 
         logger.info(f"Deleting service {self.replica_name}-service...")
-        selector = f"service_name={self.replica_name}-service"
-        service_list = self.api_instance.list_namespaced_service(settings.NAMESPACE, label_selector=selector)
-        if len(service_list.items) == 0:
+        if self.cache.get_service(f"{self.replica_name}-service") is None:
             logging.warning(f"No service with name {self.replica_name}-service found during clean up")
             return
-        if len(service_list.items) > 1:
-            logging.warning(
-                f"Multiple services found with labels name {self.replica_name}-service found during clean up")
-            assert False
         self.api_instance.delete_namespaced_service(
             f"{self.replica_name}-service",
-            settings.NAMESPACE,
+            self.namespace,
             body=client.V1DeleteOptions())
 
     def get_uid(self):
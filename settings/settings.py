@@ -1,5 +1,94 @@
 NAMESPACE = "default"
 DOMAIN = "mpba.fbk.eu"
-CRD = "./crds/crd/mxjob.yml"
-CRD_NAME_SINGULAR = "mxjob"
-CRD_NAME_PLURAL = "mxjobs"
\ No newline at end of file
+# directory of the CustomResourceDefinitions, one <kind>.yml per job kind (see dl_job.job_kinds)
+CRD_DIR = "./crds/crd"
+# namespaces whose jobs are managed (None for all the namespaces of the cluster)
+WATCH_NAMESPACES = [NAMESPACE]
+# timeout (seconds) of a single watch request before it is re-established
+WATCH_TIMEOUT = 300
+# seconds to wait before restarting a failed watch
+INFORMER_RETRY_PERIOD = 5
+# seconds to wait for the pod and service caches to be loaded at startup
+CACHE_SYNC_TIMEOUT = 60
+# number of threads reconciling jobs in parallel
+WORKERS = 4
+# seconds to wait for the pods and services of a job to be deleted
+DELETE_TIMEOUT = 120
+# seconds to wait for a pod to be assigned an IP address
+POD_IP_TIMEOUT = 300
+# seconds after which a pod created by the operator but never seen in the pod cache is created again
+EXPECTATION_TIMEOUT = 300
+# initial and maximum delay (seconds) between checks while waiting on the cache
+WAIT_BACKOFF_BASE = 0.5
+WAIT_BACKOFF_MAX = 10
+# maximum number of replicas of a job created in parallel
+REPLICA_CREATION_WORKERS = 16
+# execution engine: "threads" (controller.DLOperator) or
+# "asyncio" (async_controller.AsyncDLOperator, requires kubernetes_asyncio)
+ENGINE = "threads"
+# connections kept open to the API server, one per thread that can issue requests
+CONNECTION_POOL_MAXSIZE = WORKERS * REPLICA_CREATION_WORKERS
+# enable TCP keep-alive probes on the API server connections
+TCP_KEEPALIVE = True
+# default connect and read timeouts (seconds) of API requests
+API_CONNECT_TIMEOUT = 10
+API_READ_TIMEOUT = 60
+# publish the cluster topology of a job once in a ConfigMap, instead of
+# repeating it in the env of every replica
+TOPOLOGY_CONFIGMAP = False
+# where the topology ConfigMap is mounted in the replicas
+TOPOLOGY_MOUNT_PATH = "/etc/dljob"
+# on startup adopt the jobs that are already running instead of deleting and
+# recreating them; the resources of the jobs are also left running on shutdown
+WARM_START = False
+# client-side rate limit of the API requests: average requests per second and burst
+API_QPS = 50
+API_BURST = 100
+# status codes of the API requests to retry (update conflicts are retried as well)
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+API_MAX_RETRIES = 5
+# base and maximum delay (seconds) of the exponential backoff between retries
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 30
+# retries one job can spend every JOB_RETRY_BUDGET_PERIOD seconds
+JOB_RETRY_BUDGET = 50
+JOB_RETRY_BUDGET_PERIOD = 60
+# address and port of the Prometheus metrics endpoint (None disables it)
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_PORT = 8000
+# run as one of several operator replicas, electing a leader through a Lease
+LEADER_ELECTION = False
+# run as one of several operator replicas, each owning the jobs whose name hashes to it
+SHARDED = False
+# name of the leader Lease, and prefix of the member Leases of the sharded mode
+LEASE_NAME = "dljob-operator"
+# identity of this replica in the Leases (default: hostname and pid)
+OPERATOR_ID = None
+# seconds a Lease is valid without renewal, seconds a leader keeps trying to renew it,
+# and seconds between two attempts to acquire or renew it
+LEASE_DURATION = 15
+LEASE_RENEW_DEADLINE = 10
+LEASE_RETRY_PERIOD = 2
+# seconds between two checks of a running job (0 disables them), spread by up to
+# RESYNC_JITTER times the period so that the jobs are not all checked at once
+RESYNC_PERIOD = 60
+RESYNC_JITTER = 0.2
+# initial and maximum delay (seconds) before a job whose sync failed is synced again
+REQUEUE_BACKOFF_BASE = 1
+REQUEUE_BACKOFF_MAX = 300
+# admit a job only when all its replicas fit in the free capacity of the nodes,
+# the other jobs wait in a priority queue (needs permission to list and watch
+# the nodes and the pods of all the namespaces), not supported with SHARDED
+GANG_ADMISSION = False
+# annotation of the job custom resources with their admission priority (an integer, default 0)
+PRIORITY_ANNOTATION = f"{DOMAIN}/priority"
+# seconds during which the status changes of a job are merged in one write of the
+# status subresource of its custom resource (0 disables the status updates)
+STATUS_UPDATE_PERIOD = 2
+# JSON lines file the trace spans of the jobs are appended to (None disables the tracing),
+# see `python tracing.py <file>` to print the timeline of every job
+TRACE_FILE = None
+# seconds between two samples of the stacks of all the threads (None disables the profiler),
+# and file the samples are written to in the folded format of flame graph tools
+PROFILE_INTERVAL = None
+PROFILE_FILE = "profile.folded"
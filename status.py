@@ -0,0 +1,109 @@
+import os
+import threading
+
+from kubernetes.client.rest import ApiException
+
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def merge_diff(old, new):
+    """The JSON merge patch (RFC 7386) turning `old` into `new`, empty if they are equal.
+    """
+    patch = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            nested = merge_diff(old[key], value)
+            if nested:
+                patch[key] = nested
+        elif key not in old or old[key] != value:
+            patch[key] = value
+    return patch
+
+
+class StatusWriter:
+    """
+    Coalescing writer of the status subresource of the job custom resources.
+
+    Changes only mark a job as dirty. Every `period` seconds the status of the dirty
+    jobs is computed once and written with a merge patch carrying only the fields that
+    differ from the last written status, so that the many pod events of a starting job
+    result in a few small writes, and a job whose status did not change costs none.
+    """
+
+    def __init__(self, status_func, patch_func, period=settings.STATUS_UPDATE_PERIOD):
+        """
+        :param status_func: Called with a job key, returns the (custom resource, status) of
+            the job, or None if this operator must not write its status
+        :param patch_func: Called with the custom resource and the merge patch to apply to it
+        """
+        self.status_func = status_func
+        self.patch_func = patch_func
+        self.period = period
+        self._lock = threading.Lock()
+        self._dirty = set()
+        # key -> status as last written
+        self._written = dict()
+        self._stopped = threading.Event()
+
+    def touch(self, key):
+        """Schedule the status of `key` to be written at the end of the current period.
+        """
+        with self._lock:
+            self._dirty.add(key)
+
+    def forget(self, key):
+        with self._lock:
+            self._dirty.discard(key)
+            self._written.pop(key, None)
+
+    def changes(self):
+        """Compute the status of the dirty jobs.
+
+            Returns:
+                List. (key, custom resource, status, merge patch) of the jobs whose status changed
+        """
+        with self._lock:
+            keys, self._dirty = self._dirty, set()
+        changes = []
+        for key in keys:
+            current = self.status_func(key)
+            if current is None:
+                continue
+            obj, status = current
+            # after a restart, the status observed in the custom resource was the last written
+            patch = merge_diff(self._written.get(key, obj.get("status") or {}), status)
+            if patch:
+                changes.append((key, obj, status, patch))
+        return changes
+
+    def written(self, key, status):
+        with self._lock:
+            self._written[key] = status
+
+    def flush(self):
+        for key, obj, status, patch in self.changes():
+            try:
+                self.patch_func(obj, {"status": patch})
+                self.written(key, status)
+            except ApiException as e:
+                if e.status == 404:
+                    # the job was deleted in the meantime
+                    continue
+                logger.exception(f"Failed to write the status of job {key}")
+                self.touch(key)
+            except Exception:
+                logger.exception(f"Failed to write the status of job {key}")
+                self.touch(key)
+
+    def start(self):
+        threading.Thread(target=self.run, name="status-writer", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.period):
+            self.flush()
@@ -0,0 +1,129 @@
+import os
+from kubernetes import client
+
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+# keys accepted in a container spec (the spec is written with camel case keys)
+CONTAINER_KEYS = frozenset(client.V1Container.attribute_map.values())
+
+
+class PodTemplate:
+    """
+    Pod and service skeleton of one replica type of a job.
+
+    The template of the replica spec is validated and compiled once; the manifests of
+    each replica are then built by adding only the per-replica parts (name, labels and
+    env) to the skeleton. The compiled skeleton is never modified after creation and
+    the template of the job spec is never modified at all.
+    """
+
+    def __init__(self, job_name, replica_type, template, container_properties, topology_configmap=None,
+                 owner_references=None):
+        """
+        :param job_name: Name of the job the replicas belong to
+        :param replica_type: The `replicaType` of the replica spec
+        :param template: The `template` field of the replica spec
+        :param container_properties: The `container_properties` of the job class
+        :param topology_configmap: Name of the ConfigMap with the topology of the job, if any
+        :param owner_references: The ownerReferences of the pods and services, if any
+        """
+        self.job_name = job_name
+        self.replica_type = replica_type
+        self.owner_references = owner_references
+
+        containers = (template.get("spec") or {}).get("containers")
+        if not containers or not isinstance(containers[0], dict):
+            raise Exception(f"Job {job_name}: the {replica_type} template must define at least one container")
+        if len(containers) > 1:
+            logger.warning(f"Job {job_name}: only the first container of the {replica_type} template is used")
+
+        container = dict()
+        for key, value in containers[0].items():
+            if key not in CONTAINER_KEYS:
+                logger.warning(f"Job {job_name}: unknown container key {key} in the {replica_type} template, skipping")
+                continue
+            container[key] = value
+        if 'image' not in container:
+            raise Exception(f"Job {job_name}: the {replica_type} container must define an image")
+        if 'volumes' in container_properties:
+            # TODO: look at how to mount a volume (volumeMounts vs volumeDevices?)
+            container['volumeMounts'] = []
+        self.volumes = None
+        if topology_configmap is not None:
+            # expose the topology both as env variables and as files
+            container['envFrom'] = list(container.get('envFrom', [])) + [
+                {"configMapRef": {"name": topology_configmap}}
+            ]
+            container['volumeMounts'] = list(container.get('volumeMounts', [])) + [
+                {"name": "topology", "mountPath": settings.TOPOLOGY_MOUNT_PATH, "readOnly": True}
+            ]
+            self.volumes = [{"name": "topology", "configMap": {"name": topology_configmap}}]
+        self.container = container
+
+    def pod(self, replica_name, env=None):
+        """Build the pod manifest of one replica.
+
+            Args:
+                replica_name: Name of the pod
+                env: Dictionary of env variables, replacing the env of the template
+
+            Returns:
+                Dict. The pod manifest
+        """
+        container = self.container
+        if env is not None:
+            # shallow copy: only the env differs between replicas
+            container = dict(container)
+            container['env'] = [{"name": k, "value": str(v)} for k, v in env.items()]
+        pod = {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {
+                "name": replica_name,
+                "labels": {"pod_name": replica_name,
+                           "job_name": self.job_name}
+            },
+            "spec": {
+                "containers": [container],
+                "hostname": replica_name
+            }
+        }
+        if self.volumes is not None:
+            pod["spec"]["volumes"] = self.volumes
+        if self.owner_references is not None:
+            pod["metadata"]["ownerReferences"] = self.owner_references
+        return pod
+
+    def service(self, replica_name, ports):
+        """Build the manifest of the network service of one replica.
+
+            Args:
+                replica_name: Name of the pod exposed by the service
+                ports: The ports to be exposed to the other replicas
+
+            Returns:
+                Dict. The service manifest
+        """
+        service_name = f"{replica_name}-service"
+        service = {
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {
+                "name": service_name,
+                "labels": {"service_name": service_name,
+                           "job_name": self.job_name}
+            },
+            # Set Service object to target port on any Pod with that label.
+            # The label selection allows Kubernetes to determine which Pod
+            # should receive traffic when the service is used.
+            "spec": {
+                "selector": {"pod_name": replica_name},
+                "ports": [{"name": f"dlport{i}", "port": port} for i, port in enumerate(ports)]
+            }
+        }
+        if self.owner_references is not None:
+            service["metadata"]["ownerReferences"] = self.owner_references
+        return service
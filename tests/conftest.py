@@ -0,0 +1,44 @@
+import pytest
+from kubernetes import client
+
+import settings.settings as settings
+from benchmark.fake_apiserver import FakeApiServer
+from informer import ClusterCache
+
+
+@pytest.fixture
+def fake_server():
+    """The in-memory fake API server of the benchmark, started on a free port."""
+    server = FakeApiServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def core_v1(fake_server):
+    configuration = client.Configuration()
+    configuration.host = fake_server.url
+    return client.CoreV1Api(client.ApiClient(configuration))
+
+
+@pytest.fixture
+def cache(core_v1):
+    """The shared pod and service cache of the operator, synced with the fake server."""
+    cache = ClusterCache(core_v1)
+    cache.start()
+    assert cache.wait_for_sync(10)
+    yield cache
+    cache.stop()
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    # failed watches are restarted right away, and waits poll often
+    monkeypatch.setattr(settings, "INFORMER_RETRY_PERIOD", 0.1)
+    monkeypatch.setattr(settings, "WAIT_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(settings, "WAIT_BACKOFF_MAX", 0.2)
+
+
+def pod(name, job_name="job", namespace="default"):
+    return {"metadata": {"name": name, "namespace": namespace, "labels": {"job_name": job_name, "pod_name": name}},
+            "spec": {"containers": [{"name": "main", "image": "busybox"}]}}
@@ -0,0 +1,147 @@
+import time
+from decimal import Decimal
+
+import pytest
+
+from admission import GangAdmission, parse_quantity
+from dl_job import MXJob
+from conftest import pod
+
+SYNC_TIMEOUT = 10
+
+
+@pytest.mark.parametrize("quantity, expected", [
+    ("2", Decimal(2)),
+    (2, Decimal(2)),
+    ("500m", Decimal("0.5")),
+    ("1.5k", Decimal(1500)),
+    (".5", Decimal("0.5")),
+    ("1e3", Decimal(1000)),
+    ("4Gi", Decimal(4 * 2 ** 30)),
+    ("128Mi", Decimal(128 * 2 ** 20)),
+    ("1G", Decimal(10 ** 9)),
+])
+def test_parse_quantity(quantity, expected):
+    assert parse_quantity(quantity) == expected
+
+
+@pytest.mark.parametrize("quantity", ["", "4GB", "m", "1.2.3", "Gi4"])
+def test_parse_invalid_quantity(quantity):
+    with pytest.raises(ValueError):
+        parse_quantity(quantity)
+
+
+def node(name, cpu, unschedulable=False):
+    return {"metadata": {"name": name}, "spec": {"unschedulable": unschedulable},
+            "status": {"allocatable": {"cpu": cpu, "memory": "8Gi", "pods": "10"}}}
+
+
+def bound_pod(name, node_name, cpu):
+    obj = pod(name)
+    obj["spec"]["nodeName"] = node_name
+    obj["spec"]["containers"][0]["resources"] = {"requests": {"cpu": cpu}}
+    return obj
+
+
+def cpu(value):
+    return {"cpu": parse_quantity(value), "pods": Decimal(1)}
+
+
+@pytest.fixture
+def admission(fake_server, core_v1):
+    store = fake_server.store
+    store.create("nodes", None, node("node-a", "4"))
+    store.create("nodes", None, node("node-b", "2"))
+    store.create("nodes", None, node("node-c", "64", unschedulable=True))
+    store.create("pods", "default", bound_pod("running", "node-a", "500m"))
+    store.create("pods", "default", bound_pod("other", "node-a", "500m"))
+    store.create("pods", "default", bound_pod("done", "node-b", "2"))
+    with store.cond:
+        # once started by the fake kubelet
+        store.cond.wait_for(lambda: store.objects["pods"][("default", "done")]["status"]["phase"] == "Running",
+                            SYNC_TIMEOUT)
+    store.patch("pods", "default", "done", {"status": {"phase": "Succeeded"}}, "status")
+    admission = GangAdmission(core_v1, on_change=lambda key: None)
+    admission.start()
+    assert admission.wait_for_sync(SYNC_TIMEOUT)
+    yield admission
+    admission.stop()
+
+
+def test_free_capacity(admission):
+    free = admission.free_capacity()
+    assert set(free) == {"node-a", "node-b"}
+    assert free["node-a"]["cpu"] == 3
+    assert free["node-a"]["pods"] == 8
+    # terminated pods free their requests
+    assert free["node-b"]["cpu"] == 2
+
+
+def test_place_first_fit(admission):
+    # largest first: 2 on node-a, 2 on node-b, then 1 on node-a
+    assert admission.place([cpu("1"), cpu("2"), cpu("2")])
+    assert not admission.place([cpu("2500m"), cpu("2500m")])
+    # a replica never spans two nodes
+    assert not admission.place([cpu("4")])
+    # the pending replicas of the admitted jobs are placed first
+    assert admission.place([cpu("3")], [cpu("2")])
+    assert not admission.place([cpu("3")], [cpu("3")])
+
+
+def mx_spec(workers=1, cpu="1"):
+    container = {"name": "main", "image": "busybox", "resources": {"requests": {"cpu": cpu}}}
+    return [{"replicaType": replica_type, "replicas": count, "template": {"spec": {"containers": [container]}}}
+            for replica_type, count in (("SCHEDULER", 1), ("SERVER", 1), ("WORKER", workers))]
+
+
+def job_pod(name, job_name, owner_uid):
+    obj = pod(name, job_name)
+    obj["metadata"]["ownerReferences"] = [{"apiVersion": "v1", "kind": "MXJob", "name": job_name,
+                                           "uid": owner_uid, "controller": True}]
+    return obj
+
+
+def test_started_jobs_are_admitted_without_capacity(fake_server, admission, cache):
+    # 6 cores, 5 are free
+    job = MXJob("big", mx_spec(cpu="2"), cache, None, uid="uid-new")
+    fake_server.store.create("pods", "default", job_pod("scheduler-big-0", "big", "uid-old"))
+    assert cache.pods.wait_for(lambda: cache.get_pods("big"), SYNC_TIMEOUT)
+    # left over by a deleted job with the same name
+    assert not admission.admit("default/big", job)
+    assert admission.waiting("default/big")
+
+    fake_server.store.create("pods", "default", job_pod("server-big-0", "big", "uid-new"))
+    assert cache.pods.wait_for(lambda: len(cache.get_pods("big")) == 2, SYNC_TIMEOUT)
+    assert admission.admit("default/big", job)
+    assert not admission.waiting("default/big")
+
+
+def test_scale_ups_are_admitted(admission, cache):
+    job = MXJob("mx", mx_spec(workers=1), cache, None, uid="uid-1")
+    assert admission.admit("default/mx", job)
+    # its 3 replicas are not bound yet, 2 more cores are free
+    assert admission.admit("default/mx", job, spec=mx_spec(workers=3))
+    assert not admission.admit("default/mx", job, spec=mx_spec(workers=4))
+    assert admission.waiting("default/mx")
+    # scaled back before it fits
+    assert admission.admit("default/mx", job, spec=mx_spec(workers=1))
+    assert not admission.waiting("default/mx")
+    assert admission.admit("default/mx", job, spec=mx_spec(workers=0))
+
+
+def test_only_freed_capacity_syncs_the_head(fake_server, admission, cache):
+    synced = []
+    admission.on_change = synced.append
+    assert not admission.admit("default/big", MXJob("big", mx_spec(cpu="2"), cache, None, uid="uid-1"))
+    synced.clear()
+
+    store = fake_server.store
+    store.create("pods", "default", bound_pod("new", "node-b", "1"))
+    with store.cond:
+        store.cond.wait_for(lambda: store.objects["pods"][("default", "new")]["status"]["phase"] == "Running",
+                            SYNC_TIMEOUT)
+    store.delete("pods", "default", "new")
+    assert admission.pods.wait_for(lambda: synced, SYNC_TIMEOUT)
+    time.sleep(0.2)
+    # once for the deletion, not for the creation and the start of the pod
+    assert synced == ["default/big"]
@@ -0,0 +1,161 @@
+import os
+import json
+import asyncio
+
+import pytest
+
+import settings.settings as settings
+from conftest import pod
+
+pytest.importorskip("kubernetes_asyncio")
+from kubernetes_asyncio import client  # noqa: E402
+from kubernetes_asyncio.config import kube_config  # noqa: E402
+import metrics  # noqa: E402
+from async_controller import AsyncDLOperator, AsyncJob, ConnectionStats, gather_all  # noqa: E402
+from dl_job import TFJob  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 10
+
+
+def test_gather_all_waits_for_every_awaitable():
+    finished = []
+
+    async def fail():
+        raise ValueError("failed")
+
+    async def slow():
+        await asyncio.sleep(0.1)
+        finished.append(True)
+
+    async def main():
+        with pytest.raises(ValueError):
+            await gather_all(fail(), slow())
+        # the sibling of the failure was not left running
+        assert finished == [True]
+    asyncio.run(main())
+
+
+def test_connection_stats_of_the_session(fake_server):
+    async def main():
+        configuration = client.Configuration()
+        configuration.host = fake_server.url
+        api_client = client.ApiClient(configuration)
+        stats = ConnectionStats(api_client)
+        try:
+            core_v1 = client.CoreV1Api(api_client)
+            for _ in range(3):
+                await core_v1.list_namespaced_pod("default")
+        finally:
+            await api_client.close()
+        return stats
+    stats = asyncio.run(main())
+    assert stats() == {"requests": 3, "connections": 1, "reused": 2}
+
+    metrics.export_connection_stats(stats)
+    rendered = metrics.render()
+    assert "dljob_api_pool_connections_opened 1" in rendered
+    assert "dljob_api_pool_connections_reused 2" in rendered
+
+
+def test_published_topology_is_patched(fake_server, cache, monkeypatch):
+    monkeypatch.setattr(settings, "TOPOLOGY_CONFIGMAP", True)
+    spec = [{"replicaType": replica_type, "replicas": count, "template": {"spec": {"containers": [
+        {"name": "main", "image": "busybox"}]}}} for replica_type, count in (("ps", 1), ("worker", 2))]
+    job = TFJob("tf", spec, cache, core_v1_client=None)
+    job.create_replicas()
+    store = fake_server.store
+
+    async def main():
+        configuration = client.Configuration()
+        configuration.host = fake_server.url
+        async with client.ApiClient(configuration) as api_client:
+            async_job = AsyncJob(job, client.CoreV1Api(api_client), cache)
+            await async_job.publish_topology()
+            job.scale([spec[0], {**spec[1], "replicas": 3}])
+            await async_job.publish_topology()
+            # unchanged
+            await async_job.publish_topology()
+    asyncio.run(main())
+    cluster = json.loads(store.objects["configmaps"][("default", "tf-topology")]["data"]["TF_CLUSTER"])
+    assert cluster["worker"] == ["worker0.2222", "worker1.2222", "worker2.2222"]
+    assert store.calls[("create", "configmaps")] == 1
+    assert store.calls[("patch", "configmaps")] == 1
+
+
+def service(name, job_name):
+    return {"metadata": {"name": name, "labels": {"job_name": job_name, "service_name": name}},
+            "spec": {"ports": [{"port": 9000}]}}
+
+
+def mxjob(name):
+    return {"apiVersion": f"{settings.DOMAIN}/v1", "kind": "MXJob", "metadata": {"name": name, "namespace": "default"},
+            "spec": [{"replicaType": "SCHEDULER", "replicas": 1, "template": {"spec": {"containers": [
+                {"name": "main", "image": "busybox"}]}}}]}
+
+
+@pytest.fixture
+def operator_setup(fake_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    kubeconfig = tmp_path / "kubeconfig"
+    fake_server.write_kubeconfig(str(kubeconfig))
+    monkeypatch.setattr(kube_config, "KUBE_CONFIG_DEFAULT_LOCATION", str(kubeconfig))
+    monkeypatch.setattr(settings, "STATUS_UPDATE_PERIOD", 0)
+
+
+async def until(predicate, timeout=TIMEOUT):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.05)
+
+
+def run_operator(test):
+    async def main():
+        operator = AsyncDLOperator()
+        task = asyncio.ensure_future(operator.run())
+        try:
+            await test(operator)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(main())
+
+
+def test_warm_start_deletes_the_resources_of_deleted_jobs(fake_server, operator_setup, monkeypatch):
+    monkeypatch.setattr(settings, "WARM_START", True)
+    store = fake_server.store
+    store.create(f"{settings.DOMAIN}/mxjobs", "default", mxjob("kept"))
+    store.create("pods", "default", pod("scheduler-kept-0", "kept"))
+    store.create("pods", "default", pod("scheduler-gone-0", "gone"))
+    store.create("services", "default", service("scheduler-gone-0-service", "gone"))
+
+    async def test(operator):
+        await until(lambda: ("default", "scheduler-gone-0") not in store.objects["pods"] and
+                    ("default", "scheduler-gone-0-service") not in store.objects["services"])
+        # adopted with its running pod
+        await until(lambda: "default/kept" in operator.jobs)
+        assert ("default", "scheduler-kept-0") in store.objects["pods"]
+        assert store.calls[("deletecollection", "pods")] == 1
+
+    run_operator(test)
+
+
+def test_cold_start_deletes_the_custom_resources(fake_server, operator_setup, monkeypatch):
+    monkeypatch.setattr(settings, "WARM_START", False)
+    store = fake_server.store
+    store.create("customresourcedefinitions", None,
+                 {"metadata": {"name": f"mxjobs.{settings.DOMAIN}"},
+                  "spec": {"group": settings.DOMAIN, "names": {"plural": "mxjobs", "kind": "MXJob"},
+                           "scope": "Namespaced", "versions": [{"name": "v1", "served": True, "storage": True}]}})
+    store.create(f"{settings.DOMAIN}/mxjobs", "default", mxjob("previous"))
+
+    async def test(operator):
+        await until(lambda: store.watchers[f"{settings.DOMAIN}/mxjobs"] >= 1)
+        assert store.calls[("delete", "customresourcedefinitions")] == 1
+        # the definition is created again, without the jobs of the previous run
+        assert (None, f"mxjobs.{settings.DOMAIN}") in store.objects["customresourcedefinitions"]
+        assert not store.objects[f"{settings.DOMAIN}/mxjobs"]
+        assert "default/previous" not in operator.jobs
+
+    run_operator(test)
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import settings.settings as settings
+from conftest import pod
+
+async_client = pytest.importorskip("kubernetes_asyncio.client")
+from async_controller import AsyncInformer, watch  # noqa: E402
+
+SYNC_TIMEOUT = 10
+
+
+async def eventually(predicate, timeout=SYNC_TIMEOUT):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.05)
+
+
+def run_informer(fake_server, test):
+    """Run the coroutine `test(informer)` with a started AsyncInformer of the pods of "default"."""
+    async def main():
+        configuration = async_client.Configuration()
+        configuration.host = fake_server.url
+        async with async_client.ApiClient(configuration) as api_client:
+            core_v1 = async_client.CoreV1Api(api_client)
+            informer = AsyncInformer(core_v1.list_namespaced_pod, "default", index_labels=("job_name",))
+            informer.start()
+            try:
+                assert await informer.wait_for_sync(SYNC_TIMEOUT)
+                await test(informer)
+            finally:
+                informer.stop()
+                await asyncio.gather(informer._task, return_exceptions=True)
+    asyncio.run(main())
+
+
+def test_bookmarks_advance_the_resource_version(fake_server):
+    store = fake_server.store
+
+    async def test(informer):
+        store.create("pods", "other", pod("b-0", "b", namespace="other"))
+        version = store.resource_version
+        await eventually(lambda: int(informer._resource_version) >= version)
+        assert store.calls[("watch", "pods")] == 1
+        store.create("pods", "default", pod("a-0", "a"))
+        await eventually(lambda: informer.get("a-0") is not None)
+        assert store.calls[("watch", "pods")] == 1
+
+    run_informer(fake_server, test)
+
+
+def test_watches_are_closed(fake_server, monkeypatch):
+    monkeypatch.setattr(settings, "WATCH_TIMEOUT", 1)
+    closed = []
+    close = watch.Watch.close
+
+    async def counting_close(self):
+        closed.append(self)
+        await close(self)
+    monkeypatch.setattr(watch.Watch, "close", counting_close)
+
+    async def test(informer):
+        # every watch ending on its timeout is closed before the next one is opened
+        await eventually(lambda: fake_server.store.calls[("watch", "pods")] >= 3)
+        assert len(closed) >= 2
+
+    run_informer(fake_server, test)
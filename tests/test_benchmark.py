@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+from benchmark import run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    # the operator processes run main.py from the current directory
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.mark.parametrize("overrides", [{}, {"ENGINE": "asyncio"}])
+def test_benchmark_runs_end_to_end(tmp_path, overrides):
+    result = run.run(jobs=2, replicas=3, timeout=60, overrides=overrides, log_dir=str(tmp_path))
+    assert result["pods"] == 6
+    assert result["api_calls_by_verb"]["create pods"] == 6
+    assert result["wall_time"] > 0
+    assert len(result["operators_usage"]) == 1
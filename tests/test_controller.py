@@ -0,0 +1,287 @@
+import time
+import functools
+import threading
+
+import pytest
+from kubernetes.config import kube_config
+
+import settings.settings as settings
+from controller import DLOperator, WorkQueue, spec_changed
+from status import StatusWriter
+from informer import ClusterCache
+from conftest import pod
+
+SYNC_TIMEOUT = 10
+
+
+def wait_until(predicate, timeout=SYNC_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def owned_pod(name, job_name, uid):
+    obj = pod(name, job_name)
+    obj["metadata"]["ownerReferences"] = [{"apiVersion": "v1", "kind": "MXJob", "name": job_name, "uid": uid}]
+    return obj
+
+
+@pytest.fixture
+def operator(core_v1):
+    # only the shared cache of the operator is needed
+    operator = DLOperator.__new__(DLOperator)
+    operator.cache = ClusterCache(core_v1)
+    operator.cache.start()
+    assert operator.cache.wait_for_sync(SYNC_TIMEOUT)
+    yield operator
+    operator.cache.stop()
+
+
+def test_has_resources(fake_server, operator):
+    store = fake_server.store
+    store.create("pods", "default", owned_pod("running-0", "running", "uid-1"))
+    store.create("pods", "default", owned_pod("recreated-0", "recreated", "uid-old"))
+    assert operator.cache.pods.wait_for(lambda: len(operator.cache.pods.list()) == 2, SYNC_TIMEOUT)
+
+    # started by the replica that owned the job before
+    assert operator.has_resources("default/running", "uid-1")
+    assert operator.has_resources("default/running", None)
+    # a new job is started, even over the leftovers of a deleted job with the same name
+    assert not operator.has_resources("default/new", "uid-2")
+    assert not operator.has_resources("default/recreated", "uid-new")
+
+
+def test_no_gang_admission_in_the_sharded_mode(monkeypatch):
+    monkeypatch.setattr(settings, "GANG_ADMISSION", True)
+    monkeypatch.setattr(settings, "SHARDED", True)
+    with pytest.raises(Exception, match="sharded"):
+        DLOperator()
+
+
+def service(name, job_name):
+    return {"metadata": {"name": name, "labels": {"job_name": job_name, "service_name": name}},
+            "spec": {"ports": [{"port": 9000}]}}
+
+
+def mxjob(name, namespace="default"):
+    container = {"name": "main", "image": "busybox"}
+    return {"apiVersion": f"{settings.DOMAIN}/v1", "kind": "MXJob", "metadata": {"name": name, "namespace": namespace},
+            "spec": [{"replicaType": replica_type, "replicas": 1, "template": {"spec": {"containers": [container]}}}
+                     for replica_type in ("SCHEDULER", "SERVER", "WORKER")]}
+
+
+@pytest.fixture
+def kubeconfig(fake_server, tmp_path, monkeypatch):
+    path = tmp_path / "kubeconfig"
+    fake_server.write_kubeconfig(str(path))
+    monkeypatch.setattr(kube_config, "KUBE_CONFIG_DEFAULT_LOCATION", str(path))
+    # no clean up at exit, the fake server is gone by then
+    monkeypatch.setattr(settings, "WARM_START", True)
+
+
+@pytest.fixture
+def warm_operator(fake_server, kubeconfig):
+    store = fake_server.store
+    # running before the operator restarted
+    store.create(f"{settings.DOMAIN}/mxjobs", "default", mxjob("kept"))
+    store.create("pods", "default", pod("scheduler-kept-0", "kept"))
+    store.create("pods", "default", pod("server-kept-0", "kept"))
+    store.create("services", "default", service("scheduler-kept-0-service", "kept"))
+    # deleted while the operator was down
+    store.create("pods", "default", pod("scheduler-gone-0", "gone"))
+    store.create("services", "default", service("scheduler-gone-0-service", "gone"))
+    with store.cond:
+        store.cond.wait_for(lambda: all(p["status"].get("phase") == "Running"
+                                        for p in store.objects["pods"].values()), SYNC_TIMEOUT)
+
+    operator = DLOperator()
+    yield operator
+    operator.queue.shut_down()
+    operator.cache.stop()
+
+
+def test_warm_start_adopts_the_running_jobs(fake_server, warm_operator):
+    store = fake_server.store
+    warm_operator.start_workers(1)
+    warm_operator.relist_crds(adopt=warm_operator.warm_start)
+    with store.cond:
+        # only the missing replica is created
+        assert store.cond.wait_for(lambda: ("default", "worker-kept-0") in store.objects["pods"], SYNC_TIMEOUT)
+    assert "default/kept" in warm_operator.jobs
+    assert store.calls[("create", "pods")] == 1
+    assert ("default", "scheduler-kept-0") in store.objects["pods"]
+    assert ("default", "server-kept-0") in store.objects["pods"]
+    assert store.calls[("deletecollection", "pods")] == 1
+
+
+def test_warm_start_deletes_the_resources_of_deleted_jobs(fake_server, warm_operator):
+    store = fake_server.store
+    warm_operator.relist_crds(adopt=True)
+    assert ("default", "scheduler-gone-0") not in store.objects["pods"]
+    assert ("default", "scheduler-gone-0-service") not in store.objects["services"]
+    assert ("default", "scheduler-kept-0-service") in store.objects["services"]
+    # left to the adoption of the job
+    assert ("default", "scheduler-kept-0") in store.objects["pods"]
+
+
+def test_deleted_jobs_are_garbage_collected(fake_server, kubeconfig):
+    store = fake_server.store
+    obj = store.create(f"{settings.DOMAIN}/mxjobs", "default", mxjob("owned"))
+    operator = DLOperator()
+    try:
+        operator.start_workers(1)
+        operator.relist_crds()
+        with store.cond:
+            assert store.cond.wait_for(lambda: len(store.objects["services"]) == 3, SYNC_TIMEOUT)
+        assert operator.cache.pods.wait_for(lambda: len(operator.cache.pods.list()) == 3, SYNC_TIMEOUT)
+        owner = {"apiVersion": f"{settings.DOMAIN}/v1", "kind": "MXJob", "name": "owned",
+                 "uid": obj["metadata"]["uid"], "controller": True, "blockOwnerDeletion": True}
+        for resource in ("pods", "services"):
+            assert all(o["metadata"]["ownerReferences"] == [owner] for o in store.objects[resource].values())
+
+        deletes = {call: n for call, n in store.calls.items() if call[0].startswith("delete")}
+        store.delete(f"{settings.DOMAIN}/mxjobs", "default", "owned")
+        operator.handle_event("DELETED", obj)
+        assert operator.cache.pods.wait_for(lambda: not operator.cache.pods.list(), SYNC_TIMEOUT)
+        assert wait_until(lambda: "default/owned" not in operator.jobs)
+        # the children are deleted by the garbage collector of the API server only
+        assert {call: n for call, n in store.calls.items() if call[0].startswith("delete")} == deletes
+        assert not store.objects["services"]
+    finally:
+        operator.queue.shut_down()
+        operator.cache.stop()
+
+
+def test_only_spec_changes_are_synced():
+    old = mxjob("job")
+    old["metadata"]["uid"] = "uid-1"
+    status = {**old, "status": {"phase": "Running"}}
+    scaled = {**old, "spec": [dict(s, replicas=2) for s in old["spec"]]}
+    assert not spec_changed(old, status)
+    assert spec_changed(old, scaled)
+    assert spec_changed(None, old)
+
+
+class RecordingQueue(WorkQueue):
+    """A WorkQueue recording the delayed adds instead of waiting for them."""
+
+    def __init__(self):
+        super(RecordingQueue, self).__init__()
+        self.delays = []
+
+    def add_after(self, key, delay):
+        self.delays.append((key, delay))
+
+
+def test_jobs_are_requeued_after_a_sync(monkeypatch):
+    monkeypatch.setattr(settings, "RESYNC_PERIOD", 60)
+    monkeypatch.setattr(settings, "RESYNC_JITTER", 0.2)
+    monkeypatch.setattr(settings, "REQUEUE_BACKOFF_BASE", 1)
+
+    def sync_job(key):
+        if key == "default/failing":
+            raise Exception("API server unavailable")
+
+    operator = DLOperator.__new__(DLOperator)
+    operator.queue = RecordingQueue()
+    operator.status = StatusWriter(lambda key: None, patch_func=None)
+    operator.jobs = {"default/running": None, "default/failing": None}
+    operator.sync_job = sync_job
+
+    worker = threading.Thread(target=operator.process_queue, daemon=True)
+    worker.start()
+
+    def process(*keys):
+        # a single worker processes the keys in order
+        operator.queue.delays.clear()
+        for key in keys:
+            operator.queue.add(key)
+        assert wait_until(lambda: operator.queue.delays and operator.queue.delays[-1][0] == keys[-1])
+        return dict(operator.queue.delays)
+
+    try:
+        delays = process("default/deleted", "default/running", "default/failing")
+        # resynced with jitter, failures backed off, deleted jobs forgotten
+        assert 60 <= delays["default/running"] <= 72
+        assert delays["default/failing"] == 1
+        assert "default/deleted" not in delays
+        assert process("default/failing")["default/failing"] == 2
+
+        operator.sync_job = lambda key: None
+        assert 60 <= process("default/failing")["default/failing"] <= 72
+        # the backoff starts over after a success
+        operator.sync_job = sync_job
+        assert process("default/failing")["default/failing"] == 1
+    finally:
+        operator.queue.shut_down()
+        worker.join(SYNC_TIMEOUT)
+
+
+def tfjob(name, namespace="default"):
+    container = {"name": "main", "image": "busybox"}
+    return {"apiVersion": f"{settings.DOMAIN}/v1", "kind": "TFJob", "metadata": {"name": name, "namespace": namespace},
+            "spec": [{"replicaType": replica_type, "replicas": 1, "template": {"spec": {"containers": [container]}}}
+                     for replica_type in ("ps", "worker")]}
+
+
+@pytest.fixture
+def event_handler():
+    # only the maps and the queue of the operator are needed
+    operator = DLOperator.__new__(DLOperator)
+    operator.job_objects = {}
+    operator.adopting = set()
+    operator.queue = WorkQueue()
+    return operator
+
+
+def test_jobs_are_keyed_by_namespace_and_name(event_handler, monkeypatch):
+    monkeypatch.setattr(settings, "WATCH_NAMESPACES", ["team-a", "team-b"])
+    for namespace in ("team-a", "team-b", "team-c"):
+        event_handler.handle_event("ADDED", mxjob("job", namespace))
+    # not served
+    assert set(event_handler.job_objects) == {"team-a/job", "team-b/job"}
+    assert len(event_handler.queue) == 2
+
+    monkeypatch.setattr(settings, "WATCH_NAMESPACES", None)
+    event_handler.handle_event("ADDED", mxjob("job", "team-c"))
+    assert "team-c/job" in event_handler.job_objects
+
+
+def test_jobs_of_two_kinds_with_the_same_name(event_handler, monkeypatch):
+    monkeypatch.setattr(settings, "WATCH_NAMESPACES", None)
+    event_handler.handle_event("ADDED", mxjob("job"))
+    event_handler.handle_event("ADDED", tfjob("job"))
+    # the pods and services of the second job would have the names of the first one's
+    assert event_handler.job_objects["default/job"]["kind"] == "MXJob"
+    event_handler.handle_event("DELETED", tfjob("job"))
+    assert "default/job" in event_handler.job_objects
+    event_handler.handle_event("ADDED", tfjob("job", "team-a"))
+    assert event_handler.job_objects["team-a/job"]["kind"] == "TFJob"
+
+
+def test_one_operator_serves_every_kind_and_namespace(fake_server, kubeconfig, monkeypatch):
+    monkeypatch.setattr(settings, "WATCH_NAMESPACES", None)
+    # the default of the cache is bound at import
+    monkeypatch.setattr(ClusterCache, "__init__", functools.partialmethod(ClusterCache.__init__, namespaces=None))
+    store = fake_server.store
+    store.create(f"{settings.DOMAIN}/mxjobs", "team-a", mxjob("job", "team-a"))
+    store.create(f"{settings.DOMAIN}/tfjobs", "team-b", tfjob("job", "team-b"))
+    operator = DLOperator()
+    try:
+        operator.start_workers(2)
+        operator.relist_crds()
+        with store.cond:
+            assert store.cond.wait_for(lambda: len(store.objects["pods"]) == 5, SYNC_TIMEOUT)
+        assert sorted(store.objects["pods"]) == [("team-a", "scheduler-job-0"), ("team-a", "server-job-0"),
+                                                 ("team-a", "worker-job-0"), ("team-b", "ps-job-0"),
+                                                 ("team-b", "worker-job-0")]
+        assert set(operator.jobs) == {"team-a/job", "team-b/job"}
+        # one list per kind, whatever the number of namespaces
+        assert store.calls[("list", f"{settings.DOMAIN}/mxjobs")] == 1
+        assert store.calls[("list", f"{settings.DOMAIN}/tfjobs")] == 1
+    finally:
+        operator.queue.shut_down()
+        operator.cache.stop()
@@ -0,0 +1,268 @@
+import json
+import functools
+
+import pytest
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from benchmark.fake_apiserver import FakeApiServer
+from dl_job import MXJob, TFJob
+import settings.settings as settings
+from informer import ClusterCache
+from conftest import pod
+
+CONTAINER = {"name": "main", "image": "busybox"}
+
+
+def mx_spec(servers=1, workers=2):
+    return [{"replicaType": replica_type, "replicas": count, "template": {"spec": {"containers": [CONTAINER]}}}
+            for replica_type, count in (("SCHEDULER", 1), ("SERVER", servers), ("WORKER", workers))]
+
+
+@pytest.fixture
+def slow_server():
+    """A fake API server assigning the pod IPs after a while, as a real cluster does."""
+    server = FakeApiServer(pod_start_delay=0.5).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def slow_core_v1(slow_server):
+    configuration = client.Configuration()
+    configuration.host = slow_server.url
+    return client.CoreV1Api(client.ApiClient(configuration))
+
+
+@pytest.fixture
+def slow_cache(slow_core_v1):
+    cache = ClusterCache(slow_core_v1)
+    cache.start()
+    assert cache.wait_for_sync(timeout=5)
+    yield cache
+    cache.stop()
+
+
+class IgnoringDeletes:
+    """A CoreV1Api whose collection deletes of pods are accepted but never carried out."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def delete_collection_namespaced_pod(self, namespace, **kwargs):
+        pass
+
+
+class NoServiceCollectionDelete:
+    """A CoreV1Api talking to an API server without collection deletes of services."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def delete_collection_namespaced_service(self, namespace, **kwargs):
+        raise ApiException(status=405, reason="MethodNotAllowed")
+
+
+def environment(pod):
+    return {e.name: e.value for e in pod.spec.containers[0].env}
+
+
+def test_mx_replicas_need_the_scheduler_ip(slow_cache):
+    job = MXJob("mx", mx_spec(), slow_cache, core_v1_client=None)
+    job.create_replicas()
+    scheduler, server = job.replicas[0], job.replicas[1]
+
+    assert job.replica_environment(scheduler)["DMLC_ROLE"] == "scheduler"
+    with pytest.raises(Exception, match="no IP"):
+        job.replica_environment(server)
+
+    scheduler.scheduler_ip = "10.0.0.1"
+    assert job.replica_environment(server)["DMLC_PS_ROOT_URI"] == "10.0.0.1"
+
+
+def test_adopted_scheduler_without_ip(slow_core_v1, slow_cache):
+    job = MXJob("mx", mx_spec(), slow_cache, slow_core_v1)
+    job.create_replicas()
+    # left Pending by a previous operator
+    slow_core_v1.create_namespaced_pod("default", job.replicas[0].build_pod())
+    assert slow_cache.pods.wait_for(lambda: slow_cache.get_pod(job.replicas[0].replica_name), timeout=5)
+
+    job.adopt()
+
+    assert job.scheduler_ip()
+    assert slow_cache.pods.wait_for(lambda: len(slow_cache.get_pods("mx")) == 4, timeout=5)
+    for r in job.replicas[1:]:
+        assert environment(slow_cache.get_pod(r.replica_name))["DMLC_PS_ROOT_URI"] == job.scheduler_ip()
+
+
+def test_clean_up_times_out(fake_server, core_v1, cache, monkeypatch):
+    monkeypatch.setattr(ClusterCache, "wait_for_pods_deleted",
+                        functools.partialmethod(ClusterCache.wait_for_pods_deleted, timeout=0.3))
+    fake_server.store.create("pods", "default", pod("worker-mx-0", "mx"))
+    assert cache.pods.wait_for(lambda: cache.get_pods("mx"), 5)
+    job = MXJob("mx", mx_spec(), cache, IgnoringDeletes(core_v1))
+    with pytest.raises(TimeoutError):
+        job.clean_up_pods()
+    # without waiting, the deletion is only requested
+    assert job.clean_up_pods(wait=False) == 1
+
+
+def started_job(cache, core_v1):
+    job = MXJob("mx", mx_spec(), cache, core_v1)
+    job.start()
+    assert cache.pods.wait_for(lambda: len(cache.get_pods("mx")) == 4, 5)
+    assert cache.services.wait_for(lambda: len(cache.get_services("mx")) == 4, 5)
+    return job
+
+
+def test_clean_up_deletes_collections(fake_server, core_v1, cache):
+    job = started_job(cache, core_v1)
+    calls = dict(fake_server.store.calls)
+
+    assert job.clean_up() == (4, 4)
+
+    new_calls = {call: n - calls.get(call, 0) for call, n in fake_server.store.calls.items() if n > calls.get(call, 0)}
+    assert new_calls == {("deletecollection", "pods"): 1, ("deletecollection", "services"): 1}
+    assert cache.get_pods("mx") == [] and cache.get_services("mx") == []
+
+
+def test_clean_up_falls_back_to_service_deletes(fake_server, core_v1, cache):
+    job = started_job(cache, core_v1)
+    job.core_v1_client = NoServiceCollectionDelete(core_v1)
+    calls = dict(fake_server.store.calls)
+
+    assert job.clean_up() == (4, 4)
+
+    store = fake_server.store
+    assert store.calls[("deletecollection", "pods")] - calls.get(("deletecollection", "pods"), 0) == 1
+    assert store.calls[("delete", "services")] - calls.get(("delete", "services"), 0) == 4
+    assert cache.get_services("mx") == []
+
+
+def tf_spec(ps=1, workers=2):
+    return [{"replicaType": replica_type, "replicas": count, "template": {"spec": {"containers": [CONTAINER]}}}
+            for replica_type, count in (("ps", ps), ("worker", workers))]
+
+
+def test_pods_not_in_the_cache_yet_are_not_created_again(fake_server, core_v1, monkeypatch):
+    # never started: the watch events of the created pods are not received yet
+    lagging_cache = ClusterCache(core_v1)
+    job = TFJob("tf", tf_spec(), lagging_cache, core_v1)
+    job.start()
+    store = fake_server.store
+    assert store.calls[("create", "pods")] == 3
+
+    assert not job.needs_reconcile()
+    job.reconcile()
+    assert store.calls[("create", "pods")] == 3
+
+    # seen by the cache, then deleted
+    job.pod_observed("worker-tf-0")
+    assert job.needs_reconcile()
+
+    # created again once the expectations expire, the pods that exist are not an error
+    monkeypatch.setattr(settings, "EXPECTATION_TIMEOUT", 0)
+    job.reconcile()
+    assert store.calls[("create", "pods")] == 6
+    assert len(store.objects["pods"]) == 3
+
+
+def cluster(ps, workers):
+    return {"ps": [f"ps{i}.2222" for i in range(ps)], "worker": [f"worker{i}.2222" for i in range(workers)]}
+
+
+def test_topology_is_published_in_a_config_map(fake_server, core_v1, cache, monkeypatch):
+    monkeypatch.setattr(settings, "TOPOLOGY_CONFIGMAP", True)
+    job = TFJob("tf", tf_spec(), cache, core_v1)
+    job.start()
+    store = fake_server.store
+    config_map = store.objects["configmaps"][("default", "tf-topology")]
+    assert config_map["metadata"]["labels"]["job_name"] == "tf"
+    assert json.loads(config_map["data"]["TF_CLUSTER"]) == cluster(1, 2)
+
+    container = store.objects["pods"][("default", "worker-tf-1")]["spec"]["containers"][0]
+    assert container["envFrom"] == [{"configMapRef": {"name": "tf-topology"}}]
+    # expanded by the kubelet from the ConfigMap
+    tf_config = {e["name"]: e["value"] for e in container["env"]}["TF_CONFIG"]
+    assert tf_config == '{"cluster": $(TF_CLUSTER), "task": {"type": "worker", "index": 1}}'
+
+    # the published ConfigMap is patched, without trying to create it again
+    job.update(tf_spec(workers=3))
+    config_map = store.objects["configmaps"][("default", "tf-topology")]
+    assert json.loads(config_map["data"]["TF_CLUSTER"]) == cluster(1, 3)
+    assert store.calls[("create", "configmaps")] == 1
+    assert store.calls[("patch", "configmaps")] == 1
+
+    job.clean_up()
+    assert not store.objects["configmaps"]
+
+
+def test_topology_left_over_by_a_previous_job_is_replaced(fake_server, core_v1, cache, monkeypatch):
+    monkeypatch.setattr(settings, "TOPOLOGY_CONFIGMAP", True)
+    store = fake_server.store
+    store.create("configmaps", "default", {"metadata": {"name": "tf-topology"}, "data": {"TF_CLUSTER": "{}"}})
+    job = TFJob("tf", tf_spec(), cache, core_v1)
+    job.start()
+    assert json.loads(store.objects["configmaps"][("default", "tf-topology")]["data"]["TF_CLUSTER"]) == cluster(1, 2)
+    assert store.calls[("patch", "configmaps")] == 1
+
+
+def tf_config(store, name):
+    env = store.objects["pods"][("default", name)]["spec"]["containers"][0]["env"]
+    return json.loads({e["name"]: e["value"] for e in env}["TF_CONFIG"])
+
+
+def pod_names(store):
+    return sorted(name for _, name in store.objects["pods"])
+
+
+def test_scale_up_and_down_only_changes_the_delta(fake_server, core_v1, cache, caplog):
+    store = fake_server.store
+    job = TFJob("tf", tf_spec(ps=1, workers=2), cache, core_v1)
+    job.start()
+    assert cache.pods.wait_for(lambda: len(cache.pods.list()) == 3, 10)
+    uids = {name: pod["metadata"]["uid"] for (_, name), pod in store.objects["pods"].items()}
+
+    job.update(tf_spec(ps=1, workers=4))
+    assert pod_names(store) == ["ps-tf-0", "worker-tf-0", "worker-tf-1", "worker-tf-2", "worker-tf-3"]
+    assert store.calls[("create", "pods")] == 5
+    # left running, with the previous topology in their environment
+    assert all(store.objects["pods"][("default", name)]["metadata"]["uid"] == uid for name, uid in uids.items())
+    assert "keep the previous topology" in caplog.text
+    assert tf_config(store, "worker-tf-0")["cluster"] == cluster(1, 2)
+    assert tf_config(store, "worker-tf-3")["cluster"] == cluster(1, 4)
+
+    assert cache.pods.wait_for(lambda: len(cache.pods.list()) == 5, 10)
+    job.update(tf_spec(ps=1, workers=1))
+    assert pod_names(store) == ["ps-tf-0", "worker-tf-0"]
+    assert sorted(name for _, name in store.objects["services"]) == ["ps-tf-0-service", "worker-tf-0-service"]
+    assert [r.replica_name for r in job.replicas] == ["ps-tf-0", "worker-tf-0"]
+    assert store.calls[("create", "pods")] == 5
+    assert store.calls[("delete", "pods")] == 3
+
+
+def test_resync_recreates_the_lost_pods(fake_server, core_v1, cache):
+    store = fake_server.store
+    job = TFJob("tf", tf_spec(), cache, core_v1)
+    cache.pods.add_handler(lambda operation, pod: job.pod_observed(pod.metadata.name))
+    job.start()
+    assert cache.pods.wait_for(lambda: len(cache.pods.list()) == 3, 10)
+
+    # a healthy job is checked from the cache only
+    calls = sum(store.calls.values())
+    assert not job.needs_reconcile()
+    assert sum(store.calls.values()) == calls
+
+    # e.g. evicted
+    store.delete("pods", "default", "worker-tf-1")
+    assert cache.pods.wait_for(lambda: len(cache.pods.list()) == 2, 10)
+    assert job.needs_reconcile()
+    job.reconcile()
+    assert pod_names(store) == ["ps-tf-0", "worker-tf-0", "worker-tf-1"]
+    assert store.calls[("create", "pods")] == 4
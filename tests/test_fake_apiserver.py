@@ -0,0 +1,51 @@
+import json
+import http.client
+from urllib.parse import urlparse
+
+from conftest import pod
+
+
+def connect(fake_server):
+    url = urlparse(fake_server.url)
+    return http.client.HTTPConnection(url.hostname, url.port, timeout=10)
+
+
+def request(connection, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def test_delete_body_does_not_corrupt_the_next_request(fake_server):
+    store = fake_server.store
+    store.create("pods", "default", pod("a-0", "a"))
+    store.create("pods", "default", pod("a-1", "a"))
+    connection = connect(fake_server)
+    try:
+        # the requests are sent on the same keep-alive connection
+        status, _ = request(connection, "DELETE", "/api/v1/namespaces/default/pods/a-0", {})
+        assert status == 200
+        status, _ = request(connection, "DELETE", "/api/v1/namespaces/default/pods", {})
+        assert status == 200
+        status, data = request(connection, "GET", "/api/v1/namespaces/default/pods")
+        assert status == 200
+        assert json.loads(data)["items"] == []
+    finally:
+        connection.close()
+
+
+def test_watch_query_is_case_insensitive(fake_server):
+    fake_server.store.create("pods", "default", pod("a-0", "a"))
+    connection = connect(fake_server)
+    try:
+        # as sent by kubernetes_asyncio
+        connection.request("GET", "/api/v1/namespaces/default/pods?watch=True&resourceVersion=0&timeoutSeconds=1")
+        response = connection.getresponse()
+        assert response.status == 200
+        event = json.loads(response.readline())
+        assert event["type"] == "ADDED"
+        assert event["object"]["metadata"]["name"] == "a-0"
+    finally:
+        connection.close()
+    assert fake_server.store.calls[("watch", "pods")] == 1
@@ -0,0 +1,144 @@
+import time
+import threading
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+from informer import Informer
+from conftest import pod
+
+SYNC_TIMEOUT = 10
+
+
+def start_informer(core_v1, **kwargs):
+    informer = Informer(core_v1.list_namespaced_pod, "default", index_labels=("job_name",), **kwargs)
+    informer.start()
+    assert informer.wait_for_sync(SYNC_TIMEOUT)
+    return informer
+
+
+def test_list_then_watch(fake_server, core_v1):
+    store = fake_server.store
+    store.create("pods", "default", pod("a-0", "a"))
+    store.create("pods", "other", pod("b-0", "b", namespace="other"))
+    informer = start_informer(core_v1)
+    try:
+        assert [p.metadata.name for p in informer.list()] == ["a-0"]
+
+        store.create("pods", "default", pod("a-1", "a"))
+        store.create("pods", "default", pod("c-0", "c"))
+        assert informer.wait_for(lambda: len(informer.by_label("job_name", "a")) == 2, SYNC_TIMEOUT)
+        assert informer.get("c-0") is not None
+
+        store.patch("pods", "default", "a-0", {"metadata": {"labels": {"job_name": "c"}}})
+        store.delete("pods", "default", "c-0")
+        assert informer.wait_for(lambda: informer.get("c-0") is None, SYNC_TIMEOUT)
+        assert informer.wait_for(
+            lambda: [p.metadata.name for p in informer.by_label("job_name", "c")] == ["a-0"], SYNC_TIMEOUT)
+        assert [p.metadata.name for p in informer.by_label("job_name", "a")] == ["a-1"]
+    finally:
+        informer.stop()
+
+
+def test_handlers_see_every_change(fake_server, core_v1):
+    events = []
+    informer = Informer(core_v1.list_namespaced_pod, "default")
+    informer.add_handler(lambda operation, obj: events.append((operation, obj.metadata.name)))
+    informer.start()
+    try:
+        assert informer.wait_for_sync(SYNC_TIMEOUT)
+        fake_server.store.create("pods", "default", pod("a-0"))
+        fake_server.store.delete("pods", "default", "a-0")
+        assert informer.wait_for(lambda: ("DELETED", "a-0") in events, SYNC_TIMEOUT)
+        assert events[0] == ("ADDED", "a-0")
+    finally:
+        informer.stop()
+
+
+def test_relists_when_the_resource_version_expired(fake_server, core_v1):
+    store = fake_server.store
+    store.history = 5
+    informer = Informer(core_v1.list_namespaced_pod, "default")
+    informer.relist()
+    # more changes than the server keeps: the version of the informer is gone
+    for i in range(10):
+        store.create("pods", "default", pod(f"a-{i}"))
+    with pytest.raises(ApiException) as e:
+        informer.watch()
+    assert e.value.status == 410
+
+    informer.start()
+    try:
+        assert informer.wait_for(lambda: len(informer.list()) == 10, SYNC_TIMEOUT)
+        store.create("pods", "default", pod("a-10"))
+        assert informer.wait_for(lambda: informer.get("a-10") is not None, SYNC_TIMEOUT)
+    finally:
+        informer.stop()
+
+
+def test_relist_dispatches_the_missed_changes(fake_server, core_v1):
+    store = fake_server.store
+    store.create("pods", "default", pod("a-0", "a"))
+    store.create("pods", "default", pod("a-1", "a"))
+    informer = Informer(core_v1.list_namespaced_pod, "default", index_labels=("job_name",))
+    events = []
+    informer.add_handler(lambda operation, obj: events.append((operation, obj.metadata.name)))
+    informer.relist()
+    # the initial list is not a change
+    assert events == []
+
+    # while the watch is down, e.g. until its resourceVersion expires
+    store.delete("pods", "default", "a-0")
+    store.create("pods", "default", pod("a-2", "a"))
+    informer.relist()
+    assert ("DELETED", "a-0") in events
+    assert ("ADDED", "a-2") in events
+    assert ("ADDED", "a-1") not in events
+    assert informer.get("a-0") is None
+    assert [p.metadata.name for p in informer.by_label("job_name", "a")] == ["a-1", "a-2"]
+
+
+def test_bookmarks_advance_the_resource_version(fake_server, core_v1):
+    store = fake_server.store
+    informer = start_informer(core_v1)
+    try:
+        # changes the informer does not see, only the bookmarks tell it how far the watch got
+        store.create("pods", "other", pod("b-0", "b", namespace="other"))
+        version = store.resource_version
+        assert informer.wait_for(lambda: int(informer._resource_version) >= version, SYNC_TIMEOUT)
+        # the watch was not restarted by the bookmarks
+        assert store.calls[("watch", "pods")] == 1
+        store.create("pods", "default", pod("a-0", "a"))
+        assert informer.wait_for(lambda: informer.get("a-0") is not None, SYNC_TIMEOUT)
+        assert store.calls[("watch", "pods")] == 1
+    finally:
+        informer.stop()
+
+
+def test_wait_for_gives_up_at_the_deadline(fake_server, core_v1):
+    informer = start_informer(core_v1)
+    try:
+        start = time.monotonic()
+        assert not informer.wait_for(lambda: informer.get("a-0") is not None, 0.3)
+        assert 0.3 <= time.monotonic() - start < 2
+    finally:
+        informer.stop()
+
+
+def test_wait_for_wakes_up_on_events(fake_server, core_v1):
+    store = fake_server.store
+    informer = start_informer(core_v1)
+    try:
+        threading.Timer(0.2, store.create, ("pods", "default", pod("a-0", "a"))).start()
+        start = time.monotonic()
+        assert informer.wait_for(lambda: informer.get("a-0") is not None, SYNC_TIMEOUT)
+        assert time.monotonic() - start < 2
+    finally:
+        informer.stop()
+
+
+def test_wait_for_pod_ip(fake_server, cache):
+    fake_server.store.create("pods", "default", pod("a-0", "a"))
+    # assigned by the fake kubelet
+    assert cache.wait_for_pod_ip("a-0", timeout=SYNC_TIMEOUT).startswith("10.")
+    assert cache.wait_for_pod_ip("missing", timeout=0.2) is None
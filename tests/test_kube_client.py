@@ -0,0 +1,164 @@
+import json
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+import settings.settings as settings
+import kube_client
+from kube_client import RequestLayer, RequestStats, RetryBudget, TokenBucket, is_retriable, retry_delay
+
+
+def api_exception(status, reason=None, headers=None):
+    e = ApiException(status=status)
+    e.body = json.dumps({"kind": "Status", "reason": reason}) if reason else None
+    e.headers = headers
+    return e
+
+
+class Clock:
+    """Replaces time.monotonic in kube_client."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kube_client.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(qps=10, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    # the next requests wait for the tokens they took in advance
+    assert bucket.reserve() == pytest.approx(0.1)
+    assert bucket.reserve() == pytest.approx(0.2)
+    clock.now += 10
+    # refilled up to the burst only
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() > 0
+
+
+def test_retry_budget_is_a_sliding_window(clock):
+    budget = RetryBudget(retries=2, period=60)
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+    clock.now += 30
+    assert not budget.spend()
+    clock.now += 31
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+
+
+def test_retriable_errors():
+    for status in settings.API_RETRY_STATUSES:
+        assert is_retriable(api_exception(status))
+    assert is_retriable(api_exception(409, "Conflict"))
+    assert not is_retriable(api_exception(409, "AlreadyExists"))
+    assert not is_retriable(api_exception(409))
+    assert not is_retriable(api_exception(404, "NotFound"))
+    assert not is_retriable(api_exception(422, "Invalid"))
+
+
+def test_retry_delay_is_bounded_and_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(kube_client.random, "uniform", lambda low, high: high)
+    assert retry_delay(0, api_exception(500)) == settings.API_RETRY_BASE_DELAY
+    assert retry_delay(2, api_exception(500)) == settings.API_RETRY_BASE_DELAY * 4
+    assert retry_delay(100, api_exception(500)) == settings.API_RETRY_MAX_DELAY
+    assert retry_delay(0, api_exception(429, headers={"Retry-After": "7"})) == 7
+
+
+class Unlimited:
+    def acquire(self):
+        return 0
+
+
+class FakeApi:
+    """Answers each call with the next of `results`, raising the exceptions."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    def create_namespaced_pod(self, *args, **kwargs):
+        return self.next()
+
+    def delete_namespaced_pod(self, *args, **kwargs):
+        return self.next()
+
+    def next(self):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(kube_client.time, "sleep", lambda seconds: None)
+
+
+def layer(api, budget=None):
+    return RequestLayer(api, Unlimited(), budget, RequestStats())
+
+
+def test_request_layer_retries_retriable_errors(no_sleep):
+    api = FakeApi([api_exception(503), api_exception(409, "Conflict"), "ok"])
+    requests = layer(api)
+    assert requests.create_namespaced_pod("default", {}) == "ok"
+    assert api.calls == 3
+    assert requests.stats.snapshot()["retries"] == 2
+
+
+def test_request_layer_does_not_retry_other_errors(no_sleep):
+    api = FakeApi([api_exception(404, "NotFound"), "ok"])
+    with pytest.raises(ApiException):
+        layer(api).delete_namespaced_pod("a", "default")
+    assert api.calls == 1
+
+
+def test_request_layer_gives_up_after_the_maximum_retries(no_sleep, monkeypatch):
+    monkeypatch.setattr(settings, "API_MAX_RETRIES", 2)
+    api = FakeApi([api_exception(500)] * 5)
+    with pytest.raises(ApiException):
+        layer(api).delete_namespaced_pod("a", "default")
+    assert api.calls == 3
+
+
+def test_request_layer_stops_when_the_budget_is_spent(no_sleep, clock):
+    api = FakeApi([api_exception(500)] * 5)
+    requests = layer(api, RetryBudget(retries=1, period=60))
+    with pytest.raises(ApiException):
+        requests.delete_namespaced_pod("a", "default")
+    assert api.calls == 2
+    assert requests.stats.snapshot()["budget_exhausted"] == 1
+
+
+def test_retried_create_already_existing_was_created_by_a_previous_attempt(no_sleep):
+    api = FakeApi([api_exception(500), api_exception(409, "AlreadyExists")])
+    assert layer(api).create_namespaced_pod("default", {}) is None
+    assert api.calls == 2
+
+
+def test_first_create_already_existing_fails(no_sleep):
+    api = FakeApi([api_exception(409, "AlreadyExists")])
+    with pytest.raises(ApiException) as e:
+        layer(api).create_namespaced_pod("default", {})
+    assert e.value.status == 409
+
+
+def test_connection_stats_of_the_pool(fake_server):
+    configuration = kube_client.client.Configuration()
+    configuration.host = fake_server.url
+    api_client = kube_client.PooledApiClient(configuration)
+    core_v1 = kube_client.client.CoreV1Api(api_client)
+    for _ in range(3):
+        core_v1.list_namespaced_pod("default")
+    # one connection kept alive for all the requests
+    assert api_client.connection_stats() == {"requests": 3, "connections": 1, "reused": 2}
@@ -0,0 +1,81 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    # the metrics of the operator are left out of the rendered text
+    registry = []
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+
+def test_counter_rendering():
+    counter = metrics.Counter("requests_total", "Requests sent", ("verb", "path"))
+    counter.labels("get", "/a").inc()
+    counter.labels("get", "/a").inc(2)
+    counter.labels("post", 'say "hi"\n').inc()
+    assert metrics.render() == (
+        "# HELP requests_total Requests sent\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{verb="get",path="/a"} 3.0\n'
+        'requests_total{verb="post",path="say \\"hi\\"\\n"} 1.0\n'
+    )
+
+
+def test_labels_must_match_the_label_names():
+    counter = metrics.Counter("requests_total", "Requests sent", ("verb",))
+    with pytest.raises(ValueError):
+        counter.labels("get", "pods")
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("duration_seconds", "Duration", buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.labels().observe(value)
+    assert metrics.render().splitlines()[2:] == [
+        'duration_seconds_bucket{le="0.1"} 2',
+        'duration_seconds_bucket{le="1"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        "duration_seconds_sum 3.65",
+        "duration_seconds_count 4",
+    ]
+
+
+def test_gauge_computed_at_scrape_time():
+    items = []
+    gauge = metrics.Gauge("items", "Items")
+    gauge.set_function(lambda: len(items))
+    items.extend([1, 2])
+    assert metrics.render().splitlines()[-1] == "items 2"
+
+
+@pytest.mark.parametrize("func_name, expected", [
+    ("create_namespaced_pod", ("create", "pod")),
+    ("delete_collection_namespaced_service", ("deletecollection", "service")),
+    ("list_pod_for_all_namespaces", ("list", "pod")),
+    ("patch_namespaced_custom_object_status", ("patch", "custom_object_status")),
+    ("list_cluster_custom_object", ("list", "custom_object")),
+])
+def test_verb_and_resource(func_name, expected):
+    assert metrics.verb_and_resource(func_name) == expected
+
+
+def test_server_serves_the_metrics():
+    metrics.Gauge("items", "Items").labels().set(1)
+    server = metrics.start_server(port=0, address="127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert response.read().decode() == metrics.render()
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"{url}/other", timeout=5)
+        assert e.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
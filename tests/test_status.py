@@ -0,0 +1,99 @@
+from kubernetes.client.rest import ApiException
+
+from status import StatusWriter, merge_diff
+
+
+def test_merge_diff():
+    old = {"phase": "Creating", "replicas": {"worker": 2, "ps": 1}, "message": "waiting"}
+    new = {"phase": "Running", "replicas": {"worker": 2, "ps": 1, "chief": 1}, "startTime": 10}
+    assert merge_diff(old, new) == {"phase": "Running", "replicas": {"chief": 1}, "message": None, "startTime": 10}
+    assert merge_diff(new, new) == {}
+    # a value replacing a nested object, and the reverse, are written whole
+    assert merge_diff({"replicas": {"worker": 2}}, {"replicas": 2}) == {"replicas": 2}
+    assert merge_diff({"replicas": 2}, {"replicas": {"worker": 2}}) == {"replicas": {"worker": 2}}
+
+
+class Jobs:
+    """Custom resources and status of the jobs, and the patches written."""
+
+    def __init__(self):
+        self.objects = dict()
+        self.status = dict()
+        self.patches = []
+        self.errors = []
+
+    def status_func(self, key):
+        if key not in self.objects:
+            return None
+        return self.objects[key], dict(self.status[key])
+
+    def patch_func(self, obj, body):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.patches.append((obj["metadata"]["name"], body))
+
+
+def writer(jobs):
+    return StatusWriter(jobs.status_func, jobs.patch_func, period=3600)
+
+
+def test_changes_are_coalesced():
+    jobs = Jobs()
+    jobs.objects["default/a"] = {"metadata": {"name": "a"}}
+    jobs.status["default/a"] = {"phase": "Creating", "running": 0}
+    status = writer(jobs)
+    for running in range(3):
+        jobs.status["default/a"]["running"] = running
+        status.touch("default/a")
+    status.flush()
+    # one write with the status at the end of the period
+    assert jobs.patches == [("a", {"status": {"phase": "Creating", "running": 2}})]
+
+    jobs.status["default/a"]["phase"] = "Running"
+    status.touch("default/a")
+    status.flush()
+    assert jobs.patches[-1] == ("a", {"status": {"phase": "Running"}})
+
+    # unchanged, or not touched
+    status.touch("default/a")
+    status.flush()
+    status.flush()
+    assert len(jobs.patches) == 2
+
+
+def test_status_observed_in_the_custom_resource_is_not_written_again():
+    jobs = Jobs()
+    jobs.objects["default/a"] = {"metadata": {"name": "a"}, "status": {"phase": "Running", "running": 2}}
+    jobs.status["default/a"] = {"phase": "Running", "running": 2}
+    status = writer(jobs)
+    status.touch("default/a")
+    status.flush()
+    assert jobs.patches == []
+
+
+def test_failed_writes_are_retried():
+    jobs = Jobs()
+    jobs.objects["default/a"] = {"metadata": {"name": "a"}}
+    jobs.objects["default/deleted"] = {"metadata": {"name": "deleted"}}
+    jobs.status["default/a"] = jobs.status["default/deleted"] = {"phase": "Running"}
+    status = writer(jobs)
+    jobs.errors = [ApiException(status=500)]
+    status.touch("default/a")
+    status.flush()
+    status.flush()
+    assert jobs.patches == [("a", {"status": {"phase": "Running"}})]
+
+    # deleted in the meantime
+    jobs.errors = [ApiException(status=404)]
+    status.touch("default/deleted")
+    status.flush()
+    status.flush()
+    assert jobs.patches == [("a", {"status": {"phase": "Running"}})]
+
+
+def test_jobs_not_managed_are_skipped():
+    jobs = Jobs()
+    status = writer(jobs)
+    status.touch("default/other")
+    status.flush()
+    assert jobs.patches == []
@@ -0,0 +1,67 @@
+import logging
+
+import pytest
+
+import settings.settings as settings
+from template import PodTemplate
+
+CONTAINER = {"name": "main", "image": "busybox", "command": ["sleep", "60"]}
+
+
+def template(*containers):
+    return {"spec": {"containers": list(containers)}}
+
+
+@pytest.mark.parametrize("spec", [{}, {"spec": {}}, template(), {"spec": {"containers": ["busybox"]}}])
+def test_template_without_container_is_rejected(spec):
+    with pytest.raises(Exception, match="at least one container"):
+        PodTemplate("job", "worker", spec, {})
+
+
+def test_container_without_image_is_rejected():
+    with pytest.raises(Exception, match="must define an image"):
+        PodTemplate("job", "worker", template({"name": "main"}), {})
+
+
+def test_unknown_container_keys_are_skipped(caplog):
+    with caplog.at_level(logging.WARNING):
+        pod_template = PodTemplate("job", "worker", template({**CONTAINER, "imagePolicy": "Always"}), {})
+    assert "unknown container key imagePolicy" in caplog.text
+    assert pod_template.container == CONTAINER
+
+
+def test_only_the_first_container_is_used(caplog):
+    with caplog.at_level(logging.WARNING):
+        pod_template = PodTemplate("job", "worker", template(CONTAINER, {"name": "sidecar", "image": "envoy"}), {})
+    assert "only the first container" in caplog.text
+    assert pod_template.pod("worker-job-0")["spec"]["containers"] == [CONTAINER]
+
+
+def test_pods_share_the_skeleton_but_not_the_env():
+    spec = template(dict(CONTAINER))
+    pod_template = PodTemplate("job", "worker", spec, {})
+    first = pod_template.pod("worker-job-0", env={"RANK": 0})
+    second = pod_template.pod("worker-job-1", env={"RANK": 1})
+    assert first["metadata"]["labels"] == {"pod_name": "worker-job-0", "job_name": "job"}
+    assert first["spec"]["hostname"] == "worker-job-0"
+    assert first["spec"]["containers"][0]["env"] == [{"name": "RANK", "value": "0"}]
+    assert second["spec"]["containers"][0]["env"] == [{"name": "RANK", "value": "1"}]
+    # neither the skeleton nor the job spec get the env of a replica
+    assert "env" not in pod_template.container
+    assert spec == template(CONTAINER)
+
+
+def test_topology_configmap_is_mounted():
+    pod = PodTemplate("job", "worker", template(CONTAINER), {}, topology_configmap="job-topology").pod("worker-job-0")
+    container = pod["spec"]["containers"][0]
+    assert container["envFrom"] == [{"configMapRef": {"name": "job-topology"}}]
+    assert container["volumeMounts"] == [{"name": "topology", "mountPath": settings.TOPOLOGY_MOUNT_PATH,
+                                          "readOnly": True}]
+    assert pod["spec"]["volumes"] == [{"name": "topology", "configMap": {"name": "job-topology"}}]
+
+
+def test_service_exposes_the_replica_ports():
+    service = PodTemplate("job", "worker", template(CONTAINER), {}).service("worker-job-0", [2222, 2223])
+    assert service["metadata"]["name"] == "worker-job-0-service"
+    assert service["spec"] == {"selector": {"pod_name": "worker-job-0"},
+                               "ports": [{"name": "dlport0", "port": 2222}, {"name": "dlport1", "port": 2223}]}
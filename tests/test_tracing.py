@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+
+import tracing
+
+
+def span(span_id, parent_id, start, duration, name=None):
+    return {"name": name or span_id, "job": "default/job", "span_id": span_id, "parent_id": parent_id,
+            "start": start, "duration": duration, "thread": "main", "error": None, "attributes": {}}
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.MemoryExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def test_critical_path():
+    # sync (0-10)
+    #   clean_up (0-2)
+    #   reconcile (2-10)
+    #     scheduler (2-5), waits for its IP (3-5)
+    #     server (5-7) and worker (5-9) in parallel
+    #   check (9-9.5), overlapped by reconcile
+    spans = [
+        span("sync", None, 0, 10),
+        span("clean_up", "sync", 0, 2),
+        span("reconcile", "sync", 2, 8),
+        span("scheduler", "reconcile", 2, 3),
+        span("wait_ip", "scheduler", 3, 2),
+        span("server", "reconcile", 5, 2),
+        span("worker", "reconcile", 5, 4),
+        span("check", "sync", 9, 0.5),
+    ]
+    path = tracing.critical_path(spans, spans[0])
+    assert [(depth, s["span_id"]) for depth, s in path] == [
+        (0, "sync"),
+        (1, "clean_up"),
+        (1, "reconcile"),
+        (2, "scheduler"),
+        (3, "wait_ip"),
+        (2, "worker"),
+    ]
+
+
+def test_critical_path_of_a_span_without_children():
+    root = span("sync", None, 0, 1)
+    assert tracing.critical_path([root], root) == [(0, root)]
+
+
+def test_timeline_of_a_trace_file(tmp_path, capsys):
+    path = tmp_path / "trace.jsonl"
+    exporter = tracing.JsonLinesExporter(str(path))
+    tracing.set_exporter(exporter)
+    try:
+        with tracing.span("operator.sync_job", job="default/job"):
+            with tracing.span("job.reconcile"):
+                pass
+    finally:
+        tracing.set_exporter(None)
+        exporter.close()
+    tracing.print_timeline(tracing.load(str(path)), "default/job", depth=0)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("Job default/job: 2 spans")
+    # the nested spans are left out of the timeline, not of the critical path
+    assert lines[1].endswith("operator.sync_job ")
+    assert lines[2] == "Critical path of operator.sync_job:"
+    assert lines[4].endswith("  job.reconcile ")
+    assert len(lines) == 5
+
+
+def test_spans_are_nested(exporter):
+    with tracing.span("operator.sync_job", job="default/job"):
+        with tracing.span("api.create_namespaced_pod", root=False, code=201):
+            pass
+        with pytest.raises(ValueError):
+            with tracing.span("job.reconcile"):
+                raise ValueError()
+    # not recorded outside of a job
+    with tracing.span("api.list_namespaced_pod", root=False):
+        pass
+    api, reconcile, sync = exporter.spans
+    assert sync["parent_id"] is None
+    assert api["parent_id"] == reconcile["parent_id"] == sync["span_id"]
+    assert api["job"] == reconcile["job"] == "default/job"
+    assert api["attributes"] == {"code": 201}
+    assert reconcile["error"] == "ValueError"
+
+
+def test_wrapped_functions_run_in_the_span_of_the_caller(exporter):
+    @tracing.traced("replica.reconcile")
+    def reconcile():
+        pass
+
+    with tracing.span("job.reconcile", job="default/job"):
+        thread = threading.Thread(target=tracing.wrap(reconcile))
+        thread.start()
+        thread.join()
+    replica, job = exporter.spans
+    assert replica["parent_id"] == job["span_id"]
+    assert replica["job"] == "default/job"
+
+
+def test_no_spans_without_exporter():
+    assert tracing.span("operator.sync_job", job="default/job") is tracing.NULL_SPAN
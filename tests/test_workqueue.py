@@ -0,0 +1,92 @@
+import time
+import threading
+
+import settings.settings as settings
+from controller import WorkQueue
+
+
+def test_add_deduplicates_waiting_keys():
+    queue = WorkQueue()
+    queue.add("a")
+    queue.add("b")
+    queue.add("a")
+    assert len(queue) == 2
+    assert queue.get() == "a"
+    assert queue.get() == "b"
+    assert len(queue) == 0
+
+
+def test_key_added_while_processing_is_queued_again_by_done():
+    queue = WorkQueue()
+    queue.add("a")
+    assert queue.get() == "a"
+    queue.add("a")
+    queue.add("a")
+    # not handed to a second worker while the first one holds it
+    assert len(queue) == 0
+    queue.done("a")
+    assert len(queue) == 1
+    assert queue.get() == "a"
+    queue.done("a")
+    assert len(queue) == 0
+
+
+def test_done_without_changes_does_not_queue_again():
+    queue = WorkQueue()
+    queue.add("a")
+    queue.get()
+    queue.done("a")
+    assert len(queue) == 0
+
+
+def test_add_after_keeps_the_earliest_due_time():
+    queue = WorkQueue()
+    queue.add_after("a", 10)
+    queue.add_after("a", 0.05)
+    queue.add_after("a", 20)
+    start = time.monotonic()
+    assert queue.get() == "a"
+    assert time.monotonic() - start < 5
+    queue.done("a")
+    # the replaced entries of the heap are skipped
+    queue.shut_down()
+    assert queue.get() is None
+
+
+def test_add_after_does_not_duplicate_a_waiting_key():
+    queue = WorkQueue()
+    queue.add("a")
+    queue.add_after("a", 0.01)
+    time.sleep(0.05)
+    assert queue.get() == "a"
+    queue.done("a")
+    assert len(queue) == 0
+
+
+def test_add_rate_limited_backs_off_exponentially(monkeypatch):
+    monkeypatch.setattr(settings, "REQUEUE_BACKOFF_BASE", 1)
+    monkeypatch.setattr(settings, "REQUEUE_BACKOFF_MAX", 3)
+    delays = []
+    queue = WorkQueue()
+    monkeypatch.setattr(queue, "add_after", lambda key, delay: delays.append(delay))
+    for _ in range(4):
+        queue.add_rate_limited("a")
+    assert delays == [1, 2, 3, 3]
+    queue.forget("a")
+    queue.add_rate_limited("a")
+    assert delays[-1] == 1
+
+
+def test_get_wakes_up_on_add_and_on_shut_down():
+    queue = WorkQueue()
+    keys = []
+    worker = threading.Thread(target=lambda: keys.extend([queue.get(), queue.get()]))
+    worker.start()
+    queue.add("a")
+    time.sleep(0.05)
+    queue.shut_down()
+    worker.join(5)
+    assert keys == ["a", None]
+    # keys added after the shut down are dropped
+    queue.add("b")
+    assert len(queue) == 0
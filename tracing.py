@@ -0,0 +1,372 @@
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import argparse
+import itertools
+import threading
+import functools
+import contextvars
+from collections import deque
+
+import settings.settings as settings
+
+import logging
+logger = logging.getLogger(os.path.basename(__file__))
+
+# span of the current thread or asyncio task
+_current = contextvars.ContextVar("span", default=None)
+# thread id -> innermost open span of the thread, read by the sampling profiler
+_active = dict()
+_ids = itertools.count(1)
+# where the finished spans are sent, None disables the tracing
+_exporter = None
+
+
+class Span:
+    """
+    One timed operation of the operator, e.g. the reconcile of a job or one API request.
+
+    Spans opened while another span is open in the same thread or asyncio task are its
+    children, and belong to the same job. All the spans of a job, across threads and
+    operator processes, can be put back together offline with their `job` and ids.
+    """
+
+    __slots__ = ("name", "job", "span_id", "parent_id", "start", "duration", "attributes", "error",
+                 "_t0", "_token", "_previous")
+
+    def __init__(self, name, job, parent, attributes):
+        self.name = name
+        self.job = job if job is not None or parent is None else parent.job
+        self.span_id = f"{os.getpid():x}-{next(_ids):x}"
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        # wall clock to line up the processes, monotonic clock for the duration
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _current.set(self)
+        thread = threading.get_ident()
+        self._previous = _active.get(thread)
+        _active[thread] = self
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self._t0
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        _current.reset(self._token)
+        thread = threading.get_ident()
+        if self._previous is None:
+            _active.pop(thread, None)
+        else:
+            _active[thread] = self._previous
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "job": self.job,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "thread": threading.current_thread().name,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+class NullSpan:
+    """Returned by `span` when the tracing is disabled, costs a function call.
+    """
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, job=None, root=True, **attributes):
+    """Open a span, to be used as a context manager.
+
+        Args:
+            name: Name of the operation
+            job: Key of the job (namespace/name), by default the job of the enclosing span
+            root: If False, the span is only recorded inside another span (e.g. for API
+                requests, which are only interesting as part of the sync of a job)
+            attributes: Attributes of the span, more can be added with `Span.set`
+    """
+    if _exporter is None:
+        return NULL_SPAN
+    parent = _current.get()
+    if parent is None and not root:
+        return NULL_SPAN
+    return Span(name, job, parent, attributes)
+
+
+def traced(name):
+    """Decorator recording every call of a function or a coroutine function as a span named `name`.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def call_async(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return call_async
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return call
+    return decorator
+
+
+def wrap(func):
+    """Make `func` run as part of the current span in another thread, e.g. in a `ThreadPoolExecutor`.
+    """
+    parent = _current.get()
+    if _exporter is None or parent is None:
+        return func
+
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return call
+
+
+class JsonLinesExporter:
+    """
+    Append the finished spans to a file, one JSON object per line. Several operator
+    processes can share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class MemoryExporter:
+    """
+    Keep the last `maxlen` finished spans in memory, as dictionaries, e.g. for tests and benchmarks.
+    """
+
+    def __init__(self, maxlen=None):
+        self.spans = deque(maxlen=maxlen)
+
+    def export(self, span):
+        self.spans.append(span.to_dict())
+
+
+def set_exporter(exporter):
+    """Send the finished spans to `exporter` (an object with an `export(span)` method), or disable the tracing with None.
+    """
+    global _exporter
+    _exporter = exporter
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of every thread of the process every `interval` seconds, from a
+    daemon thread. The samples are counted per stack, prefixed with the job and the span
+    that were open in the thread, and written to `path` in the "folded" format of
+    flame graph tools (`frame;frame;... count` per line) every `dump_period` seconds and
+    on exit. With the asyncio engine the job of a sample is only indicative, since all
+    the jobs share the same thread.
+    """
+
+    dump_period = 30
+
+    def __init__(self, interval, path):
+        self.interval = interval
+        self.path = path
+        self.counts = dict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Sampling the stacks every {self.interval}s to {self.path}")
+
+    def stop(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self.dump()
+
+    def run(self):
+        last_dump = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_dump >= self.dump_period:
+                self.dump()
+                last_dump = time.monotonic()
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread, frame in sys._current_frames().items():
+            if thread == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(thread, str(thread)))
+            active = _active.get(thread)
+            if active is not None:
+                stack.append(f"span:{active.name}")
+                stack.append(f"job:{active.job}")
+            key = ";".join(reversed(stack))
+            with self._lock:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def dump(self):
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.counts.items()]
+        with open(self.path, "w") as f:
+            f.writelines(lines)
+
+
+def configure(trace_file=settings.TRACE_FILE, profile_interval=settings.PROFILE_INTERVAL,
+              profile_file=settings.PROFILE_FILE):
+    """Enable the tracing and the sampling profiler as set in the settings.
+
+        Returns:
+            The SamplingProfiler, or None if it is disabled
+    """
+    if trace_file is not None:
+        set_exporter(JsonLinesExporter(trace_file))
+        logger.info(f"Writing the trace spans to {trace_file}")
+    if not profile_interval:
+        return None
+    profiler = SamplingProfiler(profile_interval, profile_file)
+    profiler.start()
+    return profiler
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def end(s):
+    return s["start"] + s["duration"]
+
+
+def critical_path(spans, root):
+    """The spans that determined the end of `root`. Walking back from the end of a span, the
+    child that ended last is on the path, then the child that ended last before it started,
+    and so on, recursively: the children not on the path ran in parallel with it.
+
+        Args:
+            spans: The spans of the trace, as dictionaries
+            root: The span to start from
+
+        Returns:
+            List. (depth, span) of the spans on the path, in order of start
+    """
+    children = dict()
+    for s in spans:
+        children.setdefault(s["parent_id"], []).append(s)
+
+    def walk(span, depth):
+        path = [(depth, span)]
+        on_path = []
+        bound = end(span)
+        for child in sorted(children.get(span["span_id"], []), key=end, reverse=True):
+            if end(child) <= bound:
+                on_path.append(child)
+                bound = child["start"]
+        for child in reversed(on_path):
+            path.extend(walk(child, depth + 1))
+        return path
+    return walk(root, 0)
+
+
+def print_timeline(spans, job, depth=None):
+    """Print the spans of one job as an indented timeline, then the critical path of its longest span.
+
+        Args:
+            spans: The spans of the trace, as dictionaries
+            job: Key of the job
+            depth: Levels of nested spans to print in the timeline, default: all
+    """
+    spans = sorted((s for s in spans if s["job"] == job), key=lambda s: s["start"])
+    if not spans:
+        print(f"No spans for job {job}")
+        return
+    origin = spans[0]["start"]
+    print(f"Job {job}: {len(spans)} spans over {max(end(s) for s in spans) - origin:.3f}s")
+    ids = {s["span_id"]: s for s in spans}
+    children = dict()
+    for s in spans:
+        children.setdefault(s["parent_id"] if s["parent_id"] in ids else None, []).append(s)
+
+    def line(s, level):
+        error = f" !{s['error']}" if s["error"] else ""
+        attributes = " ".join(f"{k}={v}" for k, v in s["attributes"].items())
+        return f"{s['start'] - origin:9.3f}s {s['duration']:9.3f}s {'  ' * level}{s['name']}{error} {attributes}"
+
+    def show(s, level):
+        print(line(s, level))
+        if depth is None or level < depth:
+            for child in children.get(s["span_id"], []):
+                show(child, level + 1)
+
+    for root in children[None]:
+        show(root, 0)
+    longest = max(children[None], key=lambda s: s["duration"])
+    print(f"Critical path of {longest['name']}:")
+    for level, s in critical_path(spans, longest):
+        print(line(s, level))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the per-job timelines of a trace file")
+    parser.add_argument("trace", help="JSON lines file written with TRACE_FILE")
+    parser.add_argument("--job", action="append", help="key (namespace/name) of a job to show, default: all")
+    parser.add_argument("--depth", type=int, help="levels of nested spans to show in the timelines, default: all")
+    args = parser.parse_args()
+    trace = load(args.trace)
+    for key in args.job or sorted({s["job"] for s in trace if s["job"] is not None}):
+        print_timeline(trace, key, args.depth)
+        print()